@@ -0,0 +1,516 @@
+from argparse import ArgumentParser
+import copy
+import math
+import resource
+import time
+
+import torch
+import torch.nn.functional as F
+
+from utils import load_config
+import numpy as np
+
+from dataset import read_rgb_img, SatMapDataset, graph_collate_fn, GraphCollator
+from model import SAMRoad, TopoNet, build_inference_model, _low_res_map_decoder_forward
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--config", default=None, help="model config."
+)
+parser.add_argument("--device", default="cuda", help="device to benchmark on")
+parser.add_argument("--repeats", default=10, type=int, help="timed runs per setting")
+subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+toponet_parser = subparsers.add_parser("toponet", help="TopoNet forward, padded vs packed attention.")
+toponet_parser.add_argument("--batch_size", default=64, type=int, help="patches per TopoNet batch")
+toponet_parser.add_argument("--points_per_patch", default=128, type=int)
+toponet_parser.add_argument(
+    "--densities", default="0.1,0.25,0.5,1.0", help="mean fraction of valid pairs per sample, comma separated"
+)
+
+infer_toponet_parser = subparsers.add_parser("infer_toponet", help="SAMRoad.infer_toponet throughput.")
+infer_toponet_parser.add_argument("--batch_size", default=64, type=int, help="patches per TopoNet batch")
+infer_toponet_parser.add_argument("--points_per_patch", default=128, type=int)
+infer_toponet_parser.add_argument("--density", default=0.5, type=float, help="mean fraction of valid pairs per sample")
+
+encoder_parser = subparsers.add_parser(
+    "encoder", help="image encoder patches/s and peak memory, run one backend per process for CPU peak memory.")
+encoder_parser.add_argument("--batch_size", default=2, type=int)
+encoder_parser.add_argument("--backend", default="default", choices=["default", "sdpa"], help="ENCODER_ATTN_BACKEND")
+encoder_parser.add_argument("--train", default=False, action='store_true', help="forward + backward instead of inference")
+encoder_parser.add_argument("--checkpoint_every", default=0, type=int, help="ENCODER_CHECKPOINT_EVERY")
+encoder_parser.add_argument("--window_size", default=None, type=int, help="ENCODER_WINDOW_SIZE, defaults to the config")
+
+encoder_max_batch_parser = subparsers.add_parser(
+    "encoder_max_batch",
+    help="largest encoder training batch that fits, doubling from 1, and its patches/s. One setting per process.")
+encoder_max_batch_parser.add_argument("--backend", default="default", choices=["default", "sdpa"], help="ENCODER_ATTN_BACKEND")
+encoder_max_batch_parser.add_argument("--checkpoint_every", default=0, type=int, help="ENCODER_CHECKPOINT_EVERY")
+encoder_max_batch_parser.add_argument("--window_size", default=None, type=int, help="ENCODER_WINDOW_SIZE, defaults to the config")
+encoder_max_batch_parser.add_argument(
+    "--memory_limit_mb", default=None, type=float, help="peak memory budget, defaults to running until CUDA OOM")
+encoder_max_batch_parser.add_argument("--max_batch_size", default=256, type=int)
+
+cached_train_parser = subparsers.add_parser(
+    "cached_train", help="FREEZE_ENCODER training steps/s, from rgb vs from cached image embeddings.")
+cached_train_parser.add_argument("--batch_size", default=None, type=int, help="defaults to BATCH_SIZE")
+cached_train_parser.add_argument("--points_per_patch", default=128, type=int)
+cached_train_parser.add_argument("--density", default=0.5, type=float, help="mean fraction of valid pairs per sample")
+
+token_prune_parser = subparsers.add_parser(
+    "token_prune", help="encoder token pruning, patches/s and mask agreement with the dense encoder.")
+token_prune_parser.add_argument("--checkpoint", default=None, help="trained checkpoint, random weights if not given")
+token_prune_parser.add_argument(
+    "--images", default=None, help="test tile images to crop patches from, comma separated. Random patches if not given")
+token_prune_parser.add_argument("--max_patches", default=32, type=int)
+token_prune_parser.add_argument("--batch_size", default=4, type=int)
+token_prune_parser.add_argument("--keep_ratios", default="0.75,0.5,0.25", help="TOKEN_PRUNE_KEEP_RATIO, comma separated")
+token_prune_parser.add_argument("--threshold", default=0.5, type=float, help="mask score threshold for IoU")
+
+mask_downsample_parser = subparsers.add_parser(
+    "mask_downsample", help="low resolution mask decoding, patches/s and mask IoU with full resolution decoding.")
+mask_downsample_parser.add_argument("--checkpoint", default=None, help="trained checkpoint, random weights if not given")
+mask_downsample_parser.add_argument(
+    "--images", default=None, help="test tile images to crop patches from, comma separated. Random patches if not given")
+mask_downsample_parser.add_argument("--max_patches", default=32, type=int)
+mask_downsample_parser.add_argument("--batch_size", default=4, type=int)
+mask_downsample_parser.add_argument("--threshold", default=0.5, type=float, help="mask score threshold for IoU")
+
+collate_parser = subparsers.add_parser(
+    "collate", help="training batch collate time, per-item torch padding vs buffered numpy collate.")
+collate_parser.add_argument("--batch_size", default=None, type=int, help="defaults to BATCH_SIZE")
+collate_parser.add_argument("--points_per_patch", default=128, type=int, help="max graph points of the random samples")
+collate_parser.add_argument(
+    "--from_dataset", default=False, action='store_true', help="collate SatMapDataset training samples instead of random ones")
+
+patch_sampler_parser = subparsers.add_parser(
+    "patch_sampler", help="training crops without graph points and valid pairs per crop, uniform vs road-aware sampling.")
+patch_sampler_parser.add_argument("--samples", default=1000, type=int, help="crops drawn per sampler")
+patch_sampler_parser.add_argument("--seed", default=0, type=int)
+
+
+def time_fn(fn, device, repeats):
+    # Seconds per call, after one warm up call.
+    with torch.no_grad():
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start_seconds = time.time()
+        for _ in range(repeats):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start_seconds) / repeats
+
+
+def random_topo_queries(config, batch_size, n_points, density, device):
+    # Mimics inference queries: each point is a sample, its valid pairs are the
+    # leading knn neighbors within NEIGHBOR_RADIUS.
+    n_pairs = config.MAX_NEIGHBOR_QUERIES
+    points = torch.rand(batch_size, n_points, 2, device=device) * config.PATCH_SIZE
+    pairs = torch.randint(0, n_points, (batch_size, n_points, n_pairs, 2), device=device)
+    valid_nums = torch.distributions.Binomial(n_pairs, torch.tensor(density)).sample((batch_size, n_points))
+    valid = torch.arange(n_pairs).view(1, 1, -1) < valid_nums.unsqueeze(-1)
+    return points, pairs, valid.to(device)
+
+
+def benchmark_toponet(config, args, device):
+    feature_dim = 256
+    net = TopoNet(config, feature_dim).eval().to(device)
+    packed_net = copy.deepcopy(net)
+    packed_net.config = copy.deepcopy(config)
+    packed_net.config.TOPONET_PACKED_ATTN = True
+    net.config = copy.deepcopy(config)
+    net.config.TOPONET_PACKED_ATTN = False
+
+    for density in [float(d) for d in args.densities.split(',')]:
+        points, pairs, valid = random_topo_queries(config, args.batch_size, args.points_per_patch, density, device)
+        point_features = torch.randn(args.batch_size, args.points_per_patch, feature_dim, device=device)
+        padded_seconds = time_fn(lambda: net(points, point_features, pairs, valid), device, args.repeats)
+        packed_seconds = time_fn(lambda: packed_net(points, point_features, pairs, valid), device, args.repeats)
+        print(
+            f'valid pair density {density:.2f} ({valid.float().mean().item():.3f} measured): '
+            f'padded {padded_seconds * 1000:.2f} ms, packed {packed_seconds * 1000:.2f} ms, '
+            f'speedup {padded_seconds / packed_seconds:.2f}x'
+        )
+
+
+def benchmark_infer_toponet(config, args, device):
+    # TopoNet inference from stored image embeddings, as in pass 2 of the inferencer.
+    net = SAMRoad(config, load_sam_ckpt=False).eval().to(device)
+    embedding_size = config.PATCH_SIZE // 16
+    image_embeddings = torch.randn(args.batch_size, 256, embedding_size, embedding_size, device=device)
+    points, pairs, valid = random_topo_queries(config, args.batch_size, args.points_per_patch, args.density, device)
+    seconds = time_fn(lambda: net.infer_toponet(image_embeddings, points, pairs, valid), device, args.repeats)
+    print(
+        f'infer_toponet: {seconds * 1000:.2f} ms per batch of {args.batch_size} patches, '
+        f'{valid.sum().item() / seconds:.0f} valid pairs/s, {pairs.shape[1] * pairs.shape[2] * args.batch_size / seconds:.0f} pairs/s'
+    )
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # process peak RSS, Linux reports KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def encoder_setting(config, args):
+    config = copy.deepcopy(config)
+    config.ENCODER_ATTN_BACKEND = args.backend
+    config.ENCODER_CHECKPOINT_EVERY = args.checkpoint_every
+    if args.window_size:
+        config.ENCODER_WINDOW_SIZE = args.window_size
+    return config, (
+        f'{args.backend} attention, checkpoint every {args.checkpoint_every or "-"}, '
+        f'window {config.ENCODER_WINDOW_SIZE or 14}'
+    )
+
+
+def encoder_flops(net):
+    # Multiply-adds x 2 of one patch through the encoder blocks, and the fraction spent on
+    # tokens padded to a multiple of the window size.
+    # qkv and proj run on the padded windows, the mlp on the token grid only.
+    encoder = net.image_encoder
+    # tokens per side
+    grid_size = encoder.pos_embed.shape[1]
+    flops, padding_flops = 0, 0
+    for blk in encoder.blocks:
+        dim = blk.norm1.normalized_shape[0]
+        if blk.window_size > 0:
+            window_num = math.ceil(grid_size / blk.window_size) ** 2
+            attn_tokens, window_tokens = window_num * blk.window_size ** 2, blk.window_size ** 2
+        else:
+            attn_tokens, window_tokens = grid_size ** 2, grid_size ** 2
+        # qkv + proj linears, q @ k and attn @ v
+        attn_flops = 2 * attn_tokens * 4 * dim * dim + 2 * 2 * attn_tokens * window_tokens * dim
+        mlp_flops = 2 * grid_size ** 2 * 2 * dim * blk.mlp.lin1.out_features
+        flops += attn_flops + mlp_flops
+        padding_flops += attn_flops * (1 - grid_size ** 2 / attn_tokens)
+    return flops, padding_flops / flops
+
+
+def sdpa_kernels(run):
+    # SDPA kernels the attention calls of run() dispatch to. The calls are captured, one per input
+    # shape, and replayed with one backend allowed at a time, in the dispatcher's priority order.
+    from torch.nn.attention import sdpa_kernel, SDPBackend
+    sdpa = F.scaled_dot_product_attention
+    calls = {}
+
+    def capture(*args, **kwargs):
+        calls.setdefault(tuple((a.shape, a.dtype) for a in args if torch.is_tensor(a)), (args, kwargs))
+        return sdpa(*args, **kwargs)
+
+    F.scaled_dot_product_attention = capture
+    try:
+        run()
+    finally:
+        F.scaled_dot_product_attention = sdpa
+    kernels = set()
+    with torch.no_grad():
+        for args, kwargs in calls.values():
+            args = [a.detach() if torch.is_tensor(a) else a for a in args]
+            for backend in [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]:
+                try:
+                    with sdpa_kernel(backend):
+                        sdpa(*args, **kwargs)
+                except RuntimeError:
+                    continue
+                kernels.add(f'{backend.name} (head dim {args[0].shape[-1]})')
+                break
+    return sorted(kernels)
+
+
+def benchmark_encoder(config, args, device):
+    config, setting = encoder_setting(config, args)
+    net = SAMRoad(config, load_sam_ckpt=False).to(device)
+    net.train(args.train)
+    patches = torch.rand(args.batch_size, 3, config.PATCH_SIZE, config.PATCH_SIZE, device=device)
+
+    def run():
+        if args.train:
+            with torch.enable_grad():
+                net.image_encoder(patches).sum().backward()
+        else:
+            net.image_encoder(patches)
+
+    base_memory_mb = peak_memory_mb(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    seconds = time_fn(run, device, args.repeats)
+    flops, padding_fraction = encoder_flops(net)
+    print(
+        f'encoder {setting}, {"train" if args.train else "inference"}, '
+        f'PATCH_SIZE {config.PATCH_SIZE}, batch {args.batch_size}: '
+        f'{args.batch_size / seconds:.3f} patches/s, peak memory +{peak_memory_mb(device) - base_memory_mb:.0f} MB, '
+        f'{flops / 1e9:.1f} GFLOPs per patch in blocks, {padding_fraction:.3f} of them on window padding'
+    )
+    if args.backend == 'sdpa':
+        print(f'sdpa kernels: {", ".join(sdpa_kernels(run))}')
+
+
+def benchmark_encoder_max_batch(config, args, device):
+    config, setting = encoder_setting(config, args)
+    net = SAMRoad(config, load_sam_ckpt=False).to(device)
+    net.train()
+    base_memory_mb = peak_memory_mb(device)
+
+    def train_step(patches):
+        with torch.enable_grad():
+            net.image_encoder(patches).sum().backward()
+        net.zero_grad(set_to_none=True)
+
+    # CPU peak RSS can't be reset, but it grows with the batch size, so the last step dominates.
+    fit_batch_size, fit_seconds, fit_memory_mb = 0, None, None
+    batch_size = 1
+    while batch_size <= args.max_batch_size:
+        patches = torch.rand(batch_size, 3, config.PATCH_SIZE, config.PATCH_SIZE, device=device)
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        try:
+            seconds = time_fn(lambda: train_step(patches), device, args.repeats)
+        except torch.cuda.OutOfMemoryError:
+            break
+        memory_mb = peak_memory_mb(device) - base_memory_mb
+        if args.memory_limit_mb is not None and memory_mb > args.memory_limit_mb:
+            break
+        print(f'batch {batch_size}: {batch_size / seconds:.3f} patches/s, peak memory +{memory_mb:.0f} MB')
+        fit_batch_size, fit_seconds, fit_memory_mb = batch_size, seconds, memory_mb
+        batch_size *= 2
+        del patches
+    if fit_batch_size == 0:
+        print(f'encoder {setting}, PATCH_SIZE {config.PATCH_SIZE}: batch 1 does not fit')
+        return
+    print(
+        f'encoder {setting}, PATCH_SIZE {config.PATCH_SIZE}: largest batch {fit_batch_size}, '
+        f'{fit_batch_size / fit_seconds:.3f} patches/s, peak memory +{fit_memory_mb:.0f} MB'
+    )
+
+
+def benchmark_cached_train(config, args, device):
+    # Model forward + backward only, data loading is not included.
+    config = copy.deepcopy(config)
+    config.FREEZE_ENCODER = True
+    config.ENCODER_LORA = False
+    batch_size = args.batch_size or config.BATCH_SIZE
+    net = SAMRoad(config, load_sam_ckpt=False).train().to(device)
+    rgb = torch.rand(batch_size, config.PATCH_SIZE, config.PATCH_SIZE, 3, device=device) * 255.0
+    embedding_size = config.PATCH_SIZE // 16
+    image_embeddings = torch.randn(
+        batch_size, 256, embedding_size, embedding_size, device=device).to(torch.float16)
+    points, pairs, valid = random_topo_queries(config, batch_size, args.points_per_patch, args.density, device)
+
+    def train_step(**image_input):
+        with torch.enable_grad():
+            mask_logits, _, topo_logits, _ = net(graph_points=points, pairs=pairs, valid=valid, **image_input)
+            (mask_logits.mean() + topo_logits.mean()).backward()
+        net.zero_grad(set_to_none=True)
+
+    rgb_seconds = time_fn(lambda: train_step(rgb=rgb), device, args.repeats)
+    cached_seconds = time_fn(lambda: train_step(rgb=None, image_embeddings=image_embeddings), device, args.repeats)
+    print(
+        f'FREEZE_ENCODER training, PATCH_SIZE {config.PATCH_SIZE}, batch {batch_size}: '
+        f'from rgb {1 / rgb_seconds:.3f} steps/s, from cached embeddings {1 / cached_seconds:.3f} steps/s, '
+        f'speedup {rgb_seconds / cached_seconds:.2f}x'
+    )
+
+
+def image_patches(config, args):
+    # [N, H, W, C] 0-255, non-overlapping crops of the given tiles or random.
+    if not args.images:
+        return torch.rand(args.max_patches, config.PATCH_SIZE, config.PATCH_SIZE, 3) * 255.0
+    patches = []
+    for path in args.images.split(','):
+        rgb = read_rgb_img(path)
+        for y in range(0, rgb.shape[0] - config.PATCH_SIZE + 1, config.PATCH_SIZE):
+            for x in range(0, rgb.shape[1] - config.PATCH_SIZE + 1, config.PATCH_SIZE):
+                patches.append(torch.tensor(rgb[y:y + config.PATCH_SIZE, x:x + config.PATCH_SIZE], dtype=torch.float32))
+    return torch.stack(patches[:args.max_patches], dim=0)
+
+
+def load_eval_net(config, args, device):
+    # Own copy of the config, benchmarks change inference options on net.config.
+    config = copy.deepcopy(config)
+    if args.checkpoint:
+        checkpoint = torch.load(args.checkpoint, map_location="cpu", mmap=True)
+        net = build_inference_model(config, checkpoint['state_dict'])
+    else:
+        net = SAMRoad(config, load_sam_ckpt=False)
+    return net.eval().to(device)
+
+
+def mask_iou(masks, ref_masks):
+    # per channel over all patches, keypoint and road
+    return (masks & ref_masks).sum(dim=(0, 1, 2)) / (masks | ref_masks).sum(dim=(0, 1, 2)).clamp(min=1)
+
+
+def benchmark_token_prune(config, args, device):
+    net = load_eval_net(config, args, device)
+    batches = image_patches(config, args).to(device).split(args.batch_size)
+
+    def infer_all():
+        return torch.cat([net.infer_masks(rgb) for rgb in batches], dim=0)
+
+    patch_num = sum(rgb.shape[0] for rgb in batches)
+    net.config.TOKEN_PRUNE_KEEP_RATIO = None
+    with torch.no_grad():
+        dense_masks = infer_all() > args.threshold
+    dense_seconds = time_fn(infer_all, device, args.repeats)
+    print(f'dense: {patch_num / dense_seconds:.3f} patches/s')
+    for keep_ratio in [float(r) for r in args.keep_ratios.split(',')]:
+        net.config.TOKEN_PRUNE_KEEP_RATIO = keep_ratio
+        with torch.no_grad():
+            masks = infer_all() > args.threshold
+        seconds = time_fn(infer_all, device, args.repeats)
+        iou = mask_iou(masks, dense_masks)
+        print(
+            f'keep ratio {keep_ratio:.2f} after block {config.TOKEN_PRUNE_AFTER_BLOCK}: '
+            f'{patch_num / seconds:.3f} patches/s, speedup {dense_seconds / seconds:.2f}x, '
+            f'IoU with dense masks keypoint {iou[0].item():.4f} road {iou[1].item():.4f}'
+        )
+
+
+def benchmark_mask_downsample(config, args, device):
+    # Per patch, the inferencer fuses the low resolution masks first and upsamples the tile once.
+    net = load_eval_net(config, args, device)
+    batches = image_patches(config, args).to(device).split(args.batch_size)
+    patch_num = sum(rgb.shape[0] for rgb in batches)
+    with torch.no_grad():
+        embeddings = [net.encode(rgb) for rgb in batches]
+
+    def decode_all():
+        # through the model's inference path, decoder timing is separate below
+        return torch.cat([net.infer_masks_and_img_features(rgb)[0] for rgb in batches], dim=0)
+
+    for downsample in [1, 2, 4]:
+        net.config.INFER_MASK_DOWNSAMPLE = downsample
+        decoder = net.map_decoder
+        if downsample > 1:
+            decode_fn = lambda: [_low_res_map_decoder_forward(decoder, e, downsample) for e in embeddings]
+        else:
+            decode_fn = lambda: [decoder(e) for e in embeddings]
+        seconds = time_fn(decode_fn, device, args.repeats)
+        with torch.no_grad():
+            # [N, 2, H, W] after one upsample
+            masks = decode_all().permute(0, 3, 1, 2)
+            masks = F.interpolate(masks, scale_factor=downsample, mode='bilinear', align_corners=False)
+        masks = masks.permute(0, 2, 3, 1) > args.threshold
+        if downsample == 1:
+            full_masks = masks
+        iou = mask_iou(masks, full_masks)
+        print(
+            f'mask downsample {downsample}: decoder {patch_num / seconds:.3f} patches/s, '
+            f'{masks.shape[1] * masks.shape[2] // downsample ** 2 * 8} bytes of fp32 masks per patch, '
+            f'IoU with full resolution keypoint {iou[0].item():.4f} road {iou[1].item():.4f}'
+        )
+
+
+def legacy_graph_collate(batch):
+    # Previous collate: per-item padding with torch.concat, then torch.stack.
+    collated = {}
+    for key in batch[0].keys():
+        if key == 'graph_points':
+            tensors = [item[key] for item in batch]
+            max_point_num = max([x.shape[0] for x in tensors])
+            padded = [torch.concat([x, torch.zeros(max_point_num - x.shape[0], 2)], dim=0) for x in tensors]
+            collated[key] = torch.stack(padded, dim=0)
+        else:
+            collated[key] = torch.stack([item[key] for item in batch], dim=0)
+    return collated
+
+
+def random_training_samples(config, batch_size, max_point_num):
+    # Training samples in the SatMapDataset layout.
+    samples = []
+    for _ in range(batch_size):
+        point_num = np.random.randint(max_point_num // 2, max_point_num + 1)
+        samples.append({
+            'rgb': np.random.randint(0, 256, size=(config.PATCH_SIZE, config.PATCH_SIZE, 3), dtype=np.uint8),
+            'keypoint_mask': np.random.randint(0, 2, size=(config.PATCH_SIZE, config.PATCH_SIZE), dtype=np.uint8) * 255,
+            'road_mask': np.random.randint(0, 2, size=(config.PATCH_SIZE, config.PATCH_SIZE), dtype=np.uint8) * 255,
+            'rot_index': np.array(np.random.randint(0, 4), dtype=np.int64),
+            'graph_points': np.random.uniform(0, config.PATCH_SIZE, size=(point_num, 2)).astype(np.float32),
+            'pairs': np.random.randint(
+                0, point_num, size=(config.TOPO_SAMPLE_NUM, config.MAX_NEIGHBOR_QUERIES, 2)).astype(np.int32),
+            'connected': np.random.rand(config.TOPO_SAMPLE_NUM, config.MAX_NEIGHBOR_QUERIES) < 0.3,
+            'valid': np.random.rand(config.TOPO_SAMPLE_NUM, config.MAX_NEIGHBOR_QUERIES) < 0.7,
+        })
+    return samples
+
+
+def benchmark_collate(config, args, device):
+    # CPU only, the device is used for pinning.
+    batch_size = args.batch_size or config.BATCH_SIZE
+    if args.from_dataset:
+        ds = SatMapDataset(config, is_train=True)
+        batch = [ds[i] for i in range(batch_size)]
+    else:
+        batch = random_training_samples(config, batch_size, args.points_per_patch)
+    torch_batch = [{k: torch.from_numpy(v) for k, v in item.items()} for item in batch]
+    cpu = torch.device('cpu')
+    collator = GraphCollator(buffer_num=2)
+    settings = [
+        ('per-item torch', lambda: legacy_graph_collate(torch_batch)),
+        ('numpy', lambda: graph_collate_fn(batch)),
+        ('numpy, reused buffers', lambda: collator(batch)),
+    ]
+    if device.type == 'cuda':
+        pinned_collator = GraphCollator(buffer_num=2, pin_memory=True)
+        settings += [
+            ('per-item torch + pin', lambda: {k: v.pin_memory() for k, v in legacy_graph_collate(torch_batch).items()}),
+            ('numpy, reused pinned buffers', lambda: pinned_collator(batch)),
+        ]
+    for name, collate_fn in settings:
+        seconds = time_fn(collate_fn, cpu, args.repeats)
+        print(f'collate {name}: {seconds * 1000:.2f} ms per batch of {batch_size}')
+    batch_mb = sum(v.nbytes for v in graph_collate_fn(batch).values()) / 2**20
+    print(f'{batch_mb:.1f} MB per batch to copy to the device')
+
+
+def benchmark_patch_sampler(config, args, device):
+    # CPU only, labels are sampled like SatMapDataset does for the drawn crops.
+    config = copy.deepcopy(config)
+    config.ROAD_AWARE_SAMPLING = True
+    # crops are sampled online, with the label generators
+    config.TOPO_LABEL_SHARD_DIR = None
+    ds = SatMapDataset(config, is_train=True)
+    for name, sample_crop in [('uniform', ds.sample_uniform_train_crop), ('road-aware', ds.sample_train_crop)]:
+        np.random.seed(args.seed)
+        empty_num, valid_pair_num = 0, 0
+        start_seconds = time.time()
+        for _ in range(args.samples):
+            img_idx, begin_x, begin_y, rot_index = sample_crop()
+            patch = ((begin_x, begin_y), (begin_x + config.PATCH_SIZE, begin_y + config.PATCH_SIZE))
+            _, _, _, valid = ds.graph_label_generators[img_idx].sample_patch(patch, rot_index)
+            empty_num += int(not valid.any())
+            valid_pair_num += int(valid.sum())
+        seconds = time.time() - start_seconds
+        print(
+            f'{name}: {empty_num / args.samples:.1%} crops without valid pairs, '
+            f'{valid_pair_num / args.samples:.1f} valid pairs per crop, {seconds / args.samples * 1000:.2f} ms per crop')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = load_config(args.config)
+    device = torch.device("cuda") if args.device == "cuda" else torch.device("cpu")
+    print(f'##### Benchmark {args.benchmark} on {device} #####')
+    if args.benchmark == 'toponet':
+        benchmark_toponet(config, args, device)
+    elif args.benchmark == 'infer_toponet':
+        benchmark_infer_toponet(config, args, device)
+    elif args.benchmark == 'encoder':
+        benchmark_encoder(config, args, device)
+    elif args.benchmark == 'encoder_max_batch':
+        benchmark_encoder_max_batch(config, args, device)
+    elif args.benchmark == 'cached_train':
+        benchmark_cached_train(config, args, device)
+    elif args.benchmark == 'token_prune':
+        benchmark_token_prune(config, args, device)
+    elif args.benchmark == 'mask_downsample':
+        benchmark_mask_downsample(config, args, device)
+    elif args.benchmark == 'collate':
+        benchmark_collate(config, args, device)
+    elif args.benchmark == 'patch_sampler':
+        benchmark_patch_sampler(config, args, device)
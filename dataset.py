@@ -1,6 +1,6 @@
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import cv2
 import math
 import graph_utils
@@ -10,6 +10,9 @@ import pickle
 import os
 import addict
 import json
+import hashlib
+import concurrent.futures
+import igraph
 
 
 
@@ -73,8 +76,111 @@ def get_patch_info_one_img(image_index, image_size, sample_margin, patch_size, p
             )
     return patch_info
 
+def get_embedding_cache_grid(tile_num, sample_min, sample_max, offsets_per_edge):
+    # Fixed (tile, offset, rotation) training patches of the embedding cache.
+    # [N, 4] int32 array of (tile position, begin_x, begin_y, rot_index)
+    offsets = sorted(set(round(x) for x in np.linspace(start=sample_min, stop=sample_max, num=offsets_per_edge)))
+    grid = [
+        (tile_pos, x, y, rot_index)
+        for tile_pos in range(tile_num) for x in offsets for y in offsets for rot_index in range(4)
+    ]
+    return np.array(grid, dtype=np.int32)
+
+
+def embedding_cache_meta(config, tile_indices):
+    # Describes what the cached embeddings were computed from, checked when training from the cache.
+    return {
+        'SAM_VERSION': config.SAM_VERSION,
+        'SAM_CKPT_PATH': config.SAM_CKPT_PATH,
+        'NO_SAM': bool(config.NO_SAM),
+        # encoder architecture, defaults normalized
+        'ENCODER_WINDOW_SIZE': config.ENCODER_WINDOW_SIZE or 14,
+        'ENCODER_BLOCK_HEADS': list(config.ENCODER_BLOCK_HEADS or []),
+        'ENCODER_BLOCK_MLP_DIMS': list(config.ENCODER_BLOCK_MLP_DIMS or []),
+        'PATCH_SIZE': config.PATCH_SIZE,
+        'DATASET': config.DATASET,
+        'EMBEDDING_CACHE_OFFSETS_PER_EDGE': config.EMBEDDING_CACHE_OFFSETS_PER_EDGE,
+        'tile_indices': list(tile_indices),
+    }
+
+
+def topo_label_shard_meta(config, tile_indices):
+    # Describes what the topology label shards were sampled from, checked when training from them:
+    # the GraphLabelGenerator config and how SatMapDataset.sample_train_crop picks crops.
+    road_aware = bool(config.ROAD_AWARE_SAMPLING)
+    return {
+        'DATASET': config.DATASET,
+        'PATCH_SIZE': config.PATCH_SIZE,
+        'TOPO_SAMPLE_NUM': config.TOPO_SAMPLE_NUM,
+        'MAX_NEIGHBOR_QUERIES': config.MAX_NEIGHBOR_QUERIES,
+        'NEIGHBOR_RADIUS': config.NEIGHBOR_RADIUS,
+        'ROAD_NMS_RADIUS': config.ROAD_NMS_RADIUS,
+        'LABEL_VERSION': GraphLabelGenerator.CACHE_VERSION,
+        # crop sampling, defaults normalized as in build_crop_index, unused with uniform crops
+        'ROAD_AWARE_SAMPLING': road_aware,
+        'PATCH_SAMPLE_STRIDE': (config.PATCH_SAMPLE_STRIDE or 16) if road_aware else None,
+        'PATCH_SAMPLE_MIN_ROAD_RATIO': (config.PATCH_SAMPLE_MIN_ROAD_RATIO or 0.0) if road_aware else None,
+        'PATCH_SAMPLE_KEYPOINT_WEIGHT': (config.PATCH_SAMPLE_KEYPOINT_WEIGHT or 0.0) if road_aware else None,
+        'tile_indices': list(tile_indices),
+    }
+
+
+class PresampledEpochSampler(Sampler):
+    # Epoch e takes the next epoch_length indices of a seeded permutation of the presampled
+    # training samples, so epochs do not repeat samples until the shards run out.
+    # Lightning calls set_epoch at the start of every training epoch. Under DDP each rank takes
+    # every world_size-th index of the epoch, so the trainer must not wrap it in a distributed
+    # sampler (use_distributed_sampler=False), which would keep set_epoch from reaching it.
+    def __init__(self, sample_num, epoch_length, seed=0):
+        self.sample_num = sample_num
+        self.epoch_length = epoch_length
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @staticmethod
+    def rank_and_world_size():
+        # read when iterating, the sampler is built before Lightning sets up the process group
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    def __iter__(self):
+        rank, world_size = self.rank_and_world_size()
+        # every rank gets the same number of indices
+        rank_length = math.ceil(self.epoch_length / world_size)
+        order = np.random.default_rng(self.seed).permutation(self.sample_num)
+        start = self.epoch * rank_length * world_size
+        indices = np.take(order, np.arange(start, start + rank_length * world_size), mode='wrap')
+        return iter(indices[rank::world_size].tolist())
+
+    def __len__(self):
+        return math.ceil(self.epoch_length / self.rank_and_world_size()[1])
+
+
+def crop_sums(image, begins_y, begins_x, crop_size):
+    # Sums of image over the crops [y, y + crop_size) x [x, x + crop_size) for all y in begins_y,
+    # x in begins_x, from the integral image. Returns [len(begins_y), len(begins_x)].
+    integral = np.zeros((image.shape[0] + 1, image.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(image, axis=0, dtype=np.int64), axis=1, out=integral[1:, 1:])
+    y0, x0 = begins_y[:, np.newaxis], begins_x[np.newaxis, :]
+    y1, x1 = y0 + crop_size, x0 + crop_size
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+
+def build_point_rtree(points):
+    # rtree of [N, 2] points as degenerate boxes, bulk loaded.
+    if len(points) == 0:
+        return rtree.index.Index()
+    return rtree.index.Index(((i, (x, y, x, y), None) for i, (x, y) in enumerate(points)))
+
 
 class GraphLabelGenerator():
+    # Bump when the label products (see label_products) would come out differently.
+    CACHE_VERSION = 1
+
     def __init__(self, config, full_graph, coord_transform):
         self.config = config
         # full_graph: sat2graph format
@@ -93,11 +199,10 @@ class GraphLabelGenerator():
         self.subdivide_points = np.array(self.full_graph_subdivide.vs['point'])
         # pre-build spatial index
         # rtree for box queries
-        self.graph_rtee = rtree.index.Index()
-        for i, v in enumerate(self.subdivide_points):
-            x, y = v
-            # hack to insert single points
-            self.graph_rtee.insert(i, (x, y, x, y))
+        self.graph_rtee = build_point_rtree(self.subdivide_points)
+        # CSR adjacency for the batched BFS in sample_patch
+        self.subdivide_indptr, self.subdivide_indices = graph_utils.csr_adjacency(
+            len(self.subdivide_points), self.full_graph_subdivide.get_edgelist())
         # kdtree for spherical query
         self.graph_kdtree = scipy.spatial.KDTree(self.subdivide_points)
 
@@ -132,6 +237,35 @@ class GraphLabelGenerator():
             interesting_indices.update(nearby_indices)
         self.sample_weights = np.full((point_num, ), 0.1, dtype=np.float32)
         self.sample_weights[list(interesting_indices)] = 0.9
+
+    def label_products(self):
+        # Everything sample_patch needs from the GT graph, as arrays.
+        return {
+            'subdivide_points': self.subdivide_points,
+            'subdivide_edges': np.array(self.full_graph_subdivide.get_edgelist(), dtype=np.int64).reshape(-1, 2),
+            'subdivide_resolution': np.array(self.subdivide_resolution),
+            'exclude_indices': np.array(sorted(self.exclude_indices), dtype=np.int64),
+            'nms_score_override': self.nms_score_override,
+            'sample_weights': self.sample_weights,
+        }
+
+    @classmethod
+    def from_label_products(cls, config, products):
+        # Rebuilds the generator from label_products() without redoing the graph processing.
+        generator = cls.__new__(cls)
+        generator.config = config
+        generator.subdivide_resolution = int(products['subdivide_resolution'])
+        generator.subdivide_points = products['subdivide_points']
+        generator.full_graph_subdivide = igraph.Graph(
+            len(generator.subdivide_points), products['subdivide_edges'].tolist())
+        generator.full_graph_subdivide.vs['point'] = generator.subdivide_points
+        generator.graph_rtee = build_point_rtree(generator.subdivide_points)
+        generator.subdivide_indptr, generator.subdivide_indices = graph_utils.csr_adjacency(
+            len(generator.subdivide_points), products['subdivide_edges'])
+        generator.exclude_indices = set(products['exclude_indices'].tolist())
+        generator.nms_score_override = products['nms_score_override']
+        generator.sample_weights = products['sample_weights']
+        return generator
     
     def sample_patch(self, patch, rot_index = 0):
         (x0, y0), (x1, y1) = patch
@@ -147,8 +281,9 @@ class GraphLabelGenerator():
             sample_num = self.config.TOPO_SAMPLE_NUM
             max_nbr_queries = self.config.MAX_NEIGHBOR_QUERIES
             fake_points = np.array([[0.0, 0.0]], dtype=np.float32)
-            fake_sample = ([[0, 0]] * max_nbr_queries, [False] * max_nbr_queries, [False] * max_nbr_queries)
-            return fake_points, [fake_sample] * sample_num
+            fake_pairs = np.zeros((sample_num, max_nbr_queries, 2), dtype=np.int32)
+            fake_flags = np.zeros((sample_num, max_nbr_queries), dtype=bool)
+            return fake_points, fake_pairs, fake_flags, fake_flags.copy()
 
         patch_points = self.subdivide_points[patch_indices, :]
         
@@ -173,45 +308,37 @@ class GraphLabelGenerator():
         sample_indices_in_nmsed = np.random.choice(
             np.arange(start=0, stop=nmsed_points.shape[0], dtype=np.int32),
             size=sample_num, replace=True, p=sample_weights / np.sum(sample_weights))
-        # indices into the subdivided graph
-        sample_indices = nmsed_indices[sample_indices_in_nmsed]
+        # samples repeat, labels are computed once per distinct source
+        source_indices_in_nmsed, sample_to_source = np.unique(sample_indices_in_nmsed, return_inverse=True)
         
         radius = self.config.NEIGHBOR_RADIUS
         max_nbr_queries = self.config.MAX_NEIGHBOR_QUERIES  # has to be greater than 1
         nmsed_kdtree = scipy.spatial.KDTree(nmsed_points)
-        sampled_points = self.subdivide_points[sample_indices, :]
-        # [n_sample, n_nbr]
+        # [n_source, n_nbr + 1]
         # k+1 because the nearest one is always self
-        knn_d, knn_idx = nmsed_kdtree.query(sampled_points, k=max_nbr_queries + 1, distance_upper_bound=radius)
-
-
-        samples = []
-
-        for i in range(sample_num):
-            source_node = sample_indices[i]
-            valid_nbr_indices = knn_idx[i, knn_idx[i, :] < nmsed_point_num]
-            valid_nbr_indices = valid_nbr_indices[1:] # the nearest one is self so remove
-            target_nodes = [nmsed_indices[ni] for ni in valid_nbr_indices]  
-
-            ### BFS to find immediate neighbors on graph
-            reached_nodes = graph_utils.bfs_with_conditions(self.full_graph_subdivide, source_node, set(target_nodes), radius // self.subdivide_resolution)
-            shall_connect = [t in reached_nodes for t in target_nodes]
-            ###
-
-            pairs = []
-            valid = []
-            source_nmsed_idx = sample_indices_in_nmsed[i]
-            for target_nmsed_idx in valid_nbr_indices:
-                pairs.append((source_nmsed_idx, target_nmsed_idx))
-                valid.append(True)
-
-            # zero-pad
-            for i in range(len(pairs), max_nbr_queries):
-                pairs.append((source_nmsed_idx, source_nmsed_idx))
-                shall_connect.append(False)
-                valid.append(False)
-
-            samples.append((pairs, shall_connect, valid))
+        knn_d, knn_idx = nmsed_kdtree.query(
+            nmsed_points[source_indices_in_nmsed], k=max_nbr_queries + 1, distance_upper_bound=radius)
+        # the nearest one is self so remove, missing neighbors (index nmsed_point_num) come last
+        nbr_indices_in_nmsed = knn_idx[:, 1:]
+        nbr_valid = nbr_indices_in_nmsed < nmsed_point_num
+        # zero-pad with self pairs
+        nbr_indices_in_nmsed = np.where(nbr_valid, nbr_indices_in_nmsed, source_indices_in_nmsed[:, np.newaxis])
+
+        ### BFS to find immediate neighbors on graph
+        source_connected = graph_utils.batched_bfs_with_conditions(
+            self.subdivide_indptr, self.subdivide_indices,
+            nmsed_indices[source_indices_in_nmsed],
+            np.where(nbr_valid, nmsed_indices[nbr_indices_in_nmsed], -1),
+            radius // self.subdivide_resolution)
+        ###
+
+        # [n_sample, n_nbr, 2]
+        pairs = np.empty((sample_num, max_nbr_queries, 2), dtype=np.int32)
+        pairs[:, :, 0] = sample_indices_in_nmsed[:, np.newaxis]
+        pairs[:, :, 1] = nbr_indices_in_nmsed[sample_to_source]
+        # [n_sample, n_nbr]
+        connected = source_connected[sample_to_source]
+        valid = nbr_valid[sample_to_source]
 
         # Transform points
         # [N, 2]
@@ -237,9 +364,105 @@ class GraphLabelGenerator():
         noise_scale = 1.0  # pixels
         nmsed_points += np.random.normal(0.0, noise_scale, size=nmsed_points.shape)
 
-        return nmsed_points, samples
+        return nmsed_points, pairs, connected, valid
     
 
+def load_graph_label_generator(config, gt_graph_adj, coord_transform, gt_graph_path):
+    # GraphLabelGenerator of one tile. With GRAPH_LABEL_CACHE_DIR, its label products are cached
+    # under the hash of the GT file and the label config, and loaded instead of rebuilt.
+    if not config.GRAPH_LABEL_CACHE_DIR:
+        return GraphLabelGenerator(config, gt_graph_adj, coord_transform)
+    hasher = hashlib.sha256()
+    with open(gt_graph_path, 'rb') as f:
+        hasher.update(f.read())
+    label_config = {'CACHE_VERSION': GraphLabelGenerator.CACHE_VERSION, 'DATASET': config.DATASET}
+    hasher.update(json.dumps(label_config, sort_keys=True).encode())
+    cache_path = os.path.join(config.GRAPH_LABEL_CACHE_DIR, f'{hasher.hexdigest()}.npz')
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as products:
+            return GraphLabelGenerator.from_label_products(config, dict(products))
+
+    generator = GraphLabelGenerator(config, gt_graph_adj, coord_transform)
+    os.makedirs(config.GRAPH_LABEL_CACHE_DIR, exist_ok=True)
+    # other processes may build the same tile, the cache file appears complete or not at all
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, **generator.label_products())
+    os.replace(tmp_path, cache_path)
+    return generator
+
+
+def cityscale_coord_transform(v):
+    # (r, c) -> (x, y), takes [N, 2] points
+    return v[:, ::-1]
+
+
+def spacenet_coord_transform(v):
+    # ??? -> (x, y), takes [N, 2] points
+    return np.stack([v[:, 1], 400 - v[:, 0]], axis=1)
+
+
+def load_tile(config, tile_idx, patterns, coord_transform, load_images, build_labels=True):
+    # Images and GraphLabelGenerator (None unless build_labels) of one tile, None for empty tiles.
+    rgb_pattern, keypoint_mask_pattern, road_mask_pattern, gt_graph_pattern = patterns
+    gt_graph_path = gt_graph_pattern.format(tile_idx)
+    if config.DATASET == 'os':
+        with open(gt_graph_path, 'r') as jf:
+            gt_graph_adj = json.load(jf)
+    else:
+        # graph label gen
+        # gt graph: dict for adj list, for cityscale set keys are (r, c) nodes, values are list of (r, c) nodes
+        # I don't know what coord system spacenet uses but we convert them all to (x, y)
+        with open(gt_graph_path, 'rb') as f:
+            gt_graph_adj = pickle.load(f)
+        if len(gt_graph_adj) == 0:
+            return None
+
+    rgb, keypoint_mask, road_mask = None, None, None
+    if load_images:
+        rgb = read_rgb_img(rgb_pattern.format(tile_idx))
+        keypoint_mask = cv2.imread(keypoint_mask_pattern.format(tile_idx), cv2.IMREAD_GRAYSCALE)
+        road_mask = cv2.imread(road_mask_pattern.format(tile_idx), cv2.IMREAD_GRAYSCALE)
+    graph_label_generator = None
+    if build_labels:
+        graph_label_generator = load_graph_label_generator(config, gt_graph_adj, coord_transform, gt_graph_path)
+    return rgb, keypoint_mask, road_mask, graph_label_generator
+
+
+def _load_tile_in_worker(args):
+    # load_tile for a process pool, the generator goes back as label products
+    # since the rtree index does not pickle.
+    tile = load_tile(*args)
+    if tile is None:
+        return None
+    rgb, keypoint_mask, road_mask, graph_label_generator = tile
+    if graph_label_generator is None:
+        return tile
+    return rgb, keypoint_mask, road_mask, graph_label_generator.label_products()
+
+
+def load_tiles(config, tile_indices, patterns, coord_transform, load_images, build_labels=True):
+    # load_tile over tile_indices, in order. With DATASET_INIT_WORKERS > 0 tiles are decoded and
+    # their label generators built in a process pool.
+    tile_args = [(config, tile_idx, patterns, coord_transform, load_images, build_labels) for tile_idx in tile_indices]
+    worker_num = min(config.DATASET_INIT_WORKERS or 0, len(tile_args))
+    if worker_num == 0:
+        tiles = map(lambda args: load_tile(*args), tile_args)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=worker_num)
+        tiles = (
+            tile if tile is None or tile[3] is None else (*tile[:3], GraphLabelGenerator.from_label_products(config, tile[3]))
+            for tile in executor.map(_load_tile_in_worker, tile_args)
+        )
+    try:
+        for i, tile in enumerate(tiles):
+            if (i + 1) % 20 == 0 or i + 1 == len(tile_args):
+                print(f'loaded {i + 1} / {len(tile_args)} tiles')
+            yield tile
+    finally:
+        if worker_num > 0:
+            executor.shutdown()
+
+
 def test_graph_label_generator():
     if not os.path.exists('debug'):
         os.mkdir('debug')
@@ -270,10 +493,10 @@ def test_graph_label_generator():
     test_num = 64
     for i in range(test_num):
         rot_index = np.random.randint(0, 4)
-        points, samples = gen.sample_patch(patch, rot_index=rot_index)
+        points, all_pairs, all_connected, all_valid = gen.sample_patch(patch, rot_index=rot_index)
         rgb_patch = rgb[y0:y1, x0:x1, ::-1].copy()
         rgb_patch = np.rot90(rgb_patch, rot_index, (0, 1)).copy()
-        for pairs, shall_connect, valid in samples:
+        for pairs, shall_connect, valid in zip(all_pairs, all_connected, all_valid):
             color = tuple(int(c) for c in np.random.randint(0, 256, size=3))
 
             for (src, tgt), connected, is_valid in zip(pairs, shall_connect, valid):
@@ -293,118 +516,178 @@ def test_graph_label_generator():
         cv2.imwrite(f'debug/viz_{i}.png', rgb_patch)
 
         
-def graph_collate_fn(batch):
-    keys = batch[0].keys()
+def _batch_buffer(buffers, key, shape, dtype, pin_memory):
+    # Contiguous tensor of shape, a view into the reusable flat buffer of key when buffers is given.
+    numel = math.prod(shape)
+    dtype = torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+    if buffers is None:
+        return torch.empty(shape, dtype=dtype)
+    buffer = buffers.get(key)
+    if buffer is None or buffer.dtype != dtype or buffer.numel() < numel:
+        buffer = torch.empty(numel, dtype=dtype, pin_memory=pin_memory)
+        buffers[key] = buffer
+    return buffer[:numel].view(shape)
+
+
+def graph_collate_fn(batch, buffers=None, pin_memory=False):
+    # Samples are numpy arrays of a fixed layout per key, except graph_points [N_i, 2], which is
+    # zero-padded to the largest N_i. Each key is written once into a [B, ...] tensor, viewed from
+    # buffers (key -> flat tensor, grown as needed) if given.
     collated = {}
-    for key in keys:
+    for key in batch[0].keys():
+        arrays = [item[key] for item in batch]
+        if key == 'graph_points':
+            point_nums = np.array([x.shape[0] for x in arrays])
+            shape = (len(batch), point_nums.max(), 2)
+        else:
+            shape = (len(batch), ) + arrays[0].shape
+        collated[key] = _batch_buffer(buffers, key, shape, arrays[0].dtype, pin_memory)
+        out = collated[key].numpy()
         if key == 'graph_points':
-            tensors = [item[key] for item in batch]
-            max_point_num = max([x.shape[0] for x in tensors])
-            padded = []
-            for x in tensors:
-                pad_num = max_point_num - x.shape[0]
-                padded_x = torch.concat([x, torch.zeros(pad_num, 2)], dim=0)
-                padded.append(padded_x)
-            collated[key] = torch.stack(padded, dim=0)
+            out[...] = 0
+            # all samples at once, into the leading N_i rows of each
+            out[np.arange(shape[1])[np.newaxis, :] < point_nums[:, np.newaxis]] = np.concatenate(arrays, axis=0)
         else:
-            collated[key] = torch.stack([item[key] for item in batch], dim=0)
+            np.stack(arrays, axis=0, out=out)
     return collated
 
 
-
-class SatMapDataset(Dataset):
-    def __init__(self, config, is_train, dev_run=False):
-        self.config = config
+class GraphCollator():
+    # graph_collate_fn into buffer_num sets of (pinned) batch buffers, reused round robin.
+    # A batch is overwritten buffer_num batches later, so this is only for collating in the
+    # training process (DATA_WORKER_NUM 0), where at most the current and the prefetched batch
+    # are in use. Batches from DataLoader workers are shared with the main process, use
+    # graph_collate_fn there.
+    def __init__(self, buffer_num, pin_memory=False):
+        assert buffer_num > 0
+        self.buffer_sets = [{} for _ in range(buffer_num)]
+        self.pin_memory = pin_memory
+        self.next_set = 0
+
+    def __call__(self, batch):
+        buffers = self.buffer_sets[self.next_set]
+        self.next_set = (self.next_set + 1) % len(self.buffer_sets)
+        return graph_collate_fn(batch, buffers, self.pin_memory)
+
+
+def get_collate_fn(config):
+    # Reused pinned buffers when batches are collated in the training process.
+    if config.DATA_WORKER_NUM == 0 and config.COLLATE_BUFFER_NUM:
+        return GraphCollator(config.COLLATE_BUFFER_NUM, pin_memory=torch.cuda.is_available())
+    return graph_collate_fn
+
+
+
+def dataset_split(config, is_train):
+    # Tiles of the train (train + val) or test split of DATASET:
+    # (image_size, sample_margin, tile_indices, patterns, coord_transform), where patterns are the
+    # (rgb, keypoint_mask, road_mask, gt_graph) paths of a tile index.
+    assert config.DATASET in {'cityscale', 'spacenet','os'}
+    if config.DATASET == 'cityscale':
+        image_size = 2048
+        # TODO: SAMPLE_MARGIN here is for training, the one in config is for inference
+        sample_margin = 64
+
+        rgb_pattern = './cityscale/20cities/region_{}_sat.png'
+        keypoint_mask_pattern = './cityscale/processed/keypoint_mask_{}.png'
+        road_mask_pattern = './cityscale/processed/road_mask_{}.png'
+        gt_graph_pattern = './cityscale/20cities/region_{}_refine_gt_graph.p'
         
-        assert self.config.DATASET in {'cityscale', 'spacenet','os'}
-        if self.config.DATASET == 'cityscale':
-            self.IMAGE_SIZE = 2048
-            # TODO: SAMPLE_MARGIN here is for training, the one in config is for inference
-            self.SAMPLE_MARGIN = 64
-
-            rgb_pattern = './cityscale/20cities/region_{}_sat.png'
-            keypoint_mask_pattern = './cityscale/processed/keypoint_mask_{}.png'
-            road_mask_pattern = './cityscale/processed/road_mask_{}.png'
-            gt_graph_pattern = './cityscale/20cities/region_{}_refine_gt_graph.p'
-            
-            train, val, test = cityscale_data_partition()
+        train, val, test = cityscale_data_partition()
 
-            # coord-transform = (r, c) -> (x, y)
-            # takes [N, 2] points
-            coord_transform = lambda v : v[:, ::-1]
+        # coord-transform = (r, c) -> (x, y)
+        # takes [N, 2] points
+        coord_transform = cityscale_coord_transform
 
-        elif self.config.DATASET == 'spacenet':
-            self.IMAGE_SIZE = 400
-            self.SAMPLE_MARGIN = 0
+    elif config.DATASET == 'spacenet':
+        image_size = 400
+        sample_margin = 0
 
-            rgb_pattern = './spacenet/RGB_1.0_meter/{}__rgb.png'
-            keypoint_mask_pattern = './spacenet/processed/keypoint_mask_{}.png'
-            road_mask_pattern = './spacenet/processed/road_mask_{}.png'
-            gt_graph_pattern = './spacenet/RGB_1.0_meter/{}__gt_graph.p'
-            
-            train, val, test = spacenet_data_partition()
+        rgb_pattern = './spacenet/RGB_1.0_meter/{}__rgb.png'
+        keypoint_mask_pattern = './spacenet/processed/keypoint_mask_{}.png'
+        road_mask_pattern = './spacenet/processed/road_mask_{}.png'
+        gt_graph_pattern = './spacenet/RGB_1.0_meter/{}__gt_graph.p'
+        
+        train, val, test = spacenet_data_partition()
 
-            # coord-transform ??? -> (x, y)
-            # takes [N, 2] points
-            coord_transform = lambda v : np.stack([v[:, 1], 400 - v[:, 0]], axis=1)
+        # coord-transform ??? -> (x, y)
+        # takes [N, 2] points
+        coord_transform = spacenet_coord_transform
+    
+    elif config.DATASET == 'os':
+        image_size = 256
+        sample_margin = 0
+
+        rgb_pattern = './os/data/{}.png'
+        keypoint_mask_pattern = './os/data/{}_keypoints.png'
+        road_mask_pattern = './os/data/{}_road_mask.png'
+        gt_graph_pattern = './os/data/{}_graph.json'
+        coord_transform = None
         
-        elif self.config.DATASET == 'os':
-            self.IMAGE_SIZE = 256
-            self.SAMPLE_MARGIN = 0
-
-            rgb_pattern = './os/data/{}.png'
-            keypoint_mask_pattern = './os/data/{}_keypoints.png'
-            road_mask_pattern = './os/data/{}_road_mask.png'
-            gt_graph_pattern = './os/data/{}_graph.json'
-            coord_transform = None
-            
-            train, val, test = os_data_partition()
-            
-        self.is_train = is_train
+        train, val, test = os_data_partition()
 
-        train_split = train + val
-        test_split = test
+    tile_indices = train + val if is_train else test
+    patterns = (rgb_pattern, keypoint_mask_pattern, road_mask_pattern, gt_graph_pattern)
+    return image_size, sample_margin, tile_indices, patterns, coord_transform
 
-        tile_indices = train_split if self.is_train else test_split
+
+class SatMapDataset(Dataset):
+    def __init__(self, config, is_train, dev_run=False):
+        self.config = config
+        
+        self.is_train = is_train
+        self.IMAGE_SIZE, self.SAMPLE_MARGIN, tile_indices, patterns, coord_transform = dataset_split(config, is_train)
         self.tile_indices = tile_indices
+
+        # Packed arrays from pack_dataset.py, mapped lazily in each process, see open_packed_arrays.
+        self.packed_dir = None
+        if self.config.PACKED_DATA_DIR:
+            self.packed_dir = os.path.join(self.config.PACKED_DATA_DIR, 'train' if self.is_train else 'test')
+            with open(os.path.join(self.packed_dir, 'index.json'), 'r') as jf:
+                packed_index = json.load(jf)
+            assert packed_index['DATASET'] == self.config.DATASET, f'{self.packed_dir} is packed from {packed_index["DATASET"]}'
+            # empty tiles are not packed
+            tile_indices = packed_index['tile_indices']
         
-        # Stores all imgs in memory.
+        # Stores all imgs in memory, unless packed.
         self.rgbs, self.keypoint_masks, self.road_masks = [], [], []
-        # For graph label generation.
-        self.graph_label_generators = []
+        # tile indices actually loaded, empty tiles are skipped
+        self.loaded_tile_indices = []
+        # For graph label generation. Not built when training from presampled topology labels.
+        build_labels = not (self.is_train and self.config.TOPO_LABEL_SHARD_DIR)
+        self.graph_label_generators = [] if build_labels else None
 
         ##### FAST DEBUG
         if dev_run:
             tile_indices = tile_indices[:4]
         ##### FAST DEBUG
 
-        for tile_idx in tile_indices:
-            # print(f'loading tile {tile_idx}')
-            rgb_path = rgb_pattern.format(tile_idx)
-            road_mask_path = road_mask_pattern.format(tile_idx)
-            keypoint_mask_path = keypoint_mask_pattern.format(tile_idx)
-            with open(gt_graph_pattern.format(tile_idx),'r') as jf:
-                gt_graph_adj = json.load(jf)
-
-            if self.config.DATASET != 'os':
-                # graph label gen
-                # gt graph: dict for adj list, for cityscale set keys are (r, c) nodes, values are list of (r, c) nodes
-                # I don't know what coord system spacenet uses but we convert them all to (x, y)
-                gt_graph_adj = pickle.load(open(gt_graph_pattern.format(tile_idx),'rb'))
-                if len(gt_graph_adj) == 0:
-                    print(f'===== skipped empty tile {tile_idx} =====')
-                    continue
-
-            self.rgbs.append(read_rgb_img(rgb_path))
-            self.road_masks.append(cv2.imread(road_mask_path, cv2.IMREAD_GRAYSCALE))
-            self.keypoint_masks.append(cv2.imread(keypoint_mask_path, cv2.IMREAD_GRAYSCALE))
-            graph_label_generator = GraphLabelGenerator(config, gt_graph_adj, coord_transform)
-            self.graph_label_generators.append(graph_label_generator)
+        tiles = load_tiles(
+            config, tile_indices, patterns, coord_transform, load_images=self.packed_dir is None, build_labels=build_labels)
+        for tile_idx, tile in zip(tile_indices, tiles):
+            if tile is None:
+                print(f'===== skipped empty tile {tile_idx} =====')
+                continue
+            rgb, keypoint_mask, road_mask, graph_label_generator = tile
+            self.loaded_tile_indices.append(tile_idx)
+            if self.packed_dir is None:
+                self.rgbs.append(rgb)
+                self.road_masks.append(road_mask)
+                self.keypoint_masks.append(keypoint_mask)
+            if build_labels:
+                self.graph_label_generators.append(graph_label_generator)
             
+        if self.packed_dir is not None:
+            self.rgbs, self.keypoint_masks, self.road_masks = None, None, None
         
         self.sample_min = self.SAMPLE_MARGIN
         self.sample_max = self.IMAGE_SIZE - (self.config.PATCH_SIZE + self.SAMPLE_MARGIN)
 
+        # Road-aware training crops, see build_crop_index.
+        self.crop_offsets = None
+        if self.is_train and self.config.ROAD_AWARE_SAMPLING and build_labels:
+            self.build_crop_index()
+
         if not self.is_train:
             eval_patches_per_edge = math.ceil((self.IMAGE_SIZE - 2 * self.SAMPLE_MARGIN) / self.config.PATCH_SIZE)
             self.eval_patches = []
@@ -413,24 +696,194 @@ class SatMapDataset(Dataset):
                     i, self.IMAGE_SIZE, self.SAMPLE_MARGIN, self.config.PATCH_SIZE, eval_patches_per_edge
                 )
 
+        # Training from precomputed encoder embeddings, see precompute_embeddings.py.
+        self.use_embedding_cache = self.is_train and bool(self.config.EMBEDDING_CACHE_DIR)
+        if self.use_embedding_cache:
+            with open(os.path.join(self.config.EMBEDDING_CACHE_DIR, 'meta.json'), 'r') as jf:
+                cache_meta = json.load(jf)
+            expected_meta = embedding_cache_meta(self.config, self.loaded_tile_indices)
+            # dev runs load a prefix of the tiles
+            cache_meta['tile_indices'] = cache_meta['tile_indices'][:len(self.loaded_tile_indices)]
+            if cache_meta != expected_meta:
+                raise ValueError(
+                    f'embedding cache {self.config.EMBEDDING_CACHE_DIR} does not match the config: '
+                    f'{cache_meta} vs {expected_meta}')
+            grid = np.load(os.path.join(self.config.EMBEDDING_CACHE_DIR, 'grid.npy'))
+            self.cache_grid_indices = np.nonzero(grid[:, 0] < len(self.loaded_tile_indices))[0]
+            self.cache_grid = grid
+            # opened lazily, so every DataLoader worker maps the file itself
+            self.cache_embeddings = None
+
+        # Training from presampled topology labels, see presample_topo_labels.py.
+        self.label_shard_dir = None
+        if self.is_train and self.config.TOPO_LABEL_SHARD_DIR:
+            assert not self.use_embedding_cache, 'the embedding cache has its own fixed patches'
+            self.label_shard_dir = self.config.TOPO_LABEL_SHARD_DIR
+            with open(os.path.join(self.label_shard_dir, 'index.json'), 'r') as jf:
+                shard_index = json.load(jf)
+            expected_meta = topo_label_shard_meta(self.config, self.loaded_tile_indices)
+            if shard_index['meta'] != expected_meta:
+                raise ValueError(
+                    f'topology label shards {self.label_shard_dir} do not match the config: '
+                    f'{shard_index["meta"]} vs {expected_meta}')
+            # sample idx of shard i is in [label_shard_starts[i], label_shard_starts[i + 1])
+            self.label_shard_starts = np.cumsum([0] + shard_index['shard_sizes'])
+            # opened lazily, see open_label_shards
+            self.label_shards = None
+
+    def open_packed_arrays(self):
+        # Maps the packed [N, H, W(, 3)] uint8 arrays on first use, so DataLoader workers
+        # each map the files and share the OS page cache instead of copies.
+        if self.packed_dir is None or self.rgbs is not None:
+            return
+        self.rgbs, self.keypoint_masks, self.road_masks = [
+            np.load(os.path.join(self.packed_dir, f'{name}.npy'), mmap_mode='r')
+            for name in ['rgb', 'keypoint_mask', 'road_mask']
+        ]
+
+    def open_label_shards(self):
+        # Maps the presampled label shards on first use, in every DataLoader worker.
+        if self.label_shard_dir is None or self.label_shards is not None:
+            return
+        self.label_shards = []
+        for shard_idx in range(len(self.label_shard_starts) - 1):
+            shard_dir = os.path.join(self.label_shard_dir, f'shard_{shard_idx:05d}')
+            self.label_shards.append({
+                name: np.load(os.path.join(shard_dir, f'{name}.npy'), mmap_mode='r')
+                for name in ['crops', 'point_offsets', 'points', 'sources', 'targets', 'connected', 'valid']
+            })
+
+    def presampled_sampler(self):
+        # Training order over the label shards, train_epoch_length samples per epoch.
+        return PresampledEpochSampler(len(self), self.train_epoch_length(), self.config.TOPO_LABEL_SHARD_SEED or 0)
+
+    def build_crop_index(self):
+        # Training crop offsets on a PATCH_SAMPLE_STRIDE grid of every tile, weighted by the road and
+        # keypoint density of the crop. Offsets whose crop has no graph points to sample labels from
+        # (the fake_points path of sample_patch) or less road than PATCH_SAMPLE_MIN_ROAD_RATIO are dropped.
+        # Crops are drawn anywhere in the stride cell of an offset, so a cell is scored on the core
+        # [begin + stride - 1, begin + patch_size) all of its crops contain.
+        stride = self.config.PATCH_SAMPLE_STRIDE or 16
+        patch_size = self.config.PATCH_SIZE
+        assert stride <= patch_size
+        begins = np.arange(self.sample_min, self.sample_max + 1, stride)
+        core_begins, core_size = begins + stride - 1, patch_size - stride + 1
+        if self.packed_dir is None:
+            keypoint_masks, road_masks = self.keypoint_masks, self.road_masks
+        else:
+            keypoint_masks, road_masks = [
+                np.load(os.path.join(self.packed_dir, f'{name}.npy'), mmap_mode='r') for name in ['keypoint_mask', 'road_mask']]
+
+        offsets, weights = [], []
+        empty_num, low_road_num = 0, 0
+        for img_idx, generator in enumerate(self.graph_label_generators):
+            # [len(begins), len(begins)] over (begin_y, begin_x)
+            road_density = crop_sums(road_masks[img_idx] >= 128, core_begins, core_begins, core_size) / core_size ** 2
+            keypoint_density = crop_sums(keypoint_masks[img_idx] >= 128, core_begins, core_begins, core_size) / core_size ** 2
+            # graph points sample_patch can pick from
+            is_sampled = np.ones(len(generator.subdivide_points), dtype=bool)
+            is_sampled[list(generator.exclude_indices)] = False
+            point_xy = np.clip(generator.subdivide_points[is_sampled].astype(np.int64), 0, self.IMAGE_SIZE - 1)
+            point_image = np.zeros((self.IMAGE_SIZE, self.IMAGE_SIZE), dtype=np.int32)
+            np.add.at(point_image, (point_xy[:, 1], point_xy[:, 0]), 1)
+            is_empty = crop_sums(point_image, core_begins, core_begins, core_size) == 0
+            is_low_road = ~is_empty & (road_density < (self.config.PATCH_SAMPLE_MIN_ROAD_RATIO or 0.0))
+            empty_num += int(is_empty.sum())
+            low_road_num += int(is_low_road.sum())
+
+            ys, xs = np.nonzero(~is_empty & ~is_low_road)
+            offsets.append(np.stack([np.full(len(ys), img_idx), begins[xs], begins[ys]], axis=1))
+            weights.append(road_density[ys, xs] + (self.config.PATCH_SAMPLE_KEYPOINT_WEIGHT or 0.0) * keypoint_density[ys, xs])
+
+        # [M, 3] int32 (img_idx, begin_x, begin_y)
+        self.crop_offsets = np.concatenate(offsets, axis=0).astype(np.int32)
+        assert len(self.crop_offsets) > 0, 'no training crop has road, lower PATCH_SAMPLE_MIN_ROAD_RATIO'
+        # crops with graph points but an empty road mask keep a small chance
+        self.crop_cum_weights = np.cumsum(np.maximum(np.concatenate(weights), 1e-3))
+        self.crop_stride = stride
+        total_num = len(self.graph_label_generators) * len(begins) ** 2
+        # fraction of uniformly sampled crop cells the index avoids
+        self.low_info_crop_fraction = (empty_num + low_road_num) / total_num
+        print(
+            f'road-aware sampling: {len(self.crop_offsets)} / {total_num} crop cells kept, of the uniformly sampled '
+            f'cells {empty_num / total_num:.1%} have no graph points and {low_road_num / total_num:.1%} too little road, '
+            f'{self.low_info_crop_fraction:.1%} low-information steps avoided')
+
+    def train_epoch_length(self):
+        if self.config.TRAIN_EPOCH_COVERAGE:
+            # each training pixel is in TRAIN_EPOCH_COVERAGE crops per epoch on average
+            tile_pixels = len(self.loaded_tile_indices) * self.IMAGE_SIZE ** 2
+            return max(1, round(self.config.TRAIN_EPOCH_COVERAGE * tile_pixels / self.config.PATCH_SIZE ** 2))
+        # Pixel seen in one epoch ~ 17 x total pixels in training set
+        if self.config.DATASET == 'cityscale':
+            return max(1, int(self.IMAGE_SIZE / self.config.PATCH_SIZE)) ** 2 * 2500
+        elif self.config.DATASET == 'spacenet':
+            return 84667
+        elif self.config.DATASET == 'os':
+            return len(self.loaded_tile_indices)
+
     def __len__(self):
+        if self.label_shard_dir is not None:
+            # all presampled samples, PresampledEpochSampler picks an epoch of them
+            return int(self.label_shard_starts[-1])
         if self.is_train:
-            # Pixel seen in one epoch ~ 17 x total pixels in training set
-            if self.config.DATASET == 'cityscale':
-                return max(1, int(self.IMAGE_SIZE / self.config.PATCH_SIZE)) ** 2 * 2500
-            elif self.config.DATASET == 'spacenet':
-                return 84667
-            elif self.config.DATASET == 'os':
-                return len(self.rgbs)
+            return self.train_epoch_length()
         else:
             return len(self.eval_patches)
 
+    def sample_train_crop(self):
+        # Random training crop, (img_idx, begin_x, begin_y, rot_index) with a CCW rotation.
+        if self.crop_offsets is None:
+            return self.sample_uniform_train_crop()
+        crop_idx = np.searchsorted(self.crop_cum_weights, np.random.uniform(0.0, self.crop_cum_weights[-1]), side='right')
+        img_idx, begin_x, begin_y = (int(v) for v in self.crop_offsets[min(crop_idx, len(self.crop_offsets) - 1)])
+        # anywhere in the stride cell of the offset
+        begin_x = min(begin_x + np.random.randint(0, self.crop_stride), self.sample_max)
+        begin_y = min(begin_y + np.random.randint(0, self.crop_stride), self.sample_max)
+        rot_index = np.random.randint(0, 4)
+        return img_idx, begin_x, begin_y, rot_index
+
+    def sample_uniform_train_crop(self):
+        img_idx = np.random.randint(low=0, high=len(self.loaded_tile_indices))
+        begin_x = np.random.randint(low=self.sample_min, high=self.sample_max+1)
+        begin_y = np.random.randint(low=self.sample_min, high=self.sample_max+1)
+        rot_index = np.random.randint(0, 4)
+        return img_idx, begin_x, begin_y, rot_index
+
+    def read_presampled_sample(self, idx):
+        # Crop and topology labels of presampled sample idx, as sample_train_crop and
+        # GraphLabelGenerator.sample_patch return them.
+        self.open_label_shards()
+        shard_idx = int(np.searchsorted(self.label_shard_starts, idx, side='right')) - 1
+        shard, i = self.label_shards[shard_idx], idx - int(self.label_shard_starts[shard_idx])
+        img_idx, begin_x, begin_y, rot_index = (int(v) for v in shard['crops'][i])
+        graph_points = np.array(shard['points'][shard['point_offsets'][i]:shard['point_offsets'][i + 1]])
+        # [n_sample, n_nbr]
+        targets = shard['targets'][i].astype(np.int32)
+        pairs = np.stack([np.broadcast_to(shard['sources'][i].astype(np.int32)[:, np.newaxis], targets.shape), targets], axis=-1)
+        connected, valid = (
+            np.unpackbits(shard[name][i], count=targets.size).astype(bool).reshape(targets.shape)
+            for name in ['connected', 'valid']
+        )
+        return (img_idx, begin_x, begin_y, rot_index), (graph_points, pairs, connected, valid)
+
     def __getitem__(self, idx):
+        self.open_packed_arrays()
         # Sample a patch.
-        if self.is_train:
-            img_idx = np.random.randint(low=0, high=len(self.rgbs))
-            begin_x = np.random.randint(low=self.sample_min, high=self.sample_max+1)
-            begin_y = np.random.randint(low=self.sample_min, high=self.sample_max+1)
+        rot_index = 0
+        cache_idx = None
+        topo_labels = None
+        if self.label_shard_dir is not None:
+            (img_idx, begin_x, begin_y, rot_index), topo_labels = self.read_presampled_sample(idx)
+            end_x, end_y = begin_x + self.config.PATCH_SIZE, begin_y + self.config.PATCH_SIZE
+        elif self.use_embedding_cache:
+            # Samples from the fixed grid of the embedding cache
+            cache_idx = np.random.choice(self.cache_grid_indices)
+            img_idx, begin_x, begin_y, rot_index = (int(v) for v in self.cache_grid[cache_idx])
+            end_x, end_y = begin_x + self.config.PATCH_SIZE, begin_y + self.config.PATCH_SIZE
+        elif self.is_train:
+            # CCW rotation, applied to the crops on the device by SAMRoad.prepare_batch
+            img_idx, begin_x, begin_y, rot_index = self.sample_train_crop()
             end_x, end_y = begin_x + self.config.PATCH_SIZE, begin_y + self.config.PATCH_SIZE
         else:
             # Returns eval patch
@@ -441,33 +894,35 @@ class SatMapDataset(Dataset):
         keypoint_mask_patch = self.keypoint_masks[img_idx][begin_y:end_y, begin_x:end_x]
         road_mask_patch = self.road_masks[img_idx][begin_y:end_y, begin_x:end_x]
 
-        # Augmentation
-        rot_index = 0
-        if self.is_train:
-            rot_index = np.random.randint(0, 4)
-            # CCW
-            rgb_patch = np.rot90(rgb_patch, rot_index, [0,1]).copy()
-            keypoint_mask_patch = np.rot90(keypoint_mask_patch, rot_index, [0, 1]).copy()
-            road_mask_patch = np.rot90(road_mask_patch, rot_index, [0, 1]).copy()
-        
-        # Sample graph labels from patch
-        patch = ((begin_x, begin_y), (end_x, end_y))
+        # Sample graph labels from patch, unless presampled
+        if topo_labels is None:
+            patch = ((begin_x, begin_y), (end_x, end_y))
+            topo_labels = self.graph_label_generators[img_idx].sample_patch(patch, rot_index)
         # points are img (x, y) inside the patch.
-        graph_points, topo_samples = self.graph_label_generators[img_idx].sample_patch(patch, rot_index)
+        # pairs: [n_sample, n_nbr, 2], connected / valid: [n_sample, n_nbr]
+        graph_points, pairs, connected, valid = topo_labels
         
-        pairs, connected, valid = zip(*topo_samples)
-        
-        # rgb: [H, W, 3] 0-255
-        # masks: [H, W] 0-1
+        # rgb: [H, W, 3] uint8, not rotated
+        # masks: [H, W] uint8 0 / 255, not rotated
+        if cache_idx is not None:
+            if self.cache_embeddings is None:
+                self.cache_embeddings = np.load(
+                    os.path.join(self.config.EMBEDDING_CACHE_DIR, 'embeddings.npy'), mmap_mode='r')
+            # [D, h, w] fp16, replaces rgb
+            image_input = {'image_embeddings': np.array(self.cache_embeddings[cache_idx])}
+        else:
+            image_input = {'rgb': rgb_patch}
+        # numpy arrays, turned into batch tensors by graph_collate_fn
         return {
-            'rgb': torch.tensor(rgb_patch, dtype=torch.float32),
-            'keypoint_mask': torch.round(torch.tensor(keypoint_mask_patch, dtype=torch.float32) / 255.0),
-            'road_mask': torch.round(torch.tensor(road_mask_patch, dtype=torch.float32) / 255.0),
+            **image_input,
+            'keypoint_mask': keypoint_mask_patch,
+            'road_mask': road_mask_patch,
+            'rot_index': np.array(rot_index, dtype=np.int64),
             
-            'graph_points': torch.tensor(graph_points, dtype=torch.float32),
-            'pairs': torch.tensor(pairs, dtype=torch.int32),
-            'connected': torch.tensor(connected, dtype=torch.bool),
-            'valid': torch.tensor(valid, dtype=torch.bool),
+            'graph_points': graph_points.astype(np.float32),
+            'pairs': pairs,
+            'connected': connected,
+            'valid': valid,
         }
 
 
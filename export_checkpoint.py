@@ -0,0 +1,149 @@
+from argparse import ArgumentParser
+import copy
+import os
+import time
+
+import torch
+import yaml
+
+from addict import Dict
+
+from utils import load_config, state_dict_content_hash
+from model import SAMRoad, build_inference_model
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--config", default=None, help="config of the trained model."
+)
+parser.add_argument(
+    "--checkpoint", default=None, help="trained checkpoint to export."
+)
+parser.add_argument(
+    "--output", default=None, help="path of the exported checkpoint, its config is saved next to it as .yaml"
+)
+parser.add_argument(
+    "--merge_lora", default=False, action='store_true', help="folds encoder LoRA weights into plain qkv linears."
+)
+parser.add_argument(
+    "--check", default=False, action='store_true', help="checks numeric parity and per-patch latency against the original model."
+)
+parser.add_argument(
+    "--dtype", default="float32", choices=["float32", "float16", "bfloat16"], help="dtype to store floating point weights in."
+)
+parser.add_argument("--device", default="cuda", help="device to run the check on")
+
+
+def save_exported_checkpoint(net, config, path, dtype_name="float32"):
+    dtype = getattr(torch, dtype_name)
+    # Drops optimizer / scheduler / loop states, keeps weights (floating point ones in dtype).
+    state_dict = {
+        k: v.to(dtype) if v.is_floating_point() else v for k, v in net.state_dict().items()
+    }
+    content_hash = state_dict_content_hash(state_dict)
+    torch.save({
+        'state_dict': state_dict,
+        'config': config.to_dict(),
+        'dtype': dtype_name,
+        'content_hash': content_hash,
+    }, path)
+    config_path = os.path.splitext(path)[0] + '.yaml'
+    with open(config_path, 'w') as file:
+        yaml.dump(config.to_dict(), file)
+    print(f'##### Exported {path} with config {config_path} #####')
+    print(f'Weights in {dtype_name}, content hash {content_hash}')
+    return content_hash
+
+
+def random_patches(config, batch_size, device):
+    # [B, H, W, C] 0-255
+    return torch.rand(batch_size, config.PATCH_SIZE, config.PATCH_SIZE, 3, device=device) * 255.0
+
+
+def measure_patch_latency(net, config, device, batch_size=8, repeats=5):
+    # Seconds per patch of encoder + decoder inference.
+    patches = random_patches(config, batch_size, device)
+    with torch.no_grad():
+        # warm up
+        net.infer_masks_and_img_features(patches)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start_seconds = time.time()
+        for _ in range(repeats):
+            net.infer_masks_and_img_features(patches)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start_seconds) / (repeats * batch_size)
+
+
+def load_exported_checkpoint(path, config=None):
+    # Exported checkpoints hold weights only, so they load with weights_only and mmap.
+    checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    if config is None:
+        config = Dict(checkpoint['config'])
+    return build_inference_model(config, checkpoint['state_dict']), checkpoint
+
+
+def measure_load_seconds(load_fn, repeats=3):
+    seconds = []
+    for _ in range(repeats):
+        start_seconds = time.time()
+        load_fn()
+        seconds.append(time.time() - start_seconds)
+    return min(seconds)
+
+
+def check_parity(ref_net, net, config, device, batch_size=4):
+    patches = random_patches(config, batch_size, device)
+    with torch.no_grad():
+        ref_masks, ref_features = ref_net.infer_masks_and_img_features(patches)
+        masks, features = net.infer_masks_and_img_features(patches)
+    mask_diff = (ref_masks - masks).abs().max().item()
+    feature_diff = (ref_features - features).abs().max().item()
+    print(f'Max abs diff: masks {mask_diff}, image embeddings {feature_diff}')
+    return mask_diff, feature_diff
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = load_config(args.config)
+    device = torch.device("cuda") if args.device == "cuda" else torch.device("cpu")
+
+    # all weights come from the trained checkpoint
+    net = SAMRoad(config, load_sam_ckpt=False)
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    print(f'##### Loading Trained CKPT {args.checkpoint} #####')
+    net.load_state_dict(checkpoint["state_dict"], strict=True)
+    net.eval()
+
+    export_config = copy.deepcopy(config)
+    ref_net = copy.deepcopy(net) if args.check else None
+
+    if args.merge_lora:
+        assert config.ENCODER_LORA, 'the model has no LoRA to merge'
+        net.merge_lora()
+        export_config.ENCODER_LORA = False
+
+    save_exported_checkpoint(net, export_config, args.output, args.dtype)
+
+    size_mb = os.path.getsize(args.checkpoint) / 2**20
+    exported_size_mb = os.path.getsize(args.output) / 2**20
+    print(f'Disk size: original {size_mb:.2f} MB, exported {exported_size_mb:.2f} MB')
+
+    def load_original():
+        original_net = SAMRoad(config, load_sam_ckpt=False)
+        original_net.load_state_dict(torch.load(args.checkpoint, map_location="cpu")["state_dict"], strict=True)
+
+    load_seconds = measure_load_seconds(load_original)
+    exported_load_seconds = measure_load_seconds(lambda: load_exported_checkpoint(args.output))
+    print(f'Load time: original {load_seconds:.4f} s, exported {exported_load_seconds:.4f} s')
+
+    if args.check:
+        exported_net, _ = load_exported_checkpoint(args.output)
+        exported_net.eval()
+        ref_net.to(device)
+        exported_net.to(device)
+        check_parity(ref_net, exported_net, config, device)
+        ref_latency = measure_patch_latency(ref_net, config, device)
+        latency = measure_patch_latency(exported_net, config, device)
+        print(f'Per-patch latency: original {ref_latency * 1000:.2f} ms, exported {latency * 1000:.2f} ms')
@@ -6,6 +6,8 @@ import math
 import tcod
 from sklearn.neighbors import KDTree
 from skimage.draw import line
+from skimage.morphology import skeletonize
+from shapely.geometry import LineString, Polygon, mapping
 import networkx as nx
 from graph_utils import nms_points
 
@@ -127,7 +129,44 @@ def create_cost_field_astar(sample_pts, road_mask, block_threshold=200):
     return cost_field
 
 
-def extract_graph_points(keypoint_mask, road_mask, config):
+def get_road_straightness(road_mask, sigma):
+    # Coherence of the structure tensor of the road mask, in [0, 1].
+    # Close to 1 along straight roads (both road borders share one orientation),
+    # lower at curves and junctions where border orientations vary.
+    mask = road_mask.astype(np.float32) / 255.0
+    gx = cv2.Sobel(mask, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(mask, cv2.CV_32F, 0, 1, ksize=3)
+    jxx = cv2.GaussianBlur(gx * gx, (0, 0), sigma)
+    jyy = cv2.GaussianBlur(gy * gy, (0, 0), sigma)
+    jxy = cv2.GaussianBlur(gx * gy, (0, 0), sigma)
+    coherence = np.sqrt((jxx - jyy) ** 2 + 4.0 * jxy ** 2) / (jxx + jyy + 1e-6)
+    return np.clip(coherence, 0.0, 1.0)
+
+
+def get_adaptive_road_nms_radius(keypoint_mask, road_mask, candidates, candidate_scores, config):
+    # Per-candidate nms radius: ROAD_NMS_RADIUS near keypoints and curves, growing up to
+    # ROAD_NMS_MAX_RADIUS on straight, confident road far from keypoints.
+    min_radius, max_radius = config.ROAD_NMS_RADIUS, config.ROAD_NMS_MAX_RADIUS
+    # [H, W]
+    straightness = get_road_straightness(road_mask, sigma=min_radius)
+    # distance to the closest keypoint pixel
+    not_keypoint = (keypoint_mask <= config.ITSC_THRESHOLD * 255).astype(np.uint8)
+    keypoint_dist = cv2.distanceTransform(not_keypoint, cv2.DIST_L2, 5)
+
+    xs, ys = candidates[:, 0], candidates[:, 1]
+    # straightness below this counts as a curve
+    min_straightness = config.ADAPTIVE_NMS_MIN_STRAIGHTNESS
+    straight = np.clip((straightness[ys, xs] - min_straightness) / (1.0 - min_straightness), 0.0, 1.0)
+    confidence = np.clip((candidate_scores / 255.0 - config.ROAD_THRESHOLD) / (1.0 - config.ROAD_THRESHOLD), 0.0, 1.0)
+    # keeps dense sampling within max_radius of keypoints
+    far_from_keypoint = np.clip(keypoint_dist[ys, xs] / max_radius - 1.0, 0.0, 1.0)
+    return min_radius + (max_radius - min_radius) * straight * confidence * far_from_keypoint
+
+
+def extract_graph_points(keypoint_mask, road_mask, config, adaptive_nms=None):
+    # adaptive_nms: spaces points more widely along straight roads, defaults to config.ADAPTIVE_ROAD_NMS
+    if adaptive_nms is None:
+        adaptive_nms = config.ADAPTIVE_ROAD_NMS
     kp_candidates, kp_scores = get_points_and_scores_from_mask(keypoint_mask, config.ITSC_THRESHOLD * 255)
     kps_0 = nms_points(kp_candidates, kp_scores, config.ITSC_NMS_RADIUS)
     kp_candidates, kp_scores = get_points_and_scores_from_mask(road_mask, config.ROAD_THRESHOLD * 255)
@@ -135,7 +174,14 @@ def extract_graph_points(keypoint_mask, road_mask, config):
     # prioritize intersection points
     kp_candidates = np.concatenate([kps_0, kps_1], axis=0)
     kp_scores = np.concatenate([np.ones((kps_0.shape[0])), np.zeros((kps_1.shape[0]))], axis=0)
-    kps = nms_points(kp_candidates, kp_scores, config.ROAD_NMS_RADIUS)
+    if adaptive_nms:
+        # this nms sets the final spacing of road points
+        road_nms_radius = get_adaptive_road_nms_radius(
+            keypoint_mask, road_mask, kps_1, road_mask[kps_1[:, 1], kps_1[:, 0]], config)
+        nms_radius = np.concatenate([np.full((kps_0.shape[0]), config.ROAD_NMS_RADIUS), road_nms_radius], axis=0)
+    else:
+        nms_radius = config.ROAD_NMS_RADIUS
+    kps = nms_points(kp_candidates, kp_scores, nms_radius)
     return kps
 
 
@@ -166,6 +212,99 @@ def extract_graph_astar(keypoint_mask, road_mask, config):
             checked.add((start, end))
     return graph
 
+def trace_skeleton_polylines(skeleton):
+    # Traces a 1-pixel wide skeleton into polylines between end points / junctions.
+    # Returns a list of [N, 2] (x, y) arrays.
+    ys, xs = np.nonzero(skeleton)
+    pixel_num = ys.shape[0]
+    if pixel_num == 0:
+        return []
+    h, w = skeleton.shape
+    index = np.full((h + 2, w + 2), -1, dtype=np.int64)
+    index[ys + 1, xs + 1] = np.arange(pixel_num)
+
+    srcs, tgts = [], []
+    # half of the 8-neighborhood, each edge is found once
+    for dy, dx in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+        nbr = index[ys + 1 + dy, xs + 1 + dx]
+        has_nbr = nbr >= 0
+        if dy != 0 and dx != 0:
+            # skips diagonal steps that are also covered by two 4-connected steps,
+            # they create fake junctions at corners
+            has_nbr &= (index[ys + 1 + dy, xs + 1] < 0) & (index[ys + 1, xs + 1 + dx] < 0)
+        srcs.append(np.nonzero(has_nbr)[0])
+        tgts.append(nbr[has_nbr])
+    srcs, tgts = np.concatenate(srcs), np.concatenate(tgts)
+    adj = [[] for _ in range(pixel_num)]
+    for s, t in zip(srcs.tolist(), tgts.tolist()):
+        adj[s].append(t)
+        adj[t].append(s)
+    degree = np.array([len(a) for a in adj])
+
+    points = np.stack([xs, ys], axis=1)
+    visited_edges = set()
+    polylines = []
+
+    def walk(start, nxt):
+        path = [start, nxt]
+        visited_edges.add((min(start, nxt), max(start, nxt)))
+        prev, cur = start, nxt
+        while degree[cur] == 2:
+            following = adj[cur][0] if adj[cur][0] != prev else adj[cur][1]
+            edge = (min(cur, following), max(cur, following))
+            if edge in visited_edges:
+                break
+            visited_edges.add(edge)
+            path.append(following)
+            prev, cur = cur, following
+        return points[path]
+
+    # polylines between end points and junctions
+    for start in np.nonzero(degree != 2)[0].tolist():
+        for nxt in adj[start]:
+            if (min(start, nxt), max(start, nxt)) not in visited_edges:
+                polylines.append(walk(start, nxt))
+    # loops without any junction
+    for start in np.nonzero(degree == 2)[0].tolist():
+        for nxt in adj[start]:
+            if (min(start, nxt), max(start, nxt)) not in visited_edges:
+                polylines.append(walk(start, nxt))
+    return polylines
+
+
+def extract_road_vectors(road_mask, config, simplify_tolerance=1.0):
+    # Vectorizes a fused road mask (uint8 0-255) in pixel (x, y) coords.
+    # Returns a GeoJSON FeatureCollection dict with road centerlines and road area polygons.
+    binary = (road_mask > config.ROAD_THRESHOLD * 255).astype(np.uint8)
+    features = []
+
+    skeleton = skeletonize(binary > 0)
+    for polyline in trace_skeleton_polylines(skeleton):
+        if polyline.shape[0] < 2:
+            continue
+        geometry = LineString(polyline).simplify(simplify_tolerance)
+        features.append({'type': 'Feature', 'properties': {'kind': 'centerline'}, 'geometry': mapping(geometry)})
+
+    # outer contours with their holes
+    contours, hierarchy = cv2.findContours(binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    for i, contour in enumerate(contours):
+        # hierarchy: [next, previous, first_child, parent]
+        if hierarchy[0][i][3] >= 0 or contour.shape[0] < 3:
+            continue
+        holes = []
+        child = hierarchy[0][i][2]
+        while child >= 0:
+            if contours[child].shape[0] >= 3:
+                holes.append(contours[child][:, 0, :])
+            child = hierarchy[0][child][0]
+        geometry = Polygon(contour[:, 0, :], holes).simplify(simplify_tolerance)
+        if geometry.is_empty:
+            continue
+        features.append({'type': 'Feature', 'properties': {'kind': 'road_area'}, 'geometry': mapping(geometry)})
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
 # takes xys    
 def visualize_image_and_graph(img, graph):
     # Draw nodes as green squares
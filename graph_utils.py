@@ -605,18 +605,28 @@ def subdivide_graph(graph, resolution):
         
 def nms_points(points, scores, radius, return_indices=False):
     # if score > 1.0, the point is forced to be kept regardless
+    # radius is either a scalar or a [N, ] array of per-point suppression radius
     sorted_indices = np.argsort(scores)[::-1]
     sorted_points = points[sorted_indices, :]
     sorted_scores = scores[sorted_indices]
+    per_point_radius = np.ndim(radius) > 0
+    if per_point_radius:
+        sorted_radius = np.asarray(radius)[sorted_indices]
+    else:
+        sorted_radius = np.full(sorted_indices.shape[0], radius)
     kept = np.ones(sorted_indices.shape[0], dtype=bool)
     tree = scipy.spatial.KDTree(sorted_points)
     for idx, p in enumerate(sorted_points):
         if not kept[idx]:
             continue
         # neighbor_indices = tree.query_radius(p[np.newaxis, :], r=radius)[0]
-        neighbor_indices = tree.query_ball_point(p, r=radius)
+        neighbor_indices = tree.query_ball_point(p, r=sorted_radius[idx])
         neighbor_scores = sorted_scores[neighbor_indices]
         keep_nbr = np.greater(neighbor_scores, 1.0)
+        if per_point_radius:
+            # a larger radius shall not remove points kept before this one
+            neighbor_indices = np.asarray(neighbor_indices, dtype=np.int64)
+            keep_nbr |= (neighbor_indices < idx) & kept[neighbor_indices]
         kept[neighbor_indices] = keep_nbr
         kept[idx] = True
     if return_indices:
@@ -664,6 +674,166 @@ def bfs_with_conditions(graph, start_node, stop_nodes, max_depth):
     return visited
 
 
+def csr_adjacency(node_num, edges):
+    """
+    CSR adjacency of an undirected graph.
+
+    Args:
+    - node_num (int): Number of nodes.
+    - edges (np.ndarray): [N_edge, 2] (src_idx, dst_idx) pairs.
+
+    Returns:
+    - tuple: (indptr [node_num + 1], indices [2 * N_edge]), the neighbors of node i are
+      indices[indptr[i]:indptr[i + 1]].
+    """
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    src = np.concatenate([edges[:, 0], edges[:, 1]])
+    dst = np.concatenate([edges[:, 1], edges[:, 0]])
+    indptr = np.zeros(node_num + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=node_num), out=indptr[1:])
+    return indptr, dst[np.argsort(src, kind='stable')]
+
+
+# Dense (search, node) flags of batched_bfs_with_conditions, reused across calls in a process and
+# all False between them. Searches needing more flags than the limit use sorted key arrays instead.
+_bfs_flags = np.zeros(0, dtype=bool)
+BFS_DENSE_FLAG_LIMIT = 2 ** 25
+
+
+def batched_bfs_with_conditions(indptr, indices, start_nodes, stop_nodes, max_depth):
+    """
+    bfs_with_conditions for many searches at once, level by level over a CSR adjacency.
+    Search i starts from start_nodes[i] and does not extend past its own stop nodes.
+
+    Args:
+    - indptr, indices (np.ndarray): CSR adjacency, see csr_adjacency.
+    - start_nodes (np.ndarray): [N_search] start node of each search.
+    - stop_nodes (np.ndarray): [N_search, K] stop nodes of each search, negative entries are padding.
+    - max_depth (int): The maximum depth to search.
+
+    Returns:
+    - np.ndarray: [N_search, K] bool, whether each stop node is visited by its search.
+    """
+    global _bfs_flags
+    node_num = len(indptr) - 1
+    search_num = len(start_nodes)
+    stop_nodes = np.asarray(stop_nodes, dtype=np.int64)
+    is_stop = stop_nodes >= 0
+    # (search, node) pairs are flattened as search * node_num + node
+    key_num = search_num * node_num
+    stop_keys = (np.arange(search_num)[:, np.newaxis] * node_num + stop_nodes)[is_stop]
+    keys = np.arange(search_num, dtype=np.int64) * node_num + np.asarray(start_nodes, dtype=np.int64)
+    dense = 2 * key_num <= BFS_DENSE_FLAG_LIMIT
+    if dense:
+        if len(_bfs_flags) < 2 * key_num:
+            _bfs_flags = np.zeros(2 * key_num, dtype=bool)
+        stop_flags, visited = _bfs_flags[:key_num], _bfs_flags[key_num:2 * key_num]
+        stop_flags[stop_keys] = True
+        visited[keys] = True
+        visited_keys = [keys]
+    else:
+        # memory follows the nodes reached within max_depth, not the graph size
+        sorted_stop_keys = np.unique(stop_keys)
+        visited = np.unique(keys)
+    for _ in range(max_depth):
+        # stop nodes are visited but not extended
+        keys = keys[~(stop_flags[keys] if dense else np.isin(keys, sorted_stop_keys, assume_unique=True))]
+        search, node = keys // node_num, keys % node_num
+        degrees = indptr[node + 1] - indptr[node]
+        nbr_positions = np.repeat(indptr[node] - np.cumsum(degrees) + degrees, degrees) + np.arange(degrees.sum())
+        keys = np.repeat(search * node_num, degrees) + indices[nbr_positions]
+        if dense:
+            keys = np.unique(keys[~visited[keys]])
+        else:
+            keys = np.unique(keys)
+            keys = keys[~np.isin(keys, visited, assume_unique=True)]
+        if len(keys) == 0:
+            break
+        if dense:
+            visited[keys] = True
+            visited_keys.append(keys)
+        else:
+            visited = np.union1d(visited, keys)
+    reached = np.zeros(stop_nodes.shape, dtype=bool)
+    if dense:
+        reached[is_stop] = visited[stop_keys]
+        # leaves the flags all False for the next call
+        stop_flags[stop_keys] = False
+        visited[np.concatenate(visited_keys)] = False
+    else:
+        reached[is_stop] = np.isin(stop_keys, visited)
+    return reached
+
+
+def sample_mask_along_segments(mask, src_points, tgt_points, endpoint_radius=4):
+    """
+    Samples a mask at ~1 pixel steps along a batch of line segments in one vectorized op.
+
+    Args:
+    - mask (np.ndarray): [H, W] mask.
+    - src_points (np.ndarray): [N, 2] segment start points, (x, y).
+    - tgt_points (np.ndarray): [N, 2] segment end points, (x, y).
+    - endpoint_radius (float): samples closer than this to either end point are not used,
+      same as the keypoint blocking in graph_extraction.is_connected_bresenham.
+
+    Returns:
+    - np.ndarray: [N, N_steps] sampled mask values.
+    - np.ndarray: [N, N_steps] bool, whether a sample is used.
+    """
+    src_points = np.asarray(src_points, dtype=np.float32).reshape(-1, 2)
+    tgt_points = np.asarray(tgt_points, dtype=np.float32).reshape(-1, 2)
+    # [N]
+    lengths = np.linalg.norm(tgt_points - src_points, axis=-1)
+    step_num = int(np.ceil(lengths.max())) + 1 if lengths.shape[0] > 0 else 1
+    # [N_steps]
+    ts = np.linspace(0.0, 1.0, step_num, dtype=np.float32)
+    # [N, N_steps, 2]
+    coords = src_points[:, np.newaxis, :] + ts[np.newaxis, :, np.newaxis] * (tgt_points - src_points)[:, np.newaxis, :]
+    coords = np.rint(coords).astype(np.int64)
+    coords[..., 0] = np.clip(coords[..., 0], 0, mask.shape[1] - 1)
+    coords[..., 1] = np.clip(coords[..., 1], 0, mask.shape[0] - 1)
+    values = mask[coords[..., 1], coords[..., 0]]
+    # [N, N_steps] distance of each sample to the closer end point
+    dists = np.minimum(ts[np.newaxis, :], 1.0 - ts[np.newaxis, :]) * lengths[:, np.newaxis]
+    used = dists >= endpoint_radius
+    return values, used
+
+
+def prefilter_pairs_by_mask(road_mask, src_points, tgt_points, road_threshold, off_road_ratio, on_road_threshold=None, is_nearest=None):
+    """
+    Cheap connectivity test of candidate pairs against a road mask, so clear cases
+    can skip TopoNet.
+
+    Args:
+    - road_mask (np.ndarray): [H, W] uint8 road mask, 0-255.
+    - src_points, tgt_points (np.ndarray): [N, 2] pair end points, (x, y).
+    - road_threshold (float): mask score in 0-1 below which a pixel is off road.
+    - off_road_ratio (float): a pair is disconnected if more than this fraction of the
+      segment between the points is off road.
+    - on_road_threshold (float): if set, a pair is connected if every sample on the
+      segment scores above this (0-1).
+    - is_nearest (np.ndarray): [N] bool, only these pairs may be decided as connected. Farther
+      neighbors along the same road shall not be connected, and the mask can't tell them apart.
+
+    Returns:
+    - np.ndarray: [N] int8, 0 for disconnected, 1 for connected, -1 for undecided.
+    """
+    values, used = sample_mask_along_segments(road_mask, src_points, tgt_points)
+    decisions = np.full((values.shape[0], ), -1, dtype=np.int8)
+    used_num = used.sum(axis=-1)
+    has_samples = used_num > 0
+    off_road_num = np.sum((values < road_threshold * 255) & used, axis=-1)
+    disconnected = has_samples & (off_road_num > off_road_ratio * used_num)
+    decisions[disconnected] = 0
+    if on_road_threshold:
+        min_values = np.where(used, values, 255).min(axis=-1, initial=255)
+        connected = has_samples & (min_values > on_road_threshold * 255) & ~disconnected
+        if is_nearest is not None:
+            connected &= is_nearest
+        decisions[connected] = 1
+    return decisions
+
+
 
 ##### Unit tests #####
 class TestGraphUtils(unittest.TestCase):
@@ -757,6 +927,33 @@ class TestGraphUtils(unittest.TestCase):
         self.assertEqual(g.vs[0]['point'][0], 2)
         self.assertEqual(g.vs[0]['point'][1], 1)
 
+    def test_batched_bfs_with_conditions(self):
+        rng = np.random.default_rng(0)
+        node_num = 60
+        edges = rng.integers(0, node_num, size=(80, 2))
+        g = ig.Graph(node_num, edges.tolist())
+        indptr, indices = csr_adjacency(node_num, edges)
+        start_nodes = rng.integers(0, node_num, size=20)
+        stop_nodes = rng.integers(-1, node_num, size=(20, 6))
+        reached = batched_bfs_with_conditions(indptr, indices, start_nodes, stop_nodes, max_depth=4)
+        for i, start_node in enumerate(start_nodes):
+            stop_set = set(stop_nodes[i][stop_nodes[i] >= 0].tolist())
+            visited = bfs_with_conditions(g, start_node, stop_set, 4)
+            gt = [t >= 0 and t in visited for t in stop_nodes[i]]
+            np.testing.assert_array_equal(reached[i], gt)
+        # the reused dense flags are left clean
+        self.assertFalse(_bfs_flags.any())
+        np.testing.assert_array_equal(
+            batched_bfs_with_conditions(indptr, indices, start_nodes, stop_nodes, max_depth=4), reached)
+        # sparse visited sets above the dense flag limit
+        global BFS_DENSE_FLAG_LIMIT
+        dense_flag_limit, BFS_DENSE_FLAG_LIMIT = BFS_DENSE_FLAG_LIMIT, 0
+        try:
+            np.testing.assert_array_equal(
+                batched_bfs_with_conditions(indptr, indices, start_nodes, stop_nodes, max_depth=4), reached)
+        finally:
+            BFS_DENSE_FLAG_LIMIT = dense_flag_limit
+
     def test_find_crossover_points(self):
         adj = {
             (0, 1) : [(10, 1), ],
@@ -782,6 +979,27 @@ class TestGraphUtils(unittest.TestCase):
         self.assertEqual(len(g1.vs['point']), 11)
         self.assertEqual(len(g1.es), 10)
 
+    def test_prefilter_pairs_by_mask(self):
+        road_mask = np.zeros((32, 32), dtype=np.uint8)
+        road_mask[10, :] = 255
+        src = np.array([[2, 10], [2, 10], [2, 10]])
+        tgt = np.array([[20, 10], [20, 25], [3, 10]])
+        decisions = prefilter_pairs_by_mask(road_mask, src, tgt, road_threshold=0.5, off_road_ratio=0.5)
+        # on road, off road, too short to tell
+        np.testing.assert_array_equal(decisions, np.array([-1, 0, -1]))
+        decisions = prefilter_pairs_by_mask(
+            road_mask, src, tgt, road_threshold=0.5, off_road_ratio=0.5, on_road_threshold=0.9,
+            is_nearest=np.array([True, True, True]))
+        np.testing.assert_array_equal(decisions, np.array([1, 0, -1]))
+
+    def test_nms_points_per_point_radius(self):
+        points = np.array([[0.0, 0.0], [3.0, 0.0], [10.0, 0.0], [13.0, 0.0]])
+        scores = np.array([0.9, 0.5, 0.8, 0.4])
+        # the first point suppresses within 5, the third one within 2
+        radius = np.array([5.0, 5.0, 2.0, 2.0])
+        kept = nms_points(points, scores, radius)
+        np.testing.assert_array_equal(kept, np.array([[0.0, 0.0], [10.0, 0.0], [13.0, 0.0]]))
+
 
 if __name__ == '__main__':
     unittest.main()
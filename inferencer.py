@@ -2,12 +2,14 @@ import numpy as np
 import os
 import imageio
 import torch
+import torch.nn.functional as F
 import cv2
+import math
 
 from utils import load_config, create_output_dir_and_save_config
 from dataset import cityscale_data_partition, read_rgb_img, get_patch_info_one_img
 from dataset import spacenet_data_partition
-from model import SAMRoad
+from model import SAMRoad, build_inference_model
 import graph_extraction
 import graph_utils
 import triage
@@ -17,6 +19,8 @@ import scipy
 import rtree
 from collections import defaultdict
 import time
+import json
+from addict import Dict
 
 from argparse import ArgumentParser
 
@@ -26,13 +30,24 @@ parser.add_argument(
     "--checkpoint", default=None, help="checkpoint of the model to test."
 )
 parser.add_argument(
-    "--config", default=None, help="model config."
+    "--config", default=None, help="model config, can be omitted for checkpoints from export_checkpoint.py."
 )
 parser.add_argument(
     "--output_dir", default=None, help="Name of the output dir, if not specified will use timestamp"
 )
 parser.add_argument("--device", default="cuda", help="device to use for training")
+parser.add_argument(
+    "--mask_only", default=False, action='store_true', help="only infer fused road / intersection masks, skips the graph."
+)
+parser.add_argument(
+    "--export_vectors", default=False, action='store_true', help="exports road centerlines and polygons as geojson."
+)
+parser.add_argument(
+    "--full_model_init", default=False, action='store_true', help="builds the model the training way (SAM ckpt load + random init), for cold start comparison."
+)
 args = parser.parse_args()
+if args.full_model_init and not args.config:
+    parser.error('--full_model_init builds the model the training way and needs --config')
 
 
 def get_img_paths(root_dir, image_indices):
@@ -58,14 +73,147 @@ def get_batch_img_patches(img, batch_patch_info):
     return batch
 
 
-def infer_one_img(net, img, config):
-    # TODO(congrui): centralize these configs
+def get_infer_patch_info(image_size, config):
+    # list of (i, (x_begin, y_begin), (x_end, y_end))
+    all_patch_info = get_patch_info_one_img(
+        0, image_size, config.SAMPLE_MARGIN, config.PATCH_SIZE, config.INFER_PATCHES_PER_EDGE)
+    downsample = config.INFER_MASK_DOWNSAMPLE or 1
+    if downsample > 1:
+        # low res masks are fused on the downsampled grid, so patches start on it
+        max_begin = (image_size - config.PATCH_SIZE) // downsample * downsample
+        snap = lambda v: min(round(v / downsample) * downsample, max_begin)
+        all_patch_info = [
+            (i, (snap(x0), snap(y0)), (snap(x0) + config.PATCH_SIZE, snap(y0) + config.PATCH_SIZE))
+            for i, (x0, y0), _ in all_patch_info
+        ]
+    return all_patch_info
+
+
+def get_patch_topo_queries(graph_points, graph_rtree, patch_info, config, road_mask=None):
+    # Builds the TopoNet queries of one patch. Returns None if the patch has no points.
+    # With TOPO_PREFILTER, pairs that road_mask clearly decides are taken out of the queries.
+    _, (x0, y0), (x1, y1) = patch_info
+    patch_point_indices = list(graph_rtree.intersection((x0, y0, x1, y1)))
+    patch_point_num = len(patch_point_indices)
+    if patch_point_num == 0:
+        return None
+    idx_patch2all = {patch_idx : all_idx for patch_idx, all_idx in enumerate(patch_point_indices)}
+    # normalize into patch
+    patch_points = graph_points[patch_point_indices, :] - np.array([[x0, y0]], dtype=graph_points.dtype)
+    # for knn and circle query
+    patch_kdtree = scipy.spatial.KDTree(patch_points)
+
+    # k+1 because the nearest one is always self
+    # idx is to the patch subgraph
+    knn_d, knn_idx = patch_kdtree.query(patch_points, k=config.MAX_NEIGHBOR_QUERIES + 1, distance_upper_bound=config.NEIGHBOR_RADIUS)
+    # [patch_point_num, n_nbr]
+    knn_idx = knn_idx[:, 1:]  # removes self
+    # [patch_point_num, n_nbr] idx is to the patch subgraph
+    src_idx = np.tile(
+        np.arange(patch_point_num)[:, np.newaxis],
+        (1, config.MAX_NEIGHBOR_QUERIES)
+    )
+    valid = knn_idx < patch_point_num
+    tgt_idx = np.where(valid, knn_idx, src_idx)
+    # [patch_point_num, n_nbr, 2]
+    pairs = np.stack([src_idx, tgt_idx], axis=-1)
+
+    # pairs decided by the road mask skip toponet, their scores are given directly
+    forced_pairs = np.zeros((0, 2), dtype=np.int64)
+    forced_scores = np.zeros((0, ), dtype=np.float32)
+    query_num = int(valid.sum())
+    if config.TOPO_PREFILTER and road_mask is not None:
+        # [N_valid, 2] idx to the full graph
+        valid_pairs = np.array(patch_point_indices)[pairs[valid]]
+        # knn results are sorted by distance
+        is_nearest = np.zeros_like(valid)
+        is_nearest[:, 0] = True
+        decisions = graph_utils.prefilter_pairs_by_mask(
+            road_mask, graph_points[valid_pairs[:, 0]], graph_points[valid_pairs[:, 1]],
+            road_threshold=config.ROAD_THRESHOLD,
+            off_road_ratio=config.TOPO_PREFILTER_OFF_ROAD_RATIO,
+            on_road_threshold=config.TOPO_PREFILTER_ON_ROAD_THRESHOLD,
+            is_nearest=is_nearest[valid])
+        decided = decisions >= 0
+        forced_pairs = valid_pairs[decided]
+        forced_scores = decisions[decided].astype(np.float32)
+        valid_rows, valid_cols = np.nonzero(valid)
+        valid[valid_rows[decided], valid_cols[decided]] = False
+
+    return {
+        'points': patch_points,
+        'pairs': pairs,
+        'valid': valid,
+        'idx_map': idx_patch2all,
+        'query_num': query_num,
+        'forced_pairs': forced_pairs,
+        'forced_scores': forced_scores,
+    }
+
+
+def schedule_topo_batches(point_nums, batch_size):
+    # Groups patches with similar point counts so that padding to the largest
+    # patch of a batch wastes little TopoNet compute.
+    # Returns lists of indices into point_nums.
+    order = np.argsort(-np.asarray(point_nums), kind='stable')
+    return [order[i : i + batch_size].tolist() for i in range(0, len(order), batch_size)]
+
+
+def get_padding_efficiency(point_nums, batches):
+    # Returns (real, padded) counts of [B, N_points] slots, real / padded is the padding efficiency.
+    # TopoNet runs one sample per point, so this also counts useful vs computed samples.
+    point_nums = np.asarray(point_nums)
+    real = sum(int(point_nums[batch].sum()) for batch in batches)
+    padded = sum(len(batch) * int(point_nums[batch].max()) for batch in batches)
+    return real, padded
+
+
+def get_inference_stats_txt(stats, total_inference_seconds):
+    lines = []
+    if stats['mask_only_tiles'] > 0:
+        lines.append(
+            f'Mask-only throughput: {stats["mask_only_tiles"] / max(total_inference_seconds, 1e-6):.4f} tiles/s '
+            f'over {int(stats["mask_only_tiles"])} tiles.'
+        )
+    if stats['vector_export_seconds'] > 0:
+        lines.append(f'Vector export took {stats["vector_export_seconds"]} seconds, not counted above.')
+    if stats['topo_padded_samples'] > 0:
+        efficiency = stats['topo_real_samples'] / stats['topo_padded_samples']
+        encoder_order_efficiency = stats['topo_real_samples'] / max(stats['topo_encoder_order_padded_samples'], 1)
+        lines.append(
+            f'TopoNet padding efficiency: {efficiency:.4f} '
+            f'({int(stats["topo_real_samples"])} real / {int(stats["topo_padded_samples"])} padded samples '
+            f'in {int(stats["topo_batches"])} batches), '
+            f'encoder-order batching would be {encoder_order_efficiency:.4f}.'
+        )
+    if stats['graph_points_fixed_nms'] > 0:
+        lines.append(
+            f'Adaptive road nms kept {int(stats["graph_points"])} graph points, '
+            f'{stats["graph_points"] / stats["graph_points_fixed_nms"]:.4f} of the {int(stats["graph_points_fixed_nms"])} '
+            f'with fixed ROAD_NMS_RADIUS.'
+        )
+    if stats['topo_queries'] > 0:
+        lines.append(f'TopoNet queries: {int(stats["topo_queries"])} valid pairs.')
+    if stats['topo_queries'] > 0 and stats['topo_prefilter_enabled']:
+        skipped = stats['topo_prefilter_disconnected'] + stats['topo_prefilter_connected']
+        lines.append(
+            f'TopoNet pre-filter skipped {skipped / stats["topo_queries"]:.4f} of {int(stats["topo_queries"])} queries '
+            f'({int(stats["topo_prefilter_disconnected"])} disconnected, {int(stats["topo_prefilter_connected"])} connected).'
+        )
+    return '\n'.join(lines)
+
+
+def infer_masks_one_img(net, img, config, keep_img_features=True):
+    # Pass 1: runs the encoder and decoder over all patches and fuses the masks as batches come in.
+    # Returns fused uint8 masks, plus the stored img features for toponet if keep_img_features.
+    # With INFER_MASK_DOWNSAMPLE, masks are fused at low resolution and the fused tile is upsampled once.
     image_size = img.shape[0]
+    downsample = config.INFER_MASK_DOWNSAMPLE or 1
+    fused_shape = (math.ceil(img.shape[0] / downsample), math.ceil(img.shape[1] / downsample))
 
     batch_size = config.INFER_BATCH_SIZE
     # list of (i, (x_begin, y_begin), (x_end, y_end))
-    all_patch_info = get_patch_info_one_img(
-        0, image_size, config.SAMPLE_MARGIN, config.PATCH_SIZE, config.INFER_PATCHES_PER_EDGE)
+    all_patch_info = get_infer_patch_info(image_size, config)
     patch_num = len(all_patch_info)
     batch_num = (
         patch_num // batch_size
@@ -73,16 +221,14 @@ def infer_one_img(net, img, config):
         else patch_num // batch_size + 1
     )
 
-    
-
-    # [IMG_H, IMG_W]
-    fused_keypoint_mask = torch.zeros(img.shape[0:2], dtype=torch.float32).to(args.device, non_blocking=False)
-    fused_road_mask = torch.zeros(img.shape[0:2], dtype=torch.float32).to(args.device, non_blocking=False)
-    pixel_counter = torch.zeros(img.shape[0:2], dtype=torch.float32).to(args.device, non_blocking=False)
+    # [IMG_H / d, IMG_W / d]
+    fused_keypoint_mask = torch.zeros(fused_shape, dtype=torch.float32).to(args.device, non_blocking=False)
+    fused_road_mask = torch.zeros(fused_shape, dtype=torch.float32).to(args.device, non_blocking=False)
+    pixel_counter = torch.zeros(fused_shape, dtype=torch.float32).to(args.device, non_blocking=False)
 
     # stores img embeddings for toponet
-    # list of [B, D, h, w], len=batch_num
-    img_features = list()
+    # list of [B, D, h, w], len=batch_num
+    img_features = list() if keep_img_features else None
 
     for batch_index in range(batch_num):
         offset = batch_index * batch_size
@@ -92,22 +238,46 @@ def infer_one_img(net, img, config):
 
         with torch.no_grad():
             batch_img_patches = batch_img_patches.to(args.device, non_blocking=False)
-            # [B, H, W, 2]
-            mask_scores, patch_img_features = net.infer_masks_and_img_features(batch_img_patches)
-            img_features.append(patch_img_features)
+            if keep_img_features:
+                # [B, H, W, 2]
+                mask_scores, patch_img_features = net.infer_masks_and_img_features(batch_img_patches)
+                img_features.append(patch_img_features)
+            else:
+                mask_scores = net.infer_masks(batch_img_patches)
         # Aggregate masks
         for patch_index, patch_info in enumerate(batch_patch_info):
             _, (x0, y0), (x1, y1) = patch_info
+            x0, y0, x1, y1 = x0 // downsample, y0 // downsample, x1 // downsample, y1 // downsample
             keypoint_patch, road_patch = mask_scores[patch_index, :, :, 0], mask_scores[patch_index, :, :, 1]
             fused_keypoint_mask[y0:y1, x0:x1] += keypoint_patch
             fused_road_mask[y0:y1, x0:x1] += road_patch
-            pixel_counter[y0:y1, x0:x1] += torch.ones(road_patch.shape[0:2], dtype=torch.float32, device=args.device)
+            pixel_counter[y0:y1, x0:x1] += 1.0
     
     fused_keypoint_mask /= pixel_counter
     fused_road_mask /= pixel_counter
+    if downsample > 1:
+        # [2, IMG_H, IMG_W]
+        fused_masks = F.interpolate(
+            torch.stack([fused_keypoint_mask, fused_road_mask], dim=0).unsqueeze(0),
+            scale_factor=downsample, mode='bilinear', align_corners=False)[0, :, :img.shape[0], :img.shape[1]]
+        fused_keypoint_mask, fused_road_mask = fused_masks[0], fused_masks[1]
     # range 0-1 -> 0-255
     fused_keypoint_mask = (fused_keypoint_mask * 255).to(torch.uint8).cpu().numpy()
     fused_road_mask = (fused_road_mask * 255).to(torch.uint8).cpu().numpy()
+    return fused_keypoint_mask, fused_road_mask, img_features
+
+
+def infer_one_img(net, img, config, stats=None):
+    # TODO(congrui): centralize these configs
+    image_size = img.shape[0]
+
+    batch_size = config.INFER_BATCH_SIZE
+    # list of (i, (x_begin, y_begin), (x_end, y_end))
+    all_patch_info = get_infer_patch_info(image_size, config)
+    patch_num = len(all_patch_info)
+
+    ## Pass 1: masks and img features
+    fused_keypoint_mask, fused_road_mask, img_features = infer_masks_one_img(net, img, config)
 
     # ## Astar graph extraction
     # pred_graph = graph_extraction.extract_graph_astar(fused_keypoint_mask, fused_road_mask, config)
@@ -119,6 +289,8 @@ def infer_one_img(net, img, config):
     
     ## Extract sample points from masks
     graph_points = graph_extraction.extract_graph_points(fused_keypoint_mask, fused_road_mask, config)
+    if stats is not None:
+        stats['graph_points'] += graph_points.shape[0]
     if graph_points.shape[0] == 0:
         return graph_points, np.zeros((0, 2), dtype=np.int32), fused_keypoint_mask, fused_road_mask
 
@@ -130,67 +302,68 @@ def infer_one_img(net, img, config):
         graph_rtree.insert(i, (x, y, x, y))
     
     ## Pass 2: infer toponet to predict topology of points from stored img features
+    # TopoNet queries are scheduled separately from the encoder batches: patches are
+    # grouped by point count so that padding to the largest patch stays small.
+    patch_queries = dict()
+    for patch_index, patch_info in enumerate(all_patch_info):
+        queries = get_patch_topo_queries(graph_points, graph_rtree, patch_info, config, road_mask=fused_road_mask)
+        if queries is not None:
+            patch_queries[patch_index] = queries
+    query_patch_indices = list(patch_queries.keys())
+    point_nums = [patch_queries[i]['points'].shape[0] for i in query_patch_indices]
+    topo_batch_size = config.INFER_TOPO_BATCH_SIZE or batch_size
+    topo_batches = [
+        [query_patch_indices[i] for i in batch]
+        for batch in schedule_topo_batches(point_nums, topo_batch_size)
+    ]
+
+    if stats is not None:
+        all_point_nums = np.zeros((patch_num, ), dtype=np.int64)
+        all_point_nums[query_patch_indices] = point_nums
+        real, padded = get_padding_efficiency(all_point_nums, topo_batches)
+        stats['topo_real_samples'] += real
+        stats['topo_padded_samples'] += padded
+        # what batching in encoder order would have cost, for comparison
+        encoder_order_batches = [
+            list(range(offset, min(offset + batch_size, patch_num))) for offset in range(0, patch_num, batch_size)
+        ]
+        encoder_order_batches = [batch for batch in encoder_order_batches if all_point_nums[batch].max() > 0]
+        _, padded = get_padding_efficiency(all_point_nums, encoder_order_batches)
+        stats['topo_encoder_order_padded_samples'] += padded
+        stats['topo_batches'] += len(topo_batches)
+        stats['topo_prefilter_enabled'] = float(bool(config.TOPO_PREFILTER))
+        for queries in patch_queries.values():
+            stats['topo_queries'] += queries['query_num']
+            stats['topo_prefilter_disconnected'] += int(np.sum(queries['forced_scores'] == 0.0))
+            stats['topo_prefilter_connected'] += int(np.sum(queries['forced_scores'] == 1.0))
+
     edge_scores = defaultdict(float)
     edge_counts = defaultdict(float)
-    for batch_index in range(batch_num):
-        offset = batch_index * batch_size
-        batch_patch_info = all_patch_info[offset : offset + batch_size]
-
-        topo_data = {
-            'points': [],
-            'pairs': [],
-            'valid': [],
-        }
-        idx_maps = []
+    # pairs decided by the mask pre-filter
+    for queries in patch_queries.values():
+        for (src_idx_all, tgt_idx_all), edge_score in zip(queries['forced_pairs'], queries['forced_scores']):
+            edge_scores[(src_idx_all, tgt_idx_all)] += edge_score
+            edge_counts[(src_idx_all, tgt_idx_all)] += 1.0
+    for topo_batch in topo_batches:
+        batch_queries = [patch_queries[i] for i in topo_batch]
+        idx_maps = [q['idx_map'] for q in batch_queries]
 
-
-        # prepares pairs queries
-        for patch_info in batch_patch_info:
-            _, (x0, y0), (x1, y1) = patch_info
-            patch_point_indices = list(graph_rtree.intersection((x0, y0, x1, y1)))
-            idx_patch2all = {patch_idx : all_idx for patch_idx, all_idx in enumerate(patch_point_indices)}
-            patch_point_num = len(patch_point_indices)
-            # normalize into patch
-            patch_points = graph_points[patch_point_indices, :] - np.array([[x0, y0]], dtype=graph_points.dtype)
-            # for knn and circle query
-            patch_kdtree = scipy.spatial.KDTree(patch_points)
-
-            # k+1 because the nearest one is always self
-            # idx is to the patch subgraph
-            knn_d, knn_idx = patch_kdtree.query(patch_points, k=config.MAX_NEIGHBOR_QUERIES + 1, distance_upper_bound=config.NEIGHBOR_RADIUS)
-            # [patch_point_num, n_nbr]
-            knn_idx = knn_idx[:, 1:]  # removes self
-            # [patch_point_num, n_nbr] idx is to the patch subgraph
-            src_idx = np.tile(
-                np.arange(patch_point_num)[:, np.newaxis],
-                (1, config.MAX_NEIGHBOR_QUERIES)
-            )
-            valid = knn_idx < patch_point_num
-            tgt_idx = np.where(valid, knn_idx, src_idx)
-            # [patch_point_num, n_nbr, 2]
-            pairs = np.stack([src_idx, tgt_idx], axis=-1)
-
-            topo_data['points'].append(patch_points)
-            topo_data['pairs'].append(pairs)
-            topo_data['valid'].append(valid)
-            idx_maps.append(idx_patch2all)
-        
         # collate
         collated = {}
-        for key, x_list in topo_data.items():
+        for key in ['points', 'pairs', 'valid']:
+            x_list = [q[key] for q in batch_queries]
             length = max([x.shape[0] for x in x_list])
             collated[key] = np.stack([
                 np.pad(x, [(0, length - x.shape[0])] + [(0, 0)] * (len(x.shape) - 1))
                 for x in x_list
             ], axis=0)
-
-        # skips this batch if there's no points
-        if collated['points'].shape[1] == 0:
-            continue
         
         # infer toponet
         # [B, D, h, w]
-        batch_features = img_features[batch_index]
+        batch_features = torch.stack([
+            img_features[patch_index // batch_size][patch_index % batch_size]
+            for patch_index in topo_batch
+        ], dim=0)
         # [B, N_sample, N_pair, 2]
         batch_points = torch.tensor(collated['points'], device=args.device)
         batch_pairs = torch.tensor(collated['pairs'], device=args.device)
@@ -206,8 +379,8 @@ def infer_one_img(net, img, config):
         topo_scores = torch.where(torch.isnan(topo_scores), -100.0, topo_scores).squeeze(-1).cpu().numpy()
 
         # aggregate edge scores
-        batch_size, n_samples, n_pairs = topo_scores.shape
-        for bi in range(batch_size):
+        batch_size_topo, n_samples, n_pairs = topo_scores.shape
+        for bi in range(batch_size_topo):
             for si in range(n_samples):
                 for pi in range(n_pairs):
                     if not collated['valid'][bi, si, pi]:
@@ -237,21 +410,44 @@ def infer_one_img(net, img, config):
 
 
 if __name__ == "__main__":
-    config = load_config(args.config)
-    
     # Builds eval model    
     device = torch.device("cuda") if args.device == "cuda" else torch.device("cpu")
     # Good when model architecture/input shape are fixed.
     torch.backends.cudnn.benchmark = True
     torch.backends.cudnn.enabled = True
-    net = SAMRoad(config)
-
-    # load checkpoint
-    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    cold_start_seconds = time.time()
     print(f'##### Loading Trained CKPT {args.checkpoint} #####')
-    net.load_state_dict(checkpoint["state_dict"], strict=True)
+    if args.full_model_init:
+        config = load_config(args.config)
+        net = SAMRoad(config)
+        checkpoint = torch.load(args.checkpoint, map_location="cpu")
+        net.load_state_dict(checkpoint["state_dict"], strict=True)
+    else:
+        # Skips the SAM ckpt and random init, weights are paged in from the mmap-ed checkpoint.
+        checkpoint = torch.load(args.checkpoint, map_location="cpu", mmap=True)
+        # Exported checkpoints embed their config.
+        if args.config:
+            config = load_config(args.config)
+        else:
+            assert 'config' in checkpoint, '--config is required for training checkpoints'
+            config = Dict(checkpoint['config'])
+        if 'content_hash' in checkpoint:
+            print(f'Exported checkpoint, weights in {checkpoint["dtype"]}, content hash {checkpoint["content_hash"]}')
+        net = build_inference_model(config, checkpoint["state_dict"])
     net.eval()
     net.to(device)
+    model_ready_seconds = time.time() - cold_start_seconds
+    # One patch through encoder + decoder, includes lazy weight reads and kernel warm up.
+    with torch.no_grad():
+        net.infer_masks(torch.zeros(1, config.PATCH_SIZE, config.PATCH_SIZE, 3, device=device))
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    first_patch_seconds = time.time() - cold_start_seconds
+    cold_start_txt = (
+        f'Cold start ({"full" if args.full_model_init else "fast"} model init): '
+        f'model ready in {model_ready_seconds:.4f} seconds, first patch done in {first_patch_seconds:.4f} seconds.'
+    )
+    print(cold_start_txt)
 
     if config.DATASET == 'cityscale':
         _, _, test_img_indices = cityscale_data_partition()
@@ -269,16 +465,46 @@ if __name__ == "__main__":
         output_dir = create_output_dir_and_save_config(output_dir_prefix, config)
     
     total_inference_seconds = 0.0
+    infer_stats = defaultdict(float)
 
     for img_id in test_img_indices:
         print(f'Processing {img_id}')
         # [H, W, C] RGB
         img = read_rgb_img(rgb_pattern.format(img_id))
         start_seconds = time.time()
+
+        if args.mask_only:
+            itsc_mask, road_mask, _ = infer_masks_one_img(net, img, config, keep_img_features=False)
+            end_seconds = time.time()
+            total_inference_seconds += (end_seconds - start_seconds)
+            infer_stats['mask_only_tiles'] += 1
+
+            mask_save_dir = os.path.join(output_dir, 'mask')
+            if not os.path.exists(mask_save_dir):
+                os.makedirs(mask_save_dir)
+            cv2.imwrite(os.path.join(mask_save_dir, f'{img_id}_road.png'), road_mask)
+            cv2.imwrite(os.path.join(mask_save_dir, f'{img_id}_itsc.png'), itsc_mask)
+
+            if args.export_vectors:
+                vector_start_seconds = time.time()
+                road_vectors = graph_extraction.extract_road_vectors(road_mask, config)
+                infer_stats['vector_export_seconds'] += time.time() - vector_start_seconds
+                vector_save_dir = os.path.join(output_dir, 'vector')
+                if not os.path.exists(vector_save_dir):
+                    os.makedirs(vector_save_dir)
+                with open(os.path.join(vector_save_dir, f'{img_id}.geojson'), 'w') as f:
+                    json.dump(road_vectors, f)
+            print(f'Done for {img_id}.')
+            continue
+
         # coords in (r, c)
-        pred_nodes, pred_edges, itsc_mask, road_mask = infer_one_img(net, img, config)
+        pred_nodes, pred_edges, itsc_mask, road_mask = infer_one_img(net, img, config, stats=infer_stats)
         end_seconds = time.time()
         total_inference_seconds += (end_seconds - start_seconds)
+        if config.ADAPTIVE_ROAD_NMS:
+            # fixed radius point count of the same masks, for reporting the reduction only, not timed
+            fixed_nms_points = graph_extraction.extract_graph_points(itsc_mask, road_mask, config, adaptive_nms=False)
+            infer_stats['graph_points_fixed_nms'] += fixed_nms_points.shape[0]
 
         gt_graph_path = gt_graph_pattern.format(img_id)
         gt_graph = pickle.load(open(gt_graph_path, "rb"))
@@ -343,7 +569,12 @@ if __name__ == "__main__":
         print(f'Done for {img_id}.')
     
     # log inference time
-    time_txt = f'Inference completed for {args.config} in {total_inference_seconds} seconds.'
+    mode = 'Mask-only inference' if args.mask_only else 'Inference'
+    time_txt = f'{mode} completed for {args.config or args.checkpoint} in {total_inference_seconds} seconds.'
     print(time_txt)
+    stats_txt = get_inference_stats_txt(infer_stats, total_inference_seconds)
+    print(stats_txt)
     with open(os.path.join(output_dir, 'inference_time.txt'), 'w') as f:
-        f.write(time_txt)
+        f.write(time_txt + '\n')
+        f.write(cold_start_txt + '\n')
+        f.write(stats_txt)
@@ -1,6 +1,7 @@
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 # from torchvision.ops import nms
 import matplotlib.pyplot as plt
@@ -8,10 +9,12 @@ import math
 import copy
 
 from functools import partial
+from collections import defaultdict
 from torchmetrics.classification import BinaryJaccardIndex, F1Score, BinaryPrecisionRecallCurve
 
 import lightning.pytorch as pl
-from segment_anything.modeling.image_encoder import ImageEncoderViT
+from segment_anything.modeling.image_encoder import (
+    Block, ImageEncoderViT, get_rel_pos, window_partition, window_unpartition)
 from segment_anything.modeling.mask_decoder import MaskDecoder
 from segment_anything.modeling.prompt_encoder import PromptEncoder
 from segment_anything.modeling.transformer import TwoWayTransformer
@@ -20,6 +23,11 @@ from segment_anything.modeling.common import LayerNorm2d
 import wandb
 import pprint
 import torchvision
+import numpy as np
+import unittest
+from addict import Dict
+import graph_utils
+from utils import load_config
 
 # Only needed for the ablation experiment of using a ViT-B model without SA-1B pre-training.
 # It depends on detectron2 library. Not super important. 
@@ -92,32 +100,35 @@ class TopoNet(nn.Module):
         # pairs_valid: [B, N_samples, N_pairs]
         
         point_features = F.relu(self.feature_proj(point_features))
-        # gathers pairs
         batch_size, n_samples, n_pairs, _ = pairs.shape
-        pairs = pairs.view(batch_size, -1, 2)
-        
-        batch_indices = torch.arange(batch_size).view(-1, 1).expand(-1, n_samples * n_pairs)
-        # Use advanced indexing to fetch the corresponding feature vectors
-        # [B, N_samples * N_pairs, D]
-        src_features = point_features[batch_indices, pairs[:, :, 0]]
-        tgt_features = point_features[batch_indices, pairs[:, :, 1]]
-        # [B, N_samples * N_pairs, 2]
-        src_points = points[batch_indices, pairs[:, :, 0]]
-        tgt_points = points[batch_indices, pairs[:, :, 1]]
-        offset = tgt_points - src_points
+        n_points = points.shape[1]
 
+        # pair_proj([src_features, tgt_features, tgt_points - src_points]) is linear, so src and tgt
+        # parts are projected per point and gathered afterwards:
+        # W_src * src_features - W_offset * src_points + W_tgt * tgt_features + W_offset * tgt_points + b
+        w_src, w_tgt, w_offset = self.pair_proj.weight.split([self.hidden_dim, self.hidden_dim, 2], dim=1)
         ## ablation study
-        # [B, N_samples * N_pairs, 2D + 2]
-        if self.config.TOPONET_VERSION == 'no_tgt_features':
-            pair_features = torch.concat([src_features, torch.zeros_like(tgt_features), offset], dim=2)
+        # 'no_tgt_features' used to fall through to the full pair features below, kept as is.
         if self.config.TOPONET_VERSION == 'no_offset':
-            pair_features = torch.concat([src_features, tgt_features, torch.zeros_like(offset)], dim=2)
+            src_proj = F.linear(point_features, w_src)
+            tgt_proj = F.linear(point_features, w_tgt)
         else:
-            pair_features = torch.concat([src_features, tgt_features, offset], dim=2)
-        
-        
+            offset_proj = F.linear(points.to(point_features.dtype), w_offset)
+            src_proj = F.linear(point_features, w_src) - offset_proj
+            tgt_proj = F.linear(point_features, w_tgt) + offset_proj
+        # [2 * B * N_points, D], src projections first
+        point_proj = torch.cat([src_proj.reshape(-1, self.hidden_dim), tgt_proj.reshape(-1, self.hidden_dim)], dim=0)
+
+        # flat indices into point_proj, built on the input device
+        # [B, N_samples * N_pairs, 2]
+        pairs = pairs.view(batch_size, -1, 2)
+        batch_offsets = torch.arange(batch_size, device=pairs.device).view(-1, 1, 1) * n_points
+        pair_offsets = torch.tensor([0, batch_size * n_points], device=pairs.device)
+        flat_indices = (pairs + batch_offsets + pair_offsets).view(-1)
+        # single gather of src and tgt projections
         # [B, N_samples * N_pairs, D]
-        pair_features = F.relu(self.pair_proj(pair_features))
+        pair_features = point_proj.index_select(0, flat_indices).view(batch_size, n_samples * n_pairs, 2, -1).sum(dim=2)
+        pair_features = F.relu(pair_features + self.pair_proj.bias)
         
         # attn applies within each local graph sample
         pair_features = pair_features.view(batch_size * n_samples, n_pairs, -1)
@@ -133,7 +144,12 @@ class TopoNet(nn.Module):
         
         ## ablation study
         if self.config.TOPONET_VERSION != 'no_transformer':
-            pair_features = self.transformer_encoder(pair_features, src_key_padding_mask=padding_mask)
+            if self.config.TOPONET_PACKED_ATTN:
+                # Padded pairs are left out instead of masked. Samples without valid pairs
+                # (flipped above) are skipped and get zero features, their outputs are unused.
+                pair_features = self.packed_transformer(pair_features, ~all_invalid_pair_mask & pairs_valid)
+            else:
+                pair_features = self.transformer_encoder(pair_features, src_key_padding_mask=padding_mask)
         
         ## Seems like at inference time, the returned n_pairs heres might be less - it's the
         # max num of valid pairs across all samples in the batch
@@ -147,6 +163,210 @@ class TopoNet(nn.Module):
 
         return logits, scores
 
+    def packed_transformer(self, pair_features, pairs_valid):
+        # pair_features: [S, N_pairs, D]
+        # pairs_valid: [S, N_pairs]
+        # Runs the transformer over the valid pairs of each sample only. Samples with the same
+        # number of valid pairs are stacked and run without padding mask, samples without valid
+        # pairs are skipped. Outputs of invalid pairs are zeros.
+        # Attention has no positional encoding, so moving valid pairs to the front is safe.
+        _, n_pairs, dim = pair_features.shape
+        valid_nums = pairs_valid.sum(dim=-1)
+        # valid pairs first, in their original order
+        order = torch.argsort((~pairs_valid).to(torch.int8), dim=-1, stable=True)
+        order = order.unsqueeze(-1).expand(-1, -1, dim)
+        sorted_features = torch.gather(pair_features, 1, order)
+
+        packed_features = torch.zeros_like(sorted_features)
+        for valid_num in torch.unique(valid_nums).tolist():
+            if valid_num == 0:
+                continue
+            sample_indices = torch.nonzero(valid_nums == valid_num).squeeze(1)
+            packed_features[sample_indices, :valid_num] = self.transformer_encoder(
+                sorted_features[sample_indices, :valid_num])
+        # back to the original pair order
+        return torch.zeros_like(packed_features).scatter(1, order, packed_features)
+
+
+class _SDPAAttention(nn.Module):
+    """Replaces the SAM encoder Attention, same params, runs F.scaled_dot_product_attention.
+    The decomposed relative position bias rel_h[q, k_h] + rel_w[q, k_w] is the dot product of
+    [rel_h, rel_w] and the one-hot (k_h, k_w) of the key, so it is appended to q and k
+    instead of being added to a full attention map.
+    With query_indices, only those tokens attend (to all keys), see SAMRoad.encode_pruned.
+    """
+
+    def __init__(self, attn: nn.Module):
+        super().__init__()
+        self.num_heads = attn.num_heads
+        self.scale = attn.scale
+        self.qkv = attn.qkv
+        self.proj = attn.proj
+        self.use_rel_pos = attn.use_rel_pos
+        if self.use_rel_pos:
+            self.rel_pos_h = attn.rel_pos_h
+            self.rel_pos_w = attn.rel_pos_w
+
+    def forward(self, x, query_indices=None):
+        # x: [B, H, W, C]
+        # query_indices: [B, K] flat token indices, returns [B, K, C] for these queries if given
+        B, H, W, _ = x.shape
+        # q, k, v with shape (B, nHead, H * W, C)
+        q, k, v = self.qkv(x).reshape(B, H * W, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4).unbind(0)
+        head_dim = q.shape[-1]
+        if query_indices is not None:
+            q = q.gather(2, query_indices[:, None, :, None].expand(-1, self.num_heads, -1, head_dim))
+        r_q = q
+        q = q * self.scale
+
+        if self.use_rel_pos:
+            Rh = get_rel_pos(H, H, self.rel_pos_h).to(q.dtype)
+            Rw = get_rel_pos(W, W, self.rel_pos_w).to(q.dtype)
+            if query_indices is None:
+                r_q = r_q.reshape(B, self.num_heads, H, W, head_dim)
+                rel_h = torch.einsum("bnhwc,hkc->bnhwk", r_q, Rh).reshape(B, self.num_heads, H * W, H)
+                rel_w = torch.einsum("bnhwc,wkc->bnhwk", r_q, Rw).reshape(B, self.num_heads, H * W, W)
+            else:
+                # Rh, Rw rows of each query: [B, K, H, C], [B, K, W, C]
+                rel_h = torch.einsum("bnqc,bqkc->bnqk", r_q, Rh[query_indices // W])
+                rel_w = torch.einsum("bnqc,bqkc->bnqk", r_q, Rw[query_indices % W])
+            key_h = F.one_hot(torch.arange(H, device=x.device).repeat_interleave(W), H).to(q.dtype)
+            key_w = F.one_hot(torch.arange(W, device=x.device).repeat(H), W).to(q.dtype)
+            q = torch.cat([q, rel_h, rel_w], dim=-1)
+            k = torch.cat([k, key_h.expand(B, self.num_heads, -1, -1), key_w.expand(B, self.num_heads, -1, -1)], dim=-1)
+            # fused kernels want a head dim that is a multiple of 8, zero columns leave q @ k as is
+            qk_pad = -q.shape[-1] % 8
+            q, k = F.pad(q, (0, qk_pad)), F.pad(k, (0, qk_pad))
+            # and v as wide as q and k
+            v = F.pad(v, (0, q.shape[-1] - head_dim))
+
+        x = F.scaled_dot_product_attention(q, k, v, scale=1.0)[..., :head_dim]
+        if query_indices is not None:
+            return self.proj(x.permute(0, 2, 1, 3).reshape(B, query_indices.shape[1], -1))
+        x = x.reshape(B, self.num_heads, H, W, head_dim).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        x = self.proj(x)
+
+        return x
+
+
+class _CheckpointBlock(Block):
+    """Replaces a SAM encoder Block, same params, recomputes the block activations in backward
+    instead of keeping them. Submodules are shared, so later surgery like LoRA on attn.qkv applies.
+    """
+
+    def __init__(self, blk: Block):
+        nn.Module.__init__(self)
+        self.norm1 = blk.norm1
+        self.attn = blk.attn
+        self.norm2 = blk.norm2
+        self.mlp = blk.mlp
+        self.window_size = blk.window_size
+
+    def forward(self, x):
+        if self.training and torch.is_grad_enabled():
+            return checkpoint(super().forward, x, use_reentrant=False)
+        return super().forward(x)
+
+
+def _token_importance(blk, x, chunk_size=1024):
+    # Attention each token receives in blk, summed over heads and queries.
+    # Relative position bias is left out, it's a ranking only.
+    # x: [B, H, W, C] -> [B, H * W]
+    B, H, W, _ = x.shape
+    attn = blk.attn
+    q, k, _ = attn.qkv(blk.norm1(x)).reshape(B, H * W, 3, attn.num_heads, -1).permute(2, 0, 3, 1, 4).unbind(0)
+    q = q * attn.scale
+    importance = torch.zeros(B, H * W, dtype=x.dtype, device=x.device)
+    # query chunks keep the attention maps small
+    for start in range(0, H * W, chunk_size):
+        probs = (q[:, :, start:start + chunk_size] @ k.transpose(-2, -1)).softmax(dim=-1)
+        importance += probs.sum(dim=(1, 2))
+    return importance
+
+
+def _pruned_block_forward(blk, x, keep_indices, keep_mask):
+    # SAM encoder Block that updates the kept tokens only, the others pass through as they are.
+    # x: [B, H, W, C]
+    # keep_indices: [B, K] flat token indices
+    # keep_mask: [B, H, W] bool, same tokens
+    B, H, W, C = x.shape
+    shortcut = x.reshape(B, H * W, C)
+    x = blk.norm1(x)
+    if blk.window_size > 0:
+        # windows without kept tokens are skipped
+        x, pad_hw = window_partition(x, blk.window_size)
+        window_keep, _ = window_partition(keep_mask.unsqueeze(-1).to(x.dtype), blk.window_size)
+        active = window_keep.flatten(1).any(dim=1)
+        windows = torch.zeros_like(x)
+        windows[active] = blk.attn(x[active])
+        x = window_unpartition(windows, blk.window_size, pad_hw, (H, W)).reshape(B, H * W, C)
+        x = x.gather(1, keep_indices.unsqueeze(-1).expand(-1, -1, C))
+    else:
+        # kept queries against all keys
+        attn = blk.attn if isinstance(blk.attn, _SDPAAttention) else _SDPAAttention(blk.attn)
+        x = attn(x, query_indices=keep_indices)
+    # [B, K, C]
+    x = shortcut.gather(1, keep_indices.unsqueeze(-1).expand(-1, -1, C)) + x
+    x = x + blk.mlp(blk.norm2(x))
+    return shortcut.scatter(1, keep_indices.unsqueeze(-1).expand(-1, -1, C), x).view(B, H, W, C)
+
+
+def _low_res_map_decoder_forward(map_decoder, x, downsample):
+    # map_decoder upsamples 2x per ConvTranspose2d (kernel 2, stride 2). The last log2(downsample)
+    # of them run without upsampling, as 1x1 convs with the kernel averaged over its 2x2 outputs.
+    # For downsample 2 the logits are exactly the 2x2 average of the full resolution ones.
+    deconv_indices = [i for i, layer in enumerate(map_decoder) if isinstance(layer, nn.ConvTranspose2d)]
+    low_res_from = deconv_indices[len(deconv_indices) - int(math.log2(downsample))]
+    for i, layer in enumerate(map_decoder):
+        if i >= low_res_from and isinstance(layer, nn.ConvTranspose2d):
+            # [in, out, 2, 2] -> [out, in, 1, 1]
+            weight = layer.weight.mean(dim=(2, 3)).t()[:, :, None, None]
+            x = F.conv2d(x, weight, layer.bias)
+        else:
+            x = layer(x)
+    return x
+
+
+def _select_linear(linear, out_indices=None, in_indices=None):
+    # New nn.Linear with the given output rows / input columns of linear.
+    weight, bias = linear.weight, linear.bias
+    if out_indices is not None:
+        weight = weight[out_indices]
+        bias = bias[out_indices] if bias is not None else None
+    if in_indices is not None:
+        weight = weight[:, in_indices]
+    selected = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None, device=weight.device, dtype=weight.dtype)
+    with torch.no_grad():
+        selected.weight.copy_(weight)
+        if bias is not None:
+            selected.bias.copy_(bias)
+    return selected
+
+
+def _prune_encoder_block(blk, head_indices, mlp_indices):
+    # Keeps the given attention heads and MLP hidden channels of a SAM encoder Block, in place.
+    # head_indices, mlp_indices: 1D int64 tensors
+    attn = blk.attn
+    head_dim = attn.qkv.out_features // 3 // attn.num_heads
+    # qkv rows are [3, num_heads, head_dim], proj columns [num_heads, head_dim]
+    channels = (head_indices.view(-1, 1) * head_dim + torch.arange(head_dim, device=head_indices.device)).view(-1)
+    qkv_rows = torch.cat([channels + i * attn.num_heads * head_dim for i in range(3)])
+    attn.qkv = _select_linear(attn.qkv, out_indices=qkv_rows)
+    attn.proj = _select_linear(attn.proj, in_indices=channels)
+    # scale stays 1 / sqrt(head_dim)
+    attn.num_heads = len(head_indices)
+    blk.mlp.lin1 = _select_linear(blk.mlp.lin1, out_indices=mlp_indices)
+    blk.mlp.lin2 = _select_linear(blk.mlp.lin2, in_indices=mlp_indices)
+
+
+def _rot90_batch(x, rot_index):
+    # x: [B, H, W, ...], item i rotated CCW by rot_index[i] * 90 deg in (H, W), as np.rot90(x[i], k, [0, 1]).
+    # Square H, W. All rotations are computed and selected per item, without a host sync.
+    rot_index = rot_index.view((-1, ) + (1, ) * (x.dim() - 1))
+    rotated = x
+    for k in range(1, 4):
+        rotated = torch.where(rot_index == k, torch.rot90(x, k, [1, 2]), rotated)
+    return rotated
 
 
 class _LoRA_qkv(nn.Module):
@@ -174,7 +394,6 @@ class _LoRA_qkv(nn.Module):
         self.linear_a_v = linear_a_v
         self.linear_b_v = linear_b_v
         self.dim = qkv.in_features
-        self.w_identity = torch.eye(qkv.in_features)
 
     def forward(self, x):
         # qkv = self.qkv(x)  # B,N,N,3*org_C
@@ -185,16 +404,30 @@ class _LoRA_qkv(nn.Module):
         qkv[:, :, :, -self.dim:] += new_v
         return qkv
 
+    def merged_linear(self):
+        # Folds linear_b @ linear_a into the q and v rows of the frozen weight,
+        # returns a plain nn.Linear for inference.
+        qkv = nn.Linear(self.dim, self.weight.shape[0], bias=self.bias is not None)
+        with torch.no_grad():
+            weight = self.weight.detach().clone()
+            weight[: self.dim, :] += self.linear_b_q.weight @ self.linear_a_q.weight
+            weight[-self.dim:, :] += self.linear_b_v.weight @ self.linear_a_v.weight
+            qkv.weight.copy_(weight)
+            if self.bias is not None:
+                qkv.bias.copy_(self.bias)
+        return qkv.to(self.weight.device)
+
 
 
 class SAMRoad(pl.LightningModule):
     """This is the RelationFormer module that performs object detection"""
 
-    def __init__(self, config):
+    def __init__(self, config, load_sam_ckpt=True):
+        # load_sam_ckpt: set False when all weights come from a trained checkpoint anyway.
         super().__init__()
         self.config = config
 
-        assert config.SAM_VERSION in {'vit_b', 'vit_l', 'vit_h'}
+        assert config.SAM_VERSION in {'vit_b', 'vit_l', 'vit_h', 'vit_s'}
         if config.SAM_VERSION == 'vit_b':
             ### SAM config (B)
             encoder_embed_dim=768
@@ -216,6 +449,13 @@ class SAMRoad(pl.LightningModule):
             encoder_num_heads=16
             encoder_global_attn_indexes=[7, 15, 23, 31]
             ###
+        elif config.SAM_VERSION == 'vit_s':
+            ### Small student encoder, distilled from a trained model (DISTILL_TEACHER_CKPT), no SAM weights
+            encoder_embed_dim=384
+            encoder_depth=6
+            encoder_num_heads=6
+            encoder_global_attn_indexes=[2, 5]
+            ###
             
         prompt_embed_dim = 256
         # SAM default is 1024
@@ -223,12 +463,11 @@ class SAMRoad(pl.LightningModule):
         self.image_size = image_size
         vit_patch_size = 16
         image_embedding_size = image_size // vit_patch_size
+        # SAM uses 14, a divisor of the token grid (image_embedding_size) avoids padding in windowed blocks
+        window_size = config.ENCODER_WINDOW_SIZE or 14
 
         encoder_output_dim = prompt_embed_dim
 
-        self.register_buffer("pixel_mean", torch.Tensor([123.675, 116.28, 103.53]).view(-1, 1, 1), False)
-        self.register_buffer("pixel_std", torch.Tensor([58.395, 57.12, 57.375]).view(-1, 1, 1), False)
-
         if self.config.NO_SAM:
             # Only needed for the ablation experiment of using a ViT-B model without SA-1B pre-training.
             # It depends on detectron2 library. Not super important. 
@@ -253,9 +492,23 @@ class SAMRoad(pl.LightningModule):
                 qkv_bias=True,
                 use_rel_pos=True,
                 global_attn_indexes=encoder_global_attn_indexes,
-                window_size=14,
+                window_size=window_size,
                 out_chans=prompt_embed_dim
             )
+            # Encoder pruned by prune_encoder.py, heads and MLP dims kept per block.
+            if self.config.ENCODER_BLOCK_HEADS:
+                for blk, head_num, mlp_dim in zip(
+                        self.image_encoder.blocks, self.config.ENCODER_BLOCK_HEADS, self.config.ENCODER_BLOCK_MLP_DIMS):
+                    _prune_encoder_block(blk, torch.arange(head_num), torch.arange(mlp_dim))
+            if self.config.ENCODER_ATTN_BACKEND == 'sdpa':
+                for blk in self.image_encoder.blocks:
+                    blk.attn = _SDPAAttention(blk.attn)
+            # 0: off, k: checkpoint every k-th block, 1 for all blocks
+            if self.config.ENCODER_CHECKPOINT_EVERY:
+                self.image_encoder.blocks = nn.ModuleList([
+                    _CheckpointBlock(blk) if i % self.config.ENCODER_CHECKPOINT_EVERY == 0 else blk
+                    for i, blk in enumerate(self.image_encoder.blocks)
+                ])
 
         if self.config.USE_SAM_DECODER:
             # SAM DECODER
@@ -346,6 +599,13 @@ class SAMRoad(pl.LightningModule):
             for w_B in self.w_Bs:
                 nn.init.zeros_(w_B.weight)
 
+        if self.config.EMBEDDING_CACHE_DIR:
+            # cached embeddings are computed once with the SAM encoder weights
+            assert self.config.FREEZE_ENCODER and not self.config.ENCODER_LORA, \
+                'EMBEDDING_CACHE_DIR needs FREEZE_ENCODER and no ENCODER_LORA'
+            # the teacher needs the rgb crops, cached batches have none
+            assert not self.config.DISTILL_TEACHER_CKPT, 'EMBEDDING_CACHE_DIR can not be used with DISTILL_TEACHER_CKPT'
+
         #### Losses
         if self.config.FOCAL_LOSS:
             self.mask_criterion = partial(torchvision.ops.sigmoid_focal_loss, reduction='mean')
@@ -353,23 +613,21 @@ class SAMRoad(pl.LightningModule):
             self.mask_criterion = torch.nn.BCEWithLogitsLoss()
         self.topo_criterion = torch.nn.BCEWithLogitsLoss(reduction='none')
 
-        #### Metrics
-        self.keypoint_iou = BinaryJaccardIndex(threshold=0.5)
-        self.road_iou = BinaryJaccardIndex(threshold=0.5)
-        self.topo_f1 = F1Score(task='binary', threshold=0.5, ignore_index=-1)
-        # testing only, not used in training
-        self.keypoint_pr_curve = BinaryPrecisionRecallCurve(ignore_index=-1)
-        self.road_pr_curve = BinaryPrecisionRecallCurve(ignore_index=-1)
-        self.topo_pr_curve = BinaryPrecisionRecallCurve(ignore_index=-1)
+        self.init_non_persistent_state()
+        # Trained model the student encoder learns from, loaded in on_fit_start. In a list so it
+        # is left out of state_dict, optimizers and checkpoints.
+        self._distill_teacher = []
 
-        if self.config.NO_SAM:
+        if self.config.NO_SAM or not load_sam_ckpt or self.config.SAM_VERSION == 'vit_s':
+            self.matched_param_names = set()
             return
         with open(config.SAM_CKPT_PATH, "rb") as f:
             ckpt_state_dict = torch.load(f)
 
             ## Resize pos embeddings, if needed
-            if image_size != 1024:
-                new_state_dict = self.resize_sam_pos_embed(ckpt_state_dict, image_size, vit_patch_size, encoder_global_attn_indexes)
+            if image_size != 1024 or window_size != 14:
+                new_state_dict = self.resize_sam_pos_embed(
+                    ckpt_state_dict, image_size, vit_patch_size, encoder_global_attn_indexes, window_size)
                 ckpt_state_dict = new_state_dict
             
             matched_names = []
@@ -389,8 +647,57 @@ class SAMRoad(pl.LightningModule):
             self.matched_param_names = set(matched_names)
             self.load_state_dict(state_dict_to_load, strict=False)
 
-    def resize_sam_pos_embed(self, state_dict, image_size, vit_patch_size, encoder_global_attn_indexes):
+    @property
+    def distill_teacher(self):
+        return self._distill_teacher[0] if self._distill_teacher else None
+
+    def on_fit_start(self):
+        if not self.config.DISTILL_TEACHER_CKPT:
+            return
+        checkpoint = torch.load(self.config.DISTILL_TEACHER_CKPT, map_location="cpu", mmap=True)
+        # Exported checkpoints embed their config.
+        if self.config.DISTILL_TEACHER_CONFIG:
+            teacher_config = load_config(self.config.DISTILL_TEACHER_CONFIG)
+        else:
+            assert 'config' in checkpoint, 'DISTILL_TEACHER_CONFIG is required for training checkpoints'
+            teacher_config = Dict(checkpoint['config'])
+        assert teacher_config.PATCH_SIZE == self.config.PATCH_SIZE, 'teacher and student PATCH_SIZE differ'
+        # soft mask targets at the student's full resolution, whatever the teacher infers with
+        teacher_config = copy.deepcopy(teacher_config)
+        teacher_config.INFER_MASK_DOWNSAMPLE = 1
+        teacher = build_inference_model(teacher_config, checkpoint['state_dict'])
+        teacher.eval().requires_grad_(False)
+        self._distill_teacher = [teacher.to(self.device)]
+        print(f'##### Distilling from {self.config.DISTILL_TEACHER_CKPT} ({teacher_config.SAM_VERSION}) #####')
+
+    def init_non_persistent_state(self):
+        # Buffers and metrics that are not saved in checkpoints.
+        self.register_buffer("pixel_mean", torch.Tensor([123.675, 116.28, 103.53]).view(-1, 1, 1), False)
+        self.register_buffer("pixel_std", torch.Tensor([58.395, 57.12, 57.375]).view(-1, 1, 1), False)
+
+        #### Metrics
+        self.keypoint_iou = BinaryJaccardIndex(threshold=0.5)
+        self.road_iou = BinaryJaccardIndex(threshold=0.5)
+        self.topo_f1 = F1Score(task='binary', threshold=0.5, ignore_index=-1)
+        # testing only, not used in training
+        self.keypoint_pr_curve = BinaryPrecisionRecallCurve(ignore_index=-1)
+        self.road_pr_curve = BinaryPrecisionRecallCurve(ignore_index=-1)
+        self.topo_pr_curve = BinaryPrecisionRecallCurve(ignore_index=-1)
+        # testing only, topo precision / recall with and without the mask pre-filter
+        self.topo_prefilter_counts = defaultdict(int)
+
+    def merge_lora(self):
+        # Restores plain nn.Linear qkv in the encoder with LoRA weights folded in.
+        # The merged model matches a config with ENCODER_LORA: False.
+        for blk in self.image_encoder.blocks:
+            if isinstance(blk.attn.qkv, _LoRA_qkv):
+                blk.attn.qkv = blk.attn.qkv.merged_linear()
+        self.w_As, self.w_Bs = [], []
+
+    def resize_sam_pos_embed(self, state_dict, image_size, vit_patch_size, encoder_global_attn_indexes, window_size=14):
         new_state_dict = {k : v for k, v in state_dict.items()}
+        rel_pos_keys = [k for k in state_dict.keys() if 'rel_pos' in k]
+        global_rel_pos_keys = [k for k in rel_pos_keys if any([f'blocks.{i}.' in k for i in encoder_global_attn_indexes])]
         pos_embed = new_state_dict['image_encoder.pos_embed']
         token_size = int(image_size // vit_patch_size)
         if pos_embed.shape[1] != token_size:
@@ -400,28 +707,74 @@ class SAMRoad(pl.LightningModule):
             pos_embed = F.interpolate(pos_embed, (token_size, token_size), mode='bilinear', align_corners=False)
             pos_embed = pos_embed.permute(0, 2, 3, 1)  # [b, h, w, c]
             new_state_dict['image_encoder.pos_embed'] = pos_embed
-            rel_pos_keys = [k for k in state_dict.keys() if 'rel_pos' in k]
-            global_rel_pos_keys = [k for k in rel_pos_keys if any([str(i) in k for i in encoder_global_attn_indexes])]
             for k in global_rel_pos_keys:
                 rel_pos_params = new_state_dict[k]
                 h, w = rel_pos_params.shape
                 rel_pos_params = rel_pos_params.unsqueeze(0).unsqueeze(0)
                 rel_pos_params = F.interpolate(rel_pos_params, (token_size * 2 - 1, w), mode='bilinear', align_corners=False)
                 new_state_dict[k] = rel_pos_params[0, 0, ...]
+        # windowed blocks, same for a window size other than SAM's 14
+        for k in rel_pos_keys:
+            if k in global_rel_pos_keys or new_state_dict[k].shape[0] == window_size * 2 - 1:
+                continue
+            rel_pos_params = new_state_dict[k]
+            h, w = rel_pos_params.shape
+            rel_pos_params = rel_pos_params.unsqueeze(0).unsqueeze(0)
+            rel_pos_params = F.interpolate(rel_pos_params, (window_size * 2 - 1, w), mode='bilinear', align_corners=False)
+            new_state_dict[k] = rel_pos_params[0, 0, ...]
         return new_state_dict
 
     
-    def forward(self, rgb, graph_points, pairs, valid):
+    def encode(self, rgb):
+        # rgb: [B, H, W, C] 0-255
+        x = rgb.permute(0, 3, 1, 2)
+        # [B, C, H, W]
+        x = (x - self.pixel_mean) / self.pixel_std
+        keep_ratio = self.config.TOKEN_PRUNE_KEEP_RATIO
+        if keep_ratio and keep_ratio < 1.0 and not self.training:
+            return self.encode_pruned(x, keep_ratio)
+        # [B, D, h, w]
+        return self.image_encoder(x)
+
+    def encode_pruned(self, x, keep_ratio):
+        # Inference only. After block TOKEN_PRUNE_AFTER_BLOCK, only the keep_ratio of tokens the
+        # next block attends to most are updated, the others keep their features. Tokens stay on
+        # the dense grid, so the neck and decoders see the usual shapes.
+        # x: [B, C, H, W] normalized
+        encoder = self.image_encoder
+        prune_after = self.config.TOKEN_PRUNE_AFTER_BLOCK
+        assert 0 <= prune_after < len(encoder.blocks) - 1
+        x = encoder.patch_embed(x)
+        if encoder.pos_embed is not None:
+            x = x + encoder.pos_embed
+        for blk in encoder.blocks[:prune_after + 1]:
+            x = blk(x)
+
+        B, H, W, _ = x.shape
+        keep_num = max(1, round(H * W * keep_ratio))
+        importance = _token_importance(encoder.blocks[prune_after + 1], x)
+        # [B, K]
+        keep_indices = importance.topk(keep_num, dim=-1).indices
+        keep_mask = torch.zeros(B, H * W, dtype=torch.bool, device=x.device)
+        keep_mask = keep_mask.scatter(1, keep_indices, True).view(B, H, W)
+        for blk in encoder.blocks[prune_after + 1:]:
+            x = _pruned_block_forward(blk, x, keep_indices, keep_mask)
+        # [B, D, h, w]
+        return encoder.neck(x.permute(0, 3, 1, 2))
+
+    def forward(self, rgb, graph_points, pairs, valid, image_embeddings=None):
         # rgb: [B, H, W, C]
         # graph_points: [B, N_points, 2]
         # pairs: [B, N_samples, N_pairs, 2]
         # valid: [B, N_samples, N_pairs]
+        # image_embeddings: [B, D, h, w], precomputed encoder output, rgb is not used if given
 
-        x = rgb.permute(0, 3, 1, 2)
-        # [B, C, H, W]
-        x = (x - self.pixel_mean) / self.pixel_std
-        # [B, D, h, w]
-        image_embeddings = self.image_encoder(x)
+        if image_embeddings is None:
+            # [B, D, h, w]
+            image_embeddings = self.encode(rgb)
+        else:
+            # cached in fp16
+            image_embeddings = image_embeddings.to(self.pixel_mean.dtype)
         # mask_logits, mask_scores: [B, 2, H, W]
         if self.config.USE_SAM_DECODER:
             sparse_embeddings, dense_embeddings = self.prompt_encoder(
@@ -461,12 +814,13 @@ class SAMRoad(pl.LightningModule):
         # graph_points: [B, N_points, 2]
         # pairs: [B, N_samples, N_pairs, 2]
         # valid: [B, N_samples, N_pairs]
+        # Masks are [B, H / d, W / d, 2] with d = INFER_MASK_DOWNSAMPLE (1, 2 or 4).
 
-        x = rgb.permute(0, 3, 1, 2)
-        # [B, C, H, W]
-        x = (x - self.pixel_mean) / self.pixel_std
+        downsample = self.config.INFER_MASK_DOWNSAMPLE or 1
+        assert downsample in {1, 2, 4}
+        mask_size = self.image_encoder.img_size // downsample
         # [B, D, h, w]
-        image_embeddings = self.image_encoder(x)
+        image_embeddings = self.encode(rgb)
         # mask_logits, mask_scores: [B, 2, H, W]
         if self.config.USE_SAM_DECODER:
             sparse_embeddings, dense_embeddings = self.prompt_encoder(
@@ -481,11 +835,14 @@ class SAMRoad(pl.LightningModule):
             )
             mask_logits = F.interpolate(
                 low_res_logits,
-                (self.image_encoder.img_size, self.image_encoder.img_size),
+                (mask_size, mask_size),
                 mode="bilinear",
                 align_corners=False,
             )
             mask_scores = torch.sigmoid(mask_logits)
+        elif downsample > 1:
+            mask_logits = _low_res_map_decoder_forward(self.map_decoder, image_embeddings, downsample)
+            mask_scores = torch.sigmoid(mask_logits)
         else:
             mask_logits = self.map_decoder(image_embeddings)
             mask_scores = torch.sigmoid(mask_logits)
@@ -494,6 +851,12 @@ class SAMRoad(pl.LightningModule):
         mask_scores = mask_scores.permute(0, 2, 3, 1)
         return mask_scores, image_embeddings
     
+    def infer_masks(self, rgb):
+        # rgb: [B, H, W, C]
+        # Mask-only inference, image embeddings are not kept.
+        mask_scores, _ = self.infer_masks_and_img_features(rgb)
+        return mask_scores
+
 
     def infer_toponet(self, image_embeddings, graph_points, pairs, valid):
         # image_embeddings: [B, D, h, w]
@@ -508,13 +871,34 @@ class SAMRoad(pl.LightningModule):
         return topo_scores
 
 
+    def prepare_batch(self, batch):
+        # SatMapDataset batches carry uint8 crops and masks as cut from the tile, plus the CCW
+        # rotation (rot_index) their graph labels were sampled with. Rotates, binarizes and
+        # converts them to float on the device.
+        prepared = dict(batch)
+        rot_index = batch['rot_index']
+        if 'rgb' in batch:
+            # [B, H, W, C] 0-255
+            prepared['rgb'] = _rot90_batch(batch['rgb'], rot_index).to(self.pixel_mean.dtype)
+        for key in ['keypoint_mask', 'road_mask']:
+            # [B, H, W] 0-1
+            prepared[key] = (_rot90_batch(batch[key], rot_index) >= 128).to(torch.float32)
+        return prepared
+
     def training_step(self, batch, batch_idx):
+        batch = self.prepare_batch(batch)
         # masks: [B, H, W]
-        rgb, keypoint_mask, road_mask = batch['rgb'], batch['keypoint_mask'], batch['road_mask']
+        keypoint_mask, road_mask = batch['keypoint_mask'], batch['road_mask']
         graph_points, pairs, valid = batch['graph_points'], batch['pairs'], batch['valid']
+        # batches from the embedding cache carry image_embeddings instead of rgb
+        rgb, image_embeddings = batch.get('rgb'), batch.get('image_embeddings')
+        if self.distill_teacher is not None:
+            # student embeddings are needed for the distillation loss
+            image_embeddings = self.encode(rgb)
 
         # [B, H, W, 2]
-        mask_logits, mask_scores, topo_logits, topo_scores = self(rgb, graph_points, pairs, valid)
+        mask_logits, mask_scores, topo_logits, topo_scores = self(
+            rgb, graph_points, pairs, valid, image_embeddings=image_embeddings)
 
         gt_masks = torch.stack([keypoint_mask, road_mask], dim=3)
         mask_loss = self.mask_criterion(mask_logits, gt_masks)
@@ -538,6 +922,16 @@ class SAMRoad(pl.LightningModule):
         topo_loss = topo_loss.sum() / topo_loss_mask.sum()
 
         loss = mask_loss + topo_loss
+        if self.distill_teacher is not None:
+            with torch.no_grad():
+                teacher_mask_scores, teacher_embeddings = self.distill_teacher.infer_masks_and_img_features(rgb)
+            # teacher scores as soft targets
+            distill_mask_loss = F.binary_cross_entropy_with_logits(mask_logits, teacher_mask_scores)
+            distill_embedding_loss = F.mse_loss(image_embeddings, teacher_embeddings)
+            loss = loss + (self.config.DISTILL_MASK_WEIGHT * distill_mask_loss
+                           + self.config.DISTILL_EMBEDDING_WEIGHT * distill_embedding_loss)
+            self.log('train_distill_mask_loss', distill_mask_loss, on_step=True, on_epoch=False, prog_bar=True)
+            self.log('train_distill_embedding_loss', distill_embedding_loss, on_step=True, on_epoch=False, prog_bar=True)
         self.log('train_mask_loss', mask_loss, on_step=True, on_epoch=False, prog_bar=True)
         self.log('train_topo_loss', topo_loss, on_step=True, on_epoch=False, prog_bar=True)
         self.log('train_loss', loss, on_step=True, on_epoch=False, prog_bar=True)
@@ -545,6 +939,7 @@ class SAMRoad(pl.LightningModule):
 
 
     def validation_step(self, batch, batch_idx):
+        batch = self.prepare_batch(batch)
         # masks: [B, H, W]
         rgb, keypoint_mask, road_mask = batch['rgb'], batch['keypoint_mask'], batch['road_mask']
         graph_points, pairs, valid = batch['graph_points'], batch['pairs'], batch['valid']
@@ -600,6 +995,7 @@ class SAMRoad(pl.LightningModule):
         self.topo_f1.reset()
 
     def test_step(self, batch, batch_idx):
+        batch = self.prepare_batch(batch)
         # masks: [B, H, W]
         rgb, keypoint_mask, road_mask = batch['rgb'], batch['keypoint_mask'], batch['road_mask']
         graph_points, pairs, valid = batch['graph_points'], batch['pairs'], batch['valid']
@@ -612,10 +1008,43 @@ class SAMRoad(pl.LightningModule):
         self.keypoint_pr_curve.update(mask_scores[..., 0], keypoint_mask.to(torch.int32))
         self.road_pr_curve.update(mask_scores[..., 1], road_mask.to(torch.int32))
         
+        if self.config.TOPO_PREFILTER:
+            self.update_topo_prefilter_counts(mask_scores[..., 1], graph_points, pairs, valid, topo_scores, topo_gt)
+
         valid = valid.to(torch.int32)
         topo_gt = (1 - valid) * -1 + valid * topo_gt
         self.topo_pr_curve.update(topo_scores, topo_gt.unsqueeze(-1).to(torch.int32))
 
+    def update_topo_prefilter_counts(self, road_scores, graph_points, pairs, valid, topo_scores, topo_gt):
+        # Counts topo TP / FP / FN at TOPO_THRESHOLD, with and without the inference-time
+        # mask pre-filter (graph_utils.prefilter_pairs_by_mask) applied to the predicted road mask.
+        road_masks = (road_scores * 255).to(torch.uint8).cpu().numpy()
+        graph_points = graph_points.cpu().numpy()
+        pairs = pairs.cpu().numpy()
+        valid = valid.cpu().numpy()
+        pred = (topo_scores[..., 0] > self.config.TOPO_THRESHOLD).cpu().numpy()
+        gt = topo_gt.cpu().numpy() > 0
+        # knn results are sorted by distance
+        is_nearest = np.zeros_like(valid)
+        is_nearest[:, :, 0] = True
+        for i in range(valid.shape[0]):
+            # [N_valid, 2]
+            valid_pairs = pairs[i][valid[i]]
+            decisions = graph_utils.prefilter_pairs_by_mask(
+                road_masks[i], graph_points[i][valid_pairs[:, 0]], graph_points[i][valid_pairs[:, 1]],
+                road_threshold=self.config.ROAD_THRESHOLD,
+                off_road_ratio=self.config.TOPO_PREFILTER_OFF_ROAD_RATIO,
+                on_road_threshold=self.config.TOPO_PREFILTER_ON_ROAD_THRESHOLD,
+                is_nearest=is_nearest[i][valid[i]])
+            item_pred, item_gt = pred[i][valid[i]], gt[i][valid[i]]
+            filtered_pred = np.where(decisions >= 0, decisions == 1, item_pred)
+            for name, p in (('baseline', item_pred), ('prefilter', filtered_pred)):
+                self.topo_prefilter_counts[f'{name}_tp'] += int(np.sum(p & item_gt))
+                self.topo_prefilter_counts[f'{name}_fp'] += int(np.sum(p & ~item_gt))
+                self.topo_prefilter_counts[f'{name}_fn'] += int(np.sum(~p & item_gt))
+            self.topo_prefilter_counts['queries'] += int(decisions.shape[0])
+            self.topo_prefilter_counts['skipped'] += int(np.sum(decisions >= 0))
+
     def on_test_end(self):
         def find_best_threshold(pr_curve_metric, category):
             print(f'======= {category} ======')   
@@ -633,11 +1062,26 @@ class SAMRoad(pl.LightningModule):
         find_best_threshold(self.road_pr_curve, 'road')
         find_best_threshold(self.topo_pr_curve, 'topo')
 
+        if self.config.TOPO_PREFILTER:
+            counts = self.topo_prefilter_counts
+            print('======= topo mask pre-filter ======')
+            print(f'Skipped {counts["skipped"] / max(counts["queries"], 1)} of {counts["queries"]} queries')
+            for name in ('baseline', 'prefilter'):
+                tp, fp, fn = counts[f'{name}_tp'], counts[f'{name}_fp'], counts[f'{name}_fn']
+                print(f'{name} at threshold {self.config.TOPO_THRESHOLD}: P={tp / max(tp + fp, 1)} R={tp / max(tp + fn, 1)}')
+
 
     def configure_optimizers(self):
         param_dicts = []
 
-        if not self.config.FREEZE_ENCODER and not self.config.ENCODER_LORA:
+        if self.config.SAM_VERSION == 'vit_s':
+            # student encoder is trained from scratch
+            encoder_params = {
+                'params': [p for p in self.image_encoder.parameters()],
+                'lr': self.config.BASE_LR,
+            }
+            param_dicts.append(encoder_params)
+        elif not self.config.FREEZE_ENCODER and not self.config.ENCODER_LORA:
             encoder_params = {
                 'params': [p for k, p in self.image_encoder.named_parameters() if 'image_encoder.'+k in self.matched_param_names],
                 'lr': self.config.BASE_LR * self.config.ENCODER_LR_FACTOR,
@@ -684,3 +1128,304 @@ class SAMRoad(pl.LightningModule):
         step_lr = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=[9,], gamma=0.1)
         return {'optimizer': optimizer, 'lr_scheduler': step_lr}
 
+
+
+def build_inference_model(config, state_dict):
+    """
+    Builds SAMRoad from a trained state_dict without the SAM checkpoint load and random init.
+
+    Modules are created on the meta device and take the state_dict tensors as they are
+    (assign=True), so a float32 state_dict from torch.load(..., mmap=True) is only paged in when used.
+    """
+    with torch.device('meta'):
+        net = SAMRoad(config, load_sam_ckpt=False)
+    net.load_state_dict(state_dict, strict=True, assign=True)
+    # Exported checkpoints may store fp16 / bf16 weights, the model runs in float32.
+    net.float()
+    with torch.device('cpu'):
+        net.init_non_persistent_state()
+    meta_names = [k for k, v in list(net.named_parameters()) + list(net.named_buffers()) if v.is_meta]
+    assert len(meta_names) == 0, f'not loaded from the state_dict: {meta_names}'
+    return net
+
+
+##### Unit tests #####
+class TestModel(unittest.TestCase):
+    def test_merge_lora_qkv(self):
+        dim, r = 32, 4
+        qkv = nn.Linear(dim, dim * 3, bias=True)
+        lora_qkv = _LoRA_qkv(
+            qkv, nn.Linear(dim, r, bias=False), nn.Linear(r, dim, bias=False),
+            nn.Linear(dim, r, bias=False), nn.Linear(r, dim, bias=False))
+        # trained LoRA, B is not zero anymore
+        nn.init.normal_(lora_qkv.linear_b_q.weight)
+        nn.init.normal_(lora_qkv.linear_b_v.weight)
+        merged = lora_qkv.merged_linear()
+        self.assertIsInstance(merged, nn.Linear)
+        x = torch.randn(2, 7, 7, dim)
+        with torch.no_grad():
+            torch.testing.assert_close(merged(x), lora_qkv(x), rtol=1e-4, atol=1e-4)
+
+    def test_forward_from_cached_embeddings(self):
+        config = Dict({
+            'SAM_VERSION': 'vit_b', 'PATCH_SIZE': 64, 'NO_SAM': False, 'USE_SAM_DECODER': False,
+            'ENCODER_LORA': False, 'FOCAL_LOSS': False, 'TOPONET_VERSION': 'normal',
+            'FREEZE_ENCODER': True, 'EMBEDDING_CACHE_DIR': 'unused',
+        })
+        net = SAMRoad(config, load_sam_ckpt=False).eval()
+        rgb = torch.rand(2, 64, 64, 3) * 255.0
+        points = torch.rand(2, 8, 2) * 64
+        pairs = torch.randint(0, 8, (2, 8, 4, 2))
+        valid = torch.rand(2, 8, 4) > 0.5
+        with torch.no_grad():
+            _, embeddings = net.infer_masks_and_img_features(rgb)
+            outputs = net(rgb, points, pairs, valid)
+            cached_outputs = net(None, points, pairs, valid, image_embeddings=embeddings.to(torch.float16))
+        for cached_output, output in zip(cached_outputs, outputs):
+            # fp16 storage
+            torch.testing.assert_close(cached_output, output, rtol=1e-2, atol=1e-2)
+
+    def test_prepare_batch(self):
+        config = Dict({
+            'SAM_VERSION': 'vit_s', 'PATCH_SIZE': 64, 'NO_SAM': False, 'USE_SAM_DECODER': False,
+            'ENCODER_LORA': False, 'FOCAL_LOSS': False, 'TOPONET_VERSION': 'normal',
+        })
+        net = SAMRoad(config, load_sam_ckpt=False)
+        rgb = np.random.randint(0, 256, size=(4, 64, 64, 3), dtype=np.uint8)
+        road_mask = np.random.randint(0, 256, size=(4, 64, 64), dtype=np.uint8)
+        rot_index = np.array([0, 1, 2, 3])
+        batch = net.prepare_batch({
+            'rgb': torch.from_numpy(rgb), 'keypoint_mask': torch.from_numpy(road_mask),
+            'road_mask': torch.from_numpy(road_mask), 'rot_index': torch.from_numpy(rot_index),
+        })
+        # as SatMapDataset used to on the CPU
+        for i, k in enumerate(rot_index):
+            np.testing.assert_array_equal(batch['rgb'][i].numpy(), np.rot90(rgb[i], k, [0, 1]).astype(np.float32))
+            np.testing.assert_array_equal(
+                batch['road_mask'][i].numpy(), np.round(np.rot90(road_mask[i], k, [0, 1]).astype(np.float32) / 255.0))
+
+    def test_encoder_importance_after_merge_lora(self):
+        from prune_encoder import encoder_importance
+        config = Dict({
+            'SAM_VERSION': 'vit_s', 'PATCH_SIZE': 64, 'NO_SAM': False, 'USE_SAM_DECODER': False,
+            'ENCODER_LORA': True, 'LORA_RANK': 4, 'FOCAL_LOSS': False, 'TOPONET_VERSION': 'normal',
+        })
+        net = SAMRoad(config, load_sam_ckpt=False)
+        net.merge_lora()
+        batch = {
+            'rgb': torch.randint(0, 256, (2, 64, 64, 3), dtype=torch.uint8),
+            'keypoint_mask': torch.randint(0, 256, (2, 64, 64), dtype=torch.uint8),
+            'road_mask': torch.randint(0, 256, (2, 64, 64), dtype=torch.uint8),
+            'rot_index': torch.tensor([0, 1]),
+            'graph_points': torch.rand(2, 8, 2) * 64,
+            'pairs': torch.randint(0, 8, (2, 8, 4, 2)),
+            'connected': torch.rand(2, 8, 4) > 0.5,
+            'valid': torch.ones(2, 8, 4, dtype=torch.bool),
+        }
+        head_scores, mlp_scores = encoder_importance(net, [batch], 1, torch.device('cpu'))
+        self.assertEqual(len(head_scores), len(net.image_encoder.blocks))
+        for head_score, mlp_score in zip(head_scores, mlp_scores):
+            self.assertTrue((head_score > 0).all())
+            self.assertTrue((mlp_score > 0).all())
+
+    def test_student_encoder(self):
+        config = Dict({
+            'SAM_VERSION': 'vit_s', 'PATCH_SIZE': 64, 'NO_SAM': False, 'USE_SAM_DECODER': False,
+            'ENCODER_LORA': False, 'FOCAL_LOSS': False, 'TOPONET_VERSION': 'normal',
+        })
+        # no SAM ckpt for the student
+        net = SAMRoad(config).eval()
+        self.assertEqual(len(net.image_encoder.blocks), 6)
+        with torch.no_grad():
+            masks, features = net.infer_masks_and_img_features(torch.rand(1, 64, 64, 3) * 255.0)
+        self.assertEqual(masks.shape, (1, 64, 64, 2))
+        self.assertEqual(features.shape, (1, 256, 4, 4))
+
+    def test_distill_teacher_full_res_masks(self):
+        import os
+        import tempfile
+        config = Dict({
+            'SAM_VERSION': 'vit_s', 'PATCH_SIZE': 64, 'NO_SAM': False, 'USE_SAM_DECODER': False,
+            'ENCODER_LORA': False, 'FOCAL_LOSS': False, 'TOPONET_VERSION': 'normal',
+        })
+        teacher_config = copy.deepcopy(config)
+        # an inference setting of the teacher
+        teacher_config.INFER_MASK_DOWNSAMPLE = 2
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ckpt_path = os.path.join(tmp_dir, 'teacher.ckpt')
+            torch.save({'config': teacher_config.to_dict(), 'state_dict': SAMRoad(teacher_config).state_dict()}, ckpt_path)
+            student_config = copy.deepcopy(config)
+            student_config.DISTILL_TEACHER_CKPT = ckpt_path
+            net = SAMRoad(student_config)
+            net.on_fit_start()
+        with torch.no_grad():
+            teacher_mask_scores, _ = net.distill_teacher.infer_masks_and_img_features(torch.rand(1, 64, 64, 3) * 255.0)
+        self.assertEqual(teacher_mask_scores.shape, (1, 64, 64, 2))
+
+    def test_encode_pruned(self):
+        config = Dict({
+            'SAM_VERSION': 'vit_s', 'PATCH_SIZE': 256, 'NO_SAM': False, 'USE_SAM_DECODER': False,
+            'ENCODER_LORA': False, 'FOCAL_LOSS': False, 'TOPONET_VERSION': 'normal',
+            'TOKEN_PRUNE_AFTER_BLOCK': 1,
+        })
+        net = SAMRoad(config, load_sam_ckpt=False).eval()
+        for blk in net.image_encoder.blocks:
+            nn.init.normal_(blk.attn.rel_pos_h)
+            nn.init.normal_(blk.attn.rel_pos_w)
+        x = torch.randn(2, 3, 256, 256)
+        with torch.no_grad():
+            ref = net.image_encoder(x)
+            # all tokens kept, windowed and global blocks through the pruned path
+            torch.testing.assert_close(net.encode_pruned(x, 1.0), ref, rtol=1e-4, atol=1e-4)
+            self.assertEqual(net.encode_pruned(x, 0.25).shape, ref.shape)
+
+    def test_low_res_map_decoder(self):
+        config = Dict({
+            'SAM_VERSION': 'vit_s', 'PATCH_SIZE': 64, 'NO_SAM': False, 'USE_SAM_DECODER': False,
+            'ENCODER_LORA': False, 'FOCAL_LOSS': False, 'TOPONET_VERSION': 'normal',
+        })
+        net = SAMRoad(config, load_sam_ckpt=False).eval()
+        embeddings = torch.randn(2, 256, 4, 4)
+        with torch.no_grad():
+            logits = net.map_decoder(embeddings)
+            half_logits = _low_res_map_decoder_forward(net.map_decoder, embeddings, 2)
+            quarter_logits = _low_res_map_decoder_forward(net.map_decoder, embeddings, 4)
+        torch.testing.assert_close(half_logits, F.avg_pool2d(logits, 2), rtol=1e-4, atol=1e-5)
+        self.assertEqual(quarter_logits.shape, (2, 2, 16, 16))
+        net.config.INFER_MASK_DOWNSAMPLE = 4
+        with torch.no_grad():
+            masks, _ = net.infer_masks_and_img_features(torch.rand(1, 64, 64, 3) * 255.0)
+        self.assertEqual(masks.shape, (1, 16, 16, 2))
+
+    def test_resize_window_rel_pos(self):
+        config = Dict({
+            'SAM_VERSION': 'vit_b', 'PATCH_SIZE': 512, 'NO_SAM': False, 'USE_SAM_DECODER': False,
+            'ENCODER_LORA': False, 'FOCAL_LOSS': False, 'TOPONET_VERSION': 'normal', 'ENCODER_WINDOW_SIZE': 16,
+        })
+        with torch.device('meta'):
+            net = SAMRoad(config, load_sam_ckpt=False)
+        # SAM vit_b shapes at 1024
+        sam_state_dict = {'image_encoder.pos_embed': torch.zeros(1, 64, 64, 768)}
+        for i in range(12):
+            size = 127 if i in [2, 5, 8, 11] else 27
+            sam_state_dict[f'image_encoder.blocks.{i}.attn.rel_pos_h'] = torch.zeros(size, 64)
+            sam_state_dict[f'image_encoder.blocks.{i}.attn.rel_pos_w'] = torch.zeros(size, 64)
+        resized = net.resize_sam_pos_embed(sam_state_dict, 512, 16, [2, 5, 8, 11], window_size=16)
+        model_state_dict = net.state_dict()
+        for k, v in resized.items():
+            self.assertEqual(v.shape, model_state_dict[k].shape, k)
+
+    def test_prune_encoder_block(self):
+        blk = Block(64, num_heads=4, qkv_bias=True, use_rel_pos=True, input_size=(8, 8))
+        x = torch.randn(2, 8, 8, 64)
+        # zero out head 1 and MLP channels 10+, pruning them keeps the outputs
+        head_dim = 16
+        with torch.no_grad():
+            blk.attn.proj.weight[:, head_dim:2 * head_dim] = 0.0
+            blk.mlp.lin2.weight[:, 10:] = 0.0
+            ref = blk(x)
+            _prune_encoder_block(blk, torch.tensor([0, 2, 3]), torch.arange(10))
+            torch.testing.assert_close(blk(x), ref, rtol=1e-4, atol=1e-5)
+        self.assertEqual(blk.attn.num_heads, 3)
+        self.assertEqual(blk.attn.qkv.out_features, 3 * 3 * head_dim)
+        self.assertEqual(blk.mlp.lin1.out_features, 10)
+
+    def test_build_inference_model(self):
+        config = Dict({
+            'SAM_VERSION': 'vit_b', 'PATCH_SIZE': 64, 'NO_SAM': False, 'USE_SAM_DECODER': False,
+            'ENCODER_LORA': False, 'FOCAL_LOSS': False, 'TOPONET_VERSION': 'normal',
+        })
+        net = SAMRoad(config, load_sam_ckpt=False).eval()
+        fast_net = build_inference_model(config, net.state_dict()).eval()
+        rgb = torch.rand(1, 64, 64, 3) * 255.0
+        with torch.no_grad():
+            masks, features = net.infer_masks_and_img_features(rgb)
+            fast_masks, fast_features = fast_net.infer_masks_and_img_features(rgb)
+        torch.testing.assert_close(fast_masks, masks)
+        torch.testing.assert_close(fast_features, features)
+
+    def test_toponet_packed_attn(self):
+        config = Dict({'TOPONET_VERSION': 'normal'})
+        net = TopoNet(config, feature_dim=32).eval()
+        packed_net = copy.deepcopy(net)
+        packed_net.config = Dict({'TOPONET_VERSION': 'normal', 'TOPONET_PACKED_ATTN': True})
+        batch_size, n_points, n_samples, n_pairs = 2, 20, 6, 8
+        points = torch.rand(batch_size, n_points, 2) * 256
+        point_features = torch.randn(batch_size, n_points, 32)
+        pairs = torch.randint(0, n_points, (batch_size, n_samples, n_pairs, 2))
+        valid = torch.rand(batch_size, n_samples, n_pairs) > 0.5
+        # a sample without valid pairs and a sample with all pairs valid
+        valid[0, 0] = False
+        valid[1, 0] = True
+        for grad_enabled in [False, True]:
+            with torch.set_grad_enabled(grad_enabled):
+                _, scores = net(points, point_features, pairs, valid)
+                _, packed_scores = packed_net(points, point_features, pairs, valid)
+            self.assertEqual(packed_scores.shape, (batch_size, n_samples, n_pairs, 1))
+            n_out_pairs = scores.shape[2]
+            torch.testing.assert_close(
+                packed_scores[:, :, :n_out_pairs][valid[:, :, :n_out_pairs]], scores[valid[:, :, :n_out_pairs]])
+
+    def test_toponet_pair_features(self):
+        batch_size, n_points, n_samples, n_pairs = 2, 20, 6, 8
+        points = torch.rand(batch_size, n_points, 2) * 256
+        point_features = torch.randn(batch_size, n_points, 32)
+        pairs = torch.randint(0, n_points, (batch_size, n_samples, n_pairs, 2))
+        valid = torch.ones(batch_size, n_samples, n_pairs, dtype=torch.bool)
+        for version in ['normal', 'no_offset', 'no_transformer']:
+            net = TopoNet(Dict({'TOPONET_VERSION': version}), feature_dim=32).eval()
+            # reference: gathers and concats pair features, then projects
+            projected = F.relu(net.feature_proj(point_features))
+            batch_indices = torch.arange(batch_size).view(-1, 1).expand(-1, n_samples * n_pairs)
+            flat_pairs = pairs.view(batch_size, -1, 2)
+            offset = points[batch_indices, flat_pairs[:, :, 1]] - points[batch_indices, flat_pairs[:, :, 0]]
+            if version == 'no_offset':
+                offset = torch.zeros_like(offset)
+            pair_features = F.relu(net.pair_proj(torch.concat([
+                projected[batch_indices, flat_pairs[:, :, 0]], projected[batch_indices, flat_pairs[:, :, 1]], offset], dim=2)))
+            pair_features = pair_features.view(batch_size * n_samples, n_pairs, -1)
+            if version != 'no_transformer':
+                pair_features = net.transformer_encoder(pair_features)
+            ref_logits = net.output_proj(pair_features).view(batch_size, n_samples, n_pairs, 1)
+            with torch.no_grad():
+                logits, _ = net(points, point_features, pairs, valid)
+            torch.testing.assert_close(logits, ref_logits.detach(), rtol=1e-4, atol=1e-4)
+
+    def test_sdpa_attention(self):
+        from segment_anything.modeling.image_encoder import Attention
+        # windowed and global attention sizes
+        for size in [(14, 14), (16, 16)]:
+            attn = Attention(64, num_heads=4, qkv_bias=True, use_rel_pos=True, input_size=size)
+            nn.init.normal_(attn.rel_pos_h)
+            nn.init.normal_(attn.rel_pos_w)
+            sdpa_attn = _SDPAAttention(attn)
+            x = torch.randn(2, size[0], size[1], 64, requires_grad=True)
+            out = attn(x)
+            grad, = torch.autograd.grad(out.sum(), x)
+            sdpa_out = sdpa_attn(x)
+            sdpa_grad, = torch.autograd.grad(sdpa_out.sum(), x)
+            torch.testing.assert_close(sdpa_out, out, rtol=1e-4, atol=1e-4)
+            torch.testing.assert_close(sdpa_grad, grad, rtol=1e-4, atol=1e-4)
+
+    def test_checkpoint_block(self):
+        # LoRA wrapped qkv, applied after the checkpoint wrapper as in SAMRoad
+        blk = Block(64, num_heads=4, qkv_bias=True, use_rel_pos=True, window_size=7, input_size=(14, 14))
+        checkpoint_blk = _CheckpointBlock(copy.deepcopy(blk))
+        for b in [blk, checkpoint_blk]:
+            torch.manual_seed(0)
+            b.attn.qkv = _LoRA_qkv(
+                b.attn.qkv, nn.Linear(64, 4, bias=False), nn.Linear(4, 64, bias=False),
+                nn.Linear(64, 4, bias=False), nn.Linear(4, 64, bias=False))
+        self.assertEqual(blk.state_dict().keys(), checkpoint_blk.state_dict().keys())
+        x = torch.randn(2, 14, 14, 64, requires_grad=True)
+        out = blk(x)
+        grads = torch.autograd.grad(out.sum(), [x, blk.attn.qkv.linear_a_q.weight])
+        checkpoint_out = checkpoint_blk(x)
+        checkpoint_grads = torch.autograd.grad(checkpoint_out.sum(), [x, checkpoint_blk.attn.qkv.linear_a_q.weight])
+        torch.testing.assert_close(checkpoint_out, out)
+        for checkpoint_grad, grad in zip(checkpoint_grads, grads):
+            torch.testing.assert_close(checkpoint_grad, grad)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+from argparse import ArgumentParser
+import copy
+import json
+import os
+
+import numpy as np
+
+from utils import load_config
+from dataset import dataset_split, load_tiles
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--config", default=None, help="training config, PACKED_DATA_DIR is where the packed arrays are written."
+)
+
+
+def pack_split(config, is_train, output_dir):
+    # Writes the tiles of the split into contiguous uint8 arrays as they are decoded:
+    # rgb.npy [N, H, W, 3], keypoint_mask.npy / road_mask.npy [N, H, W], plus index.json.
+    # Label generators are not needed for the images, so they are not built.
+    image_size, _, tile_indices, patterns, coord_transform = dataset_split(config, is_train)
+    # empty tiles are skipped like SatMapDataset does, only their GT graphs are read for that
+    tile_indices = [
+        tile_idx for tile_idx, tile in zip(
+            tile_indices, load_tiles(config, tile_indices, patterns, coord_transform, load_images=False, build_labels=False))
+        if tile is not None
+    ]
+    os.makedirs(output_dir, exist_ok=True)
+    packed_arrays = [
+        np.lib.format.open_memmap(
+            os.path.join(output_dir, f'{name}.npy'), mode='w+', dtype=np.uint8, shape=(len(tile_indices), ) + shape)
+        for name, shape in [
+            ('rgb', (image_size, image_size, 3)),
+            ('keypoint_mask', (image_size, image_size)),
+            ('road_mask', (image_size, image_size)),
+        ]
+    ]
+    tiles = load_tiles(config, tile_indices, patterns, coord_transform, load_images=True, build_labels=False)
+    for i, tile in enumerate(tiles):
+        for packed, image in zip(packed_arrays, tile[:3]):
+            packed[i] = image
+    for packed in packed_arrays:
+        packed.flush()
+    # written last, a split without index.json is incomplete
+    with open(os.path.join(output_dir, 'index.json'), 'w') as jf:
+        json.dump({'DATASET': config.DATASET, 'tile_indices': tile_indices}, jf)
+    print(f'packed {len(tile_indices)} tiles into {output_dir}')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = load_config(args.config)
+    packed_data_dir = config.PACKED_DATA_DIR
+    assert packed_data_dir, 'set PACKED_DATA_DIR in the config'
+    # reads the original images
+    config = copy.deepcopy(config)
+    config.PACKED_DATA_DIR = None
+    config.EMBEDDING_CACHE_DIR = None
+    for split, is_train in [('train', True), ('test', False)]:
+        pack_split(config, is_train, os.path.join(packed_data_dir, split))
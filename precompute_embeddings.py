@@ -0,0 +1,65 @@
+from argparse import ArgumentParser
+import copy
+import json
+import os
+
+import numpy as np
+import torch
+
+from utils import load_config
+from dataset import SatMapDataset, get_embedding_cache_grid, embedding_cache_meta
+from model import SAMRoad
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--config", default=None, help="training config, EMBEDDING_CACHE_DIR is where the cache is written."
+)
+parser.add_argument("--batch_size", default=16, type=int, help="patches per encoder batch")
+parser.add_argument("--device", default="cuda", help="device to run the encoder on")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = load_config(args.config)
+    cache_dir = config.EMBEDDING_CACHE_DIR
+    assert cache_dir, 'set EMBEDDING_CACHE_DIR in the config'
+    device = torch.device("cuda") if args.device == "cuda" else torch.device("cpu")
+
+    # loads the training tiles the usual way
+    dataset_config = copy.deepcopy(config)
+    dataset_config.EMBEDDING_CACHE_DIR = None
+    ds = SatMapDataset(dataset_config, is_train=True)
+    ds.open_packed_arrays()
+
+    net = SAMRoad(config).to(device)
+    net.eval()
+
+    grid = get_embedding_cache_grid(
+        len(ds.loaded_tile_indices), ds.sample_min, ds.sample_max, config.EMBEDDING_CACHE_OFFSETS_PER_EDGE)
+    embedding_size = config.PATCH_SIZE // 16
+    os.makedirs(cache_dir, exist_ok=True)
+    # [N, D, h, w] fp16, memory-mapped
+    embeddings = np.lib.format.open_memmap(
+        os.path.join(cache_dir, 'embeddings.npy'), mode='w+', dtype=np.float16,
+        shape=(len(grid), net.image_encoder.neck[0].out_channels, embedding_size, embedding_size))
+
+    with torch.no_grad():
+        for start in range(0, len(grid), args.batch_size):
+            if start % (100 * args.batch_size) == 0:
+                print(f'Encoding patch {start} / {len(grid)}')
+            rgb_patches = []
+            for img_idx, begin_x, begin_y, rot_index in grid[start:start + args.batch_size]:
+                rgb_patch = ds.rgbs[img_idx][begin_y:begin_y + config.PATCH_SIZE, begin_x:begin_x + config.PATCH_SIZE, :]
+                # CCW, as in SatMapDataset
+                rgb_patches.append(np.rot90(rgb_patch, rot_index, [0, 1]).copy())
+            rgb = torch.tensor(np.stack(rgb_patches, axis=0), dtype=torch.float32, device=device)
+            x = (rgb.permute(0, 3, 1, 2) - net.pixel_mean) / net.pixel_std
+            embeddings[start:start + len(rgb_patches)] = net.image_encoder(x).cpu().numpy().astype(np.float16)
+    embeddings.flush()
+
+    np.save(os.path.join(cache_dir, 'grid.npy'), grid)
+    # written last, a cache without meta.json is incomplete
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as jf:
+        json.dump(embedding_cache_meta(config, ds.loaded_tile_indices), jf)
+    print(f'cached {len(grid)} patch embeddings, {embeddings.nbytes / 2**30:.2f} GB, in {cache_dir}')
@@ -0,0 +1,102 @@
+from argparse import ArgumentParser
+import concurrent.futures
+import copy
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from utils import load_config
+from dataset import SatMapDataset, topo_label_shard_meta
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--config", default=None, help="training config, TOPO_LABEL_SHARD_DIR is where the shards are written."
+)
+parser.add_argument("--epochs", default=None, type=int, help="training epochs of samples to draw, defaults to TRAIN_EPOCHS")
+parser.add_argument("--shard_size", default=4096, type=int, help="samples per shard")
+parser.add_argument("--workers", default=None, type=int, help="processes sampling shards, defaults to the CPU count")
+parser.add_argument("--seed", default=0, type=int, help="shard i is sampled with seed (seed, i)")
+
+
+# Training dataset of the sampling processes, inherited through fork since the rtree
+# indices of the label generators do not pickle.
+_dataset = None
+
+
+def write_shard(shard_dir, sample_num, seed):
+    # Samples crops and their topology labels as SatMapDataset would online, into memory-mappable arrays:
+    # crops [N, 4] int32 (img_idx, begin_x, begin_y, rot_index), points [P, 2] float32 with
+    # point_offsets [N + 1], sources [N, S] int16, targets [N, S, K] int16, connected / valid [N, S * K / 8]
+    # packed bits. Point indices fit int16, patches hold a few thousand points after NMS.
+    np.random.seed(seed)
+    crops, points, sources, targets, connected, valid = [], [], [], [], [], []
+    for _ in range(sample_num):
+        img_idx, begin_x, begin_y, rot_index = _dataset.sample_train_crop()
+        patch = ((begin_x, begin_y), (begin_x + _dataset.config.PATCH_SIZE, begin_y + _dataset.config.PATCH_SIZE))
+        sample_points, sample_pairs, sample_connected, sample_valid = \
+            _dataset.graph_label_generators[img_idx].sample_patch(patch, rot_index)
+        assert len(sample_points) <= np.iinfo(np.int16).max
+        crops.append((img_idx, begin_x, begin_y, rot_index))
+        points.append(sample_points.astype(np.float32))
+        sources.append(sample_pairs[:, 0, 0])
+        targets.append(sample_pairs[:, :, 1])
+        connected.append(np.packbits(sample_connected))
+        valid.append(np.packbits(sample_valid))
+
+    os.makedirs(shard_dir, exist_ok=True)
+    point_offsets = np.cumsum([0] + [len(p) for p in points])
+    for name, array in [
+        ('crops', np.array(crops, dtype=np.int32)),
+        ('point_offsets', point_offsets.astype(np.int64)),
+        ('points', np.concatenate(points, axis=0)),
+        ('sources', np.stack(sources, axis=0).astype(np.int16)),
+        ('targets', np.stack(targets, axis=0).astype(np.int16)),
+        ('connected', np.stack(connected, axis=0)),
+        ('valid', np.stack(valid, axis=0)),
+    ]:
+        np.save(os.path.join(shard_dir, f'{name}.npy'), array)
+    return sample_num
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = load_config(args.config)
+    shard_root = config.TOPO_LABEL_SHARD_DIR
+    assert shard_root, 'set TOPO_LABEL_SHARD_DIR in the config'
+
+    # samples crops the online way
+    dataset_config = copy.deepcopy(config)
+    dataset_config.TOPO_LABEL_SHARD_DIR = None
+    dataset_config.EMBEDDING_CACHE_DIR = None
+    _dataset = SatMapDataset(dataset_config, is_train=True)
+
+    epochs = args.epochs or config.TRAIN_EPOCHS
+    total_num = epochs * _dataset.train_epoch_length()
+    shard_sizes = [min(args.shard_size, total_num - start) for start in range(0, total_num, args.shard_size)]
+    print(f'sampling {total_num} samples ({epochs} epochs) into {len(shard_sizes)} shards')
+
+    written_num = 0
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.workers or os.cpu_count(), mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = [
+            executor.submit(write_shard, os.path.join(shard_root, f'shard_{i:05d}'), shard_size, (args.seed, i))
+            for i, shard_size in enumerate(shard_sizes)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            written_num += future.result()
+            print(f'sampled {written_num} / {total_num}')
+
+    # written last, shards without index.json are incomplete
+    with open(os.path.join(shard_root, 'index.json'), 'w') as jf:
+        json.dump({
+            'meta': topo_label_shard_meta(config, _dataset.loaded_tile_indices),
+            'shard_sizes': shard_sizes,
+            'seed': args.seed,
+        }, jf)
+    shard_bytes = sum(
+        os.path.getsize(os.path.join(shard_root, d, f))
+        for d in os.listdir(shard_root) if d.startswith('shard_') for f in os.listdir(os.path.join(shard_root, d)))
+    print(f'wrote {total_num} samples, {shard_bytes / 2**30:.2f} GB, in {shard_root}')
@@ -0,0 +1,188 @@
+from argparse import ArgumentParser
+import copy
+import os
+
+import torch
+from torch.utils.data import DataLoader
+import lightning.pytorch as pl
+
+from addict import Dict
+
+from utils import load_config
+from dataset import SatMapDataset, get_collate_fn
+from model import build_inference_model, _prune_encoder_block
+from export_checkpoint import measure_patch_latency, save_exported_checkpoint
+
+
+parser = ArgumentParser()
+parser.add_argument(
+    "--config", default=None, help="config of the trained model, can be omitted for exported checkpoints."
+)
+parser.add_argument(
+    "--checkpoint", default=None, help="trained or exported checkpoint to prune."
+)
+parser.add_argument(
+    "--output_dir", default=None, help="pruned checkpoints are saved here as encoder_pruned_<sparsity>.ckpt"
+)
+parser.add_argument(
+    "--sparsities", default="0.25,0.5", help="fraction of heads and MLP channels removed per block, comma separated"
+)
+parser.add_argument("--calibration_batches", default=8, type=int, help="training batches to score importance on")
+parser.add_argument("--finetune_steps", default=0, type=int, help="recovery fine-tune steps per pruned model, 0 to skip")
+parser.add_argument("--eval_batches", default=8, type=int, help="test batches for mask IoU")
+parser.add_argument("--threshold", default=0.5, type=float, help="mask score threshold for IoU")
+parser.add_argument("--device", default="cuda", help="device to use")
+
+
+def training_loss(net, batch):
+    # Mask + topology loss of SAMRoad.training_step, which logs and so needs a Trainer.
+    batch = net.prepare_batch(batch)
+    valid = batch['valid']
+    mask_logits, _, topo_logits, _ = net(batch['rgb'], batch['graph_points'], batch['pairs'], valid)
+    mask_loss = net.mask_criterion(mask_logits, torch.stack([batch['keypoint_mask'], batch['road_mask']], dim=3))
+    topo_loss_mask = valid.to(torch.float32)
+    topo_loss = net.topo_criterion(topo_logits, batch['connected'].to(torch.float32).unsqueeze(-1))
+    topo_loss = (topo_loss * topo_loss_mask.unsqueeze(-1)).sum() / topo_loss_mask.sum()
+    return mask_loss + topo_loss
+
+
+def encoder_importance(net, loader, batch_num, device):
+    # First order Taylor importance, (weight * grad)^2 of the training loss summed over calibration
+    # batches, per attention head and per MLP hidden channel of every encoder block.
+    net.train()
+    # frozen encoders (FREEZE_ENCODER, or LoRA, merged or not) have no grads otherwise
+    net.image_encoder.requires_grad_(True)
+    blocks = net.image_encoder.blocks
+    head_scores = [torch.zeros(blk.attn.num_heads) for blk in blocks]
+    mlp_scores = [torch.zeros(blk.mlp.lin1.out_features) for blk in blocks]
+    for batch_idx, batch in enumerate(loader):
+        if batch_idx == batch_num:
+            break
+        batch = {k: v.to(device) for k, v in batch.items()}
+        net.zero_grad(set_to_none=True)
+        training_loss(net, batch).backward()
+        with torch.no_grad():
+            for blk, head_score, mlp_score in zip(blocks, head_scores, mlp_scores):
+                attn = blk.attn
+                head_dim = attn.qkv.out_features // 3 // attn.num_heads
+                qkv_taylor = (attn.qkv.weight * attn.qkv.weight.grad).pow(2).sum(dim=1)
+                proj_taylor = (attn.proj.weight * attn.proj.weight.grad).pow(2).sum(dim=0)
+                head_score += qkv_taylor.view(3, attn.num_heads, head_dim).sum(dim=(0, 2)).cpu()
+                head_score += proj_taylor.view(attn.num_heads, head_dim).sum(dim=1).cpu()
+                mlp_score += (blk.mlp.lin1.weight * blk.mlp.lin1.weight.grad).pow(2).sum(dim=1).cpu()
+                mlp_score += (blk.mlp.lin2.weight * blk.mlp.lin2.weight.grad).pow(2).sum(dim=0).cpu()
+    net.zero_grad(set_to_none=True)
+    return head_scores, mlp_scores
+
+
+def prune_encoder(net, head_scores, mlp_scores, sparsity):
+    # Removes the lowest scored heads and MLP channels of each block, in place.
+    # Returns the config of the pruned model.
+    config = copy.deepcopy(net.config)
+    config.ENCODER_BLOCK_HEADS, config.ENCODER_BLOCK_MLP_DIMS = [], []
+    for blk, head_score, mlp_score in zip(net.image_encoder.blocks, head_scores, mlp_scores):
+        head_num = max(1, round(len(head_score) * (1 - sparsity)))
+        mlp_dim = max(1, round(len(mlp_score) * (1 - sparsity)))
+        # kept in their original order
+        head_indices = head_score.topk(head_num).indices.sort().values
+        mlp_indices = mlp_score.topk(mlp_dim).indices.sort().values
+        device = blk.attn.qkv.weight.device
+        _prune_encoder_block(blk, head_indices.to(device), mlp_indices.to(device))
+        config.ENCODER_BLOCK_HEADS.append(head_num)
+        config.ENCODER_BLOCK_MLP_DIMS.append(mlp_dim)
+    net.config = config
+    return config
+
+
+def finetune(net, loader, steps, device):
+    # Short recovery fine-tune with the usual training_step, encoder included.
+    net.config.FREEZE_ENCODER = False
+    net.image_encoder.requires_grad_(True)
+    net.matched_param_names = {'image_encoder.' + k for k, _ in net.image_encoder.named_parameters()}
+    trainer = pl.Trainer(
+        max_steps=steps,
+        accelerator='gpu' if device.type == 'cuda' else 'cpu',
+        devices=1,
+        logger=False,
+        enable_checkpointing=False,
+        limit_val_batches=0,
+    )
+    trainer.fit(net, train_dataloaders=loader)
+
+
+def mask_iou(net, loader, batch_num, threshold, device):
+    # Keypoint and road IoU against the ground truth masks, over the first batch_num batches.
+    net.eval()
+    intersection, union = torch.zeros(2), torch.zeros(2)
+    with torch.no_grad():
+        for batch_idx, batch in enumerate(loader):
+            if batch_idx == batch_num:
+                break
+            batch = net.prepare_batch({k: v.to(device) for k, v in batch.items()})
+            # [B, H, W, 2]
+            masks = net.infer_masks(batch['rgb']).cpu() > threshold
+            gt_masks = torch.stack([batch['keypoint_mask'], batch['road_mask']], dim=3).cpu() > 0.5
+            intersection += (masks & gt_masks).sum(dim=(0, 1, 2))
+            union += (masks | gt_masks).sum(dim=(0, 1, 2))
+    return intersection / union.clamp(min=1)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    device = torch.device("cuda") if args.device == "cuda" else torch.device("cpu")
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    # Exported checkpoints embed their config.
+    if args.config:
+        config = load_config(args.config)
+    else:
+        assert 'config' in checkpoint, '--config is required for training checkpoints'
+        config = Dict(checkpoint['config'])
+    assert not config.ENCODER_BLOCK_HEADS, 'the encoder is pruned already'
+    # random crops, not the embedding cache
+    config.EMBEDDING_CACHE_DIR = None
+    net = build_inference_model(config, checkpoint['state_dict'])
+    if config.ENCODER_LORA:
+        net.merge_lora()
+        net.config.ENCODER_LORA = False
+    net.to(device)
+
+    train_loader = DataLoader(
+        SatMapDataset(config, is_train=True),
+        batch_size=config.BATCH_SIZE,
+        shuffle=True,
+        num_workers=config.DATA_WORKER_NUM,
+        collate_fn=get_collate_fn(config),
+    )
+    test_loader = DataLoader(
+        SatMapDataset(config, is_train=False),
+        batch_size=config.BATCH_SIZE,
+        shuffle=False,
+        num_workers=config.DATA_WORKER_NUM,
+        collate_fn=get_collate_fn(config),
+    )
+
+    head_scores, mlp_scores = encoder_importance(net, train_loader, args.calibration_batches, device)
+    iou = mask_iou(net, test_loader, args.eval_batches, args.threshold, device)
+    latency = measure_patch_latency(net, config, device)
+    print(
+        f'sparsity 0.00: {latency * 1000:.2f} ms per patch, '
+        f'keypoint IoU {iou[0].item():.4f}, road IoU {iou[1].item():.4f}'
+    )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for sparsity in [float(s) for s in args.sparsities.split(',')]:
+        pruned_net = copy.deepcopy(net)
+        pruned_config = prune_encoder(pruned_net, head_scores, mlp_scores, sparsity)
+        if args.finetune_steps > 0:
+            finetune(pruned_net, train_loader, args.finetune_steps, device)
+            pruned_net.to(device)
+        iou = mask_iou(pruned_net, test_loader, args.eval_batches, args.threshold, device)
+        pruned_latency = measure_patch_latency(pruned_net, pruned_config, device)
+        print(
+            f'sparsity {sparsity:.2f}{f" + {args.finetune_steps} fine-tune steps" if args.finetune_steps else ""}: '
+            f'{pruned_latency * 1000:.2f} ms per patch ({latency / pruned_latency:.2f}x), '
+            f'keypoint IoU {iou[0].item():.4f}, road IoU {iou[1].item():.4f}'
+        )
+        # the saved config matches the pruned model, not the fine-tune overrides
+        pruned_config.FREEZE_ENCODER = config.FREEZE_ENCODER
+        save_exported_checkpoint(pruned_net, pruned_config, os.path.join(args.output_dir, f'encoder_pruned_{sparsity}.ckpt'))
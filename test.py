@@ -5,7 +5,7 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 
 from utils import load_config
-from dataset import SatMapDataset, graph_collate_fn
+from dataset import SatMapDataset, get_collate_fn
 from model import SAMRoad
 
 import wandb
@@ -51,7 +51,7 @@ if __name__ == "__main__":
         shuffle=False,
         num_workers=config.DATA_WORKER_NUM,
         pin_memory=True,
-        collate_fn=graph_collate_fn,
+        collate_fn=get_collate_fn(config),
     )
 
     checkpoint_callback = ModelCheckpoint(every_n_epochs=1, save_top_k=-1)
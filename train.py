@@ -5,7 +5,7 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 
 from utils import load_config
-from dataset import SatMapDataset, graph_collate_fn
+from dataset import SatMapDataset, get_collate_fn
 from model import SAMRoad
 
 import wandb
@@ -63,13 +63,16 @@ if __name__ == "__main__":
 
     train_ds, val_ds = SatMapDataset(config, is_train=True, dev_run=dev_run), SatMapDataset(config, is_train=False, dev_run=dev_run)
 
+    # presampled topology labels come with their own seeded epoch order
+    train_sampler = train_ds.presampled_sampler() if train_ds.label_shard_dir is not None else None
     train_loader = DataLoader(
         train_ds,
         batch_size=config.BATCH_SIZE,
-        shuffle=True,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
         num_workers=config.DATA_WORKER_NUM,
         pin_memory=True,
-        collate_fn=graph_collate_fn,
+        collate_fn=get_collate_fn(config),
     )
 
     val_loader = DataLoader(
@@ -78,7 +81,7 @@ if __name__ == "__main__":
         shuffle=False,
         num_workers=config.DATA_WORKER_NUM,
         pin_memory=True,
-        collate_fn=graph_collate_fn,
+        collate_fn=get_collate_fn(config),
     )
 
     checkpoint_callback = ModelCheckpoint(every_n_epochs=1, save_top_k=-1)
@@ -96,6 +99,9 @@ if __name__ == "__main__":
         callbacks=[checkpoint_callback, lr_monitor],
         logger=wandb_logger,
         fast_dev_run=args.fast_dev_run,
+        # PresampledEpochSampler splits epochs across DDP ranks itself, and needs set_epoch
+        # which Lightning's sampler wrapper does not pass on. Validation is then not split.
+        use_distributed_sampler=train_sampler is None,
         # strategy='ddp_find_unused_parameters_true',
         precision=args.precision,
         # profiler=profiler
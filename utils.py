@@ -1,7 +1,9 @@
+import hashlib
 import yaml
 from addict import Dict
 from datetime import datetime
 import os
+import torch
 
 def load_config(path):
     with open(path) as file:
@@ -27,4 +29,13 @@ def create_output_dir_and_save_config(output_dir_prefix, config, specified_dir=N
     with open(config_path, 'w') as file:
         yaml.dump(config.to_dict(), file)
     
-    return output_dir
\ No newline at end of file
+    return output_dir
+
+def state_dict_content_hash(state_dict):
+    # sha256 over names, dtypes, shapes and bytes of the tensors, in name order.
+    hasher = hashlib.sha256()
+    for name in sorted(state_dict.keys()):
+        tensor = state_dict[name].detach().cpu().contiguous()
+        hasher.update(f'{name}:{tensor.dtype}:{tuple(tensor.shape)}'.encode())
+        hasher.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    return hasher.hexdigest()
\ No newline at end of file